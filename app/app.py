@@ -1,51 +1,81 @@
 import os
-from flask import Flask, request, jsonify, make_response
-from sqlalchemy.exc import OperationalError
-from sqlalchemy import text
+from flask import Flask, Response, request, jsonify, make_response, g, current_app, stream_with_context
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import update
+from sqlalchemy.orm import joinedload
 from dotenv import load_dotenv
 import logging
-from utils.models import db, User, Image, get_est_time
+from utils.models import db, User, Image, utc_now, to_est_isoformat, to_est_date, db_now_minus, VERIFICATION_TOKEN_TTL
 from utils.db_init import init_db
-from utils.s3 import upload_to_s3, delete_from_s3
-import bcrypt
+from utils.s3 import upload_to_s3, delete_from_s3, stream_upload_to_s3, UploadTooLarge, S3_MIN_PART_SIZE
+from utils.s3 import create_presigned_upload, get_object_size, get_presigned_download_url, presigned_url_cache
+from utils.multipart_stream import open_streamed_file, MalformedMultipart
+from utils.auth_cache import create_auth_cache
+from utils.response_cache import create_response_cache, make_etag
+from utils.user_cache import create_user_cache
+from utils.bulk_import import create_bulk_importer, read_rows, detect_format
+from utils.request_capture import create_request_capture
+from utils.profiling import create_profiler
+from utils.tracing import tracer, TRACE_HEADER, format_trace_header
+from utils.query_stats import create_query_stats, SORT_KEYS
+from utils.passwords import create_password_hasher, PasswordHasherSaturated
+from utils.sns_outbox import create_outbox_dispatcher, enqueue_verification
+from utils.email_validation import create_email_validator
+from utils.db_pool import get_engine_options, register_failover_handler, register_pool_metrics
+from utils.db_routing import REPLICA_BIND_KEY, read_only, read_with_fallback, register_replica_fallback, mark_write
+from utils.log_pipeline import configure_logging, UNSAMPLED
+from utils.metrics import metrics
+from utils.health import create_health_monitor
+from utils.request_validation import RequestValidator, request_rules
+from utils.latency import latency, add_phase_time, record_request, TimedJSONProvider
 from flask_httpauth import HTTPBasicAuth
-from email_validator import validate_email, EmailNotValidError
+from email_validator import EmailNotValidError
 from urllib.parse import quote_plus
-from statsd import StatsClient
 import time
 from werkzeug.utils import secure_filename
 from sqlalchemy import event
 import sys
 import socket
 import uuid
-from datetime import datetime, timedelta
-import boto3
+import hmac
+import ipaddress
+import io
 import json
+import click
 from functools import wraps
 
 # Initialize HTTPBasicAuth
 auth = HTTPBasicAuth()
 
-# Configure Logging
-if 'pytest' not in sys.modules:
-    logging.basicConfig(
-        level=logging.INFO,  # Set the logging level
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',  # Log format
-        handlers=[
-            logging.FileHandler("/var/log/webapp/csye6225-webapp.log"),  # Log file name
-            logging.StreamHandler()  # Also log to console
-        ]
-    )
-
 # Load environment variables from .env
 load_dotenv()
 
+# Configure Logging. LOG_MODE=async moves the file and console writes to a background thread
+if 'pytest' not in sys.modules:
+    configure_logging()
+
+# Cache of recently verified credentials, so repeat callers skip bcrypt
+auth_cache = create_auth_cache()
+
+# Users and their profile pictures by email, in-process and optionally shared between instances
+user_cache = create_user_cache()
+
+# Serialized GET /v1/user/self and /v1/user/self/pic responses, per user
+response_cache = create_response_cache()
+
+# Bounded worker pool that runs bcrypt off the request threads
+password_hasher = create_password_hasher()
+
+# Signup email validation with cached, time-bounded deliverability checks
+signup_email_validator = create_email_validator()
+
 # Define allowed headers globally
 # Any additional header added during runtime, should result in a 400 Bad Request
 ALLOWED_HEADERS = {'Authorization', 'Host', 'Accept', 'Connection', 'User-Agent', 'Accept-Encoding', 'Cache-Control', 'Postman-Token', 'Content-Type', 'Content-Length'}
 
-# Define allowed file extensions for profile picture uploads
-ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# Define allowed file extensions for profile picture uploads, with their content types
+IMAGE_CONTENT_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg'}
+ALLOWED_IMAGE_EXTENSIONS = set(IMAGE_CONTENT_TYPES)
 
 ALB_ADDED_HEADERS = {'X-Forwarded-For', 'X-Forwarded-Proto', 'X-Forwarded-Port', 'X-Amzn-Trace-Id', 'X-Forwarded-Host', 'X-Amz-Cf-Id', 'X-Amzn-RequestId'}
 
@@ -56,13 +86,6 @@ def allowed_file(filename):
         filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS
 
 
-# Function to reject body for GET requests
-def reject_body_for_get():
-    if request.method == 'GET' and (request.data or request.form):
-        logging.error("GET requests should not contain a body")
-        return jsonify({'message': 'GET requests should not contain a body'}), 400
-
-
 # Add these utility functions
 def generate_verification_token():
     return str(uuid.uuid4())
@@ -74,27 +97,11 @@ def create_verification_link(user_email, token):
     return f"{verification_url}?user={user_email}&token={token}"
 
 
-def publish_to_sns(user_data):
-    try:
-        sns = boto3.client('sns', region_name=os.getenv('AWS_REGION'))
-
-        message = {
-            'email': user_data['email'],
-            'first_name': user_data['first_name'],
-            'verification_link': user_data['verification_link'],
-            'expiration_time': (datetime.fromisoformat(get_est_time()) + timedelta(minutes=2)).isoformat()
-        }
-
-        response = sns.publish(
-            TopicArn=os.getenv('AWS_SNS_TOPIC_ARN'),
-            Message=json.dumps(message),
-            MessageStructure='string'
-        )
-        logging.info(f"SNS message published successfully: {response['MessageId']}")
-        return True
-    except Exception as e:
-        logging.error(f"Error publishing to SNS: {e}")
-        return False
+# Wake up the outbox dispatcher after committing new messages, if one is running
+def notify_outbox():
+    dispatcher = current_app.extensions.get('sns_outbox')
+    if dispatcher is not None:
+        dispatcher.notify()
 
 
 def configure_app(app, testing):
@@ -102,6 +109,7 @@ def configure_app(app, testing):
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
     elif testing == 'integration':
         app.config['SQLALCHEMY_DATABASE_URI'] = f"postgresql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}_test"
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options()
     else:
         # AWS RDS connection string
         db_user = quote_plus(os.getenv('RDS_USERNAME'))
@@ -110,47 +118,237 @@ def configure_app(app, testing):
         db_port = os.getenv('RDS_PORT', '5432')
         db_name = os.getenv('RDS_DB_NAME')
         app.config['SQLALCHEMY_DATABASE_URI'] = f"postgresql://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
+        # Pool sizing, pre-ping, recycling and timeouts
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options()
+        # Read replica, reached with the same credentials as the primary
+        if os.getenv('RDS_REPLICA_HOSTNAME'):
+            app.config['SQLALCHEMY_BINDS'] = {
+                REPLICA_BIND_KEY: f"postgresql://{db_user}:{db_password}@{os.getenv('RDS_REPLICA_HOSTNAME')}:{db_port}/{db_name}"
+            }
+    # An explicit replica URL wins, e.g. a second local database for tests
+    if os.getenv('DB_REPLICA_URI'):
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA_BIND_KEY: os.getenv('DB_REPLICA_URI')}
 
     db.init_app(app)
 
 
+# Load a user together with their profile picture in a single query
+def load_user(email):
+    return User.query.options(joinedload(User.images)).filter_by(email=email).first()
+
+
+# The authenticated user for the current request, loaded once by verify_password
+def current_user():
+    return g.get('user')
+
+
+# The profile picture of a user loaded by load_user, if any
+def get_user_image_record(user):
+    return user.images[0] if user.images else None
+
+
 # Basic Token based authentication for the user
 @auth.verify_password
 def verify_password(email, password):
-    # Retrieve the user from the database based on email ID
-    user = User.query.filter_by(email=email).first()
-    if user and bcrypt.checkpw(password.encode('utf-8'), user.password.encode('utf-8')):
+    # Retrieve the user from the cache, or the database based on email ID.
+    # The lookup goes to the read replica unless this user wrote in the last few seconds,
+    # or the replica cannot be reached
+    user = read_with_fallback(lambda: user_cache.get_user(email, load_user), email)
+    # Remembered so the auth error handler does not have to look the user up again
+    g.auth_user_exists = user is not None
+    if user and auth_cache.get(email, password, user.password):
+        g.user = user
         return True
-    logging.error(f"Unauthorized access attempt for email: {email}")
+    if user and password_hasher.check(password, user.password):
+        auth_cache.add(email, password, user.password)
+        g.user = user
+        return True
+    # Never sampled: every failed attempt matters when looking into a brute-force attempt
+    logging.error("Unauthorized access attempt for email: %s", email, extra=UNSAMPLED)
     return False
 
 
-# Request validation method to check for query parameters, headers added during runtime
-def validate_request(request):
-    # Check for query parameters if added additionally
-    if request.args:
-        logging.error("Query parameters are not allowed")
-        return jsonify({'message': 'Bad Request'}), 400
-    # Check for new headers if added
-    incoming_headers = set(request.headers.keys())
-    allowed_headers = ALLOWED_HEADERS.union(ALB_ADDED_HEADERS)
-    if not incoming_headers.issubset(allowed_headers):
-        logging.error("Invalid headers in request")
-        return make_response(jsonify({"error": "Bad Request"}), 400)
-    return None
-
-
 def require_verified_user(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        user_email = auth.current_user()
-        user = User.query.filter_by(email=user_email).first()
+        user = current_user()
         if not user or not user.is_verified:
             return jsonify({'message': 'User is not verified'}), 403
         return f(*args, **kwargs)
     return decorated_function
 
 
+# Introspection and admin endpoints are open to requests from this host that did not come
+# through the ALB, and to callers presenting the token in token_variable as a bearer token
+def internal_request_allowed(request, token_variable='METRICS_TOKEN'):
+    token = os.getenv(token_variable)
+    authorization = request.headers.get('Authorization', '')
+    if token and authorization.startswith('Bearer '):
+        return hmac.compare_digest(authorization[len('Bearer '):].encode(), token.encode())
+    try:
+        is_local = ipaddress.ip_address(request.remote_addr or '').is_loopback
+    except ValueError:
+        return False
+    return is_local and 'X-Forwarded-For' not in request.headers
+
+
+# JSON response of a conditional GET. Returns 304 when the client's If-None-Match already
+# has this etag. Otherwise serves the cached body for this etag, or serializes the dict
+# returned by build() and caches it
+def conditional_json_response(user, kind, etag, build):
+    if request.if_none_match.contains(etag):
+        metrics.incr('response_cache.not_modified', tags={'kind': kind})
+        response = make_response('', 304)
+    else:
+        body = response_cache.get(user.id, kind, etag)
+        if body is None:
+            metrics.incr('response_cache.misses', tags={'kind': kind})
+            response = current_app.json.response(build())
+            response_cache.add(user.id, kind, etag, response.get_data())
+        else:
+            metrics.incr('response_cache.hits', tags={'kind': kind})
+            response = current_app.response_class(body, mimetype=current_app.json.mimetype)
+    response.set_etag(etag)
+    return response
+
+
+# Create the image record for a profile picture uploaded to S3.
+# Returns None if the user already has one: the unique constraint on images.user_id
+# makes the insert itself the atomic "already exists" check, so two concurrent uploads
+# cannot both win. The earlier checks in the handlers only avoid a wasted upload.
+def save_image_record(user, file_name):
+    new_image = Image(
+        file_name=file_name,
+        user_id=user.id,
+        url=f"{os.getenv('AWS_S3_BUCKET')}/{user.id}/{file_name}",
+    )
+    db.session.add(new_image)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    mark_write(user.email)
+    user_cache.invalidate(user.email)
+    response_cache.invalidate(user.id)
+    return {
+        'id': new_image.id,
+        'file_name': file_name,
+        'url': new_image.url,
+        'upload_date': to_est_date(new_image.upload_date),
+        'user_id': new_image.user_id
+    }
+
+
+# Response for an upload that lost the race against another upload for the same user.
+# Our object is removed from S3 unless the winning upload used the very same key
+def duplicate_image_response(user, file_name):
+    existing_image = Image.query.filter_by(user_id=user.id).first()
+    if existing_image is None or existing_image.file_name != file_name:
+        delete_from_s3(os.getenv('AWS_S3_BUCKET'), file_name)
+    logging.error("An image already exists for this user")
+    return jsonify({'message': 'An image already exists for this user'}), 400
+
+
+# How profile pictures reach S3: 'buffered' (default), 'stream' or 'presigned'
+def image_upload_mode():
+    return os.getenv('IMAGE_UPLOAD_MODE', 'buffered')
+
+
+def get_max_upload_size():
+    return int(os.getenv('S3_UPLOAD_MAX_SIZE', str(10 * 1024 * 1024)))
+
+
+# Lifetime of presigned upload forms and download URLs, in seconds
+def get_presigned_expiry():
+    return int(os.getenv('S3_PRESIGNED_EXPIRY', '300'))
+
+
+# Step 1 of a presigned upload: return a presigned POST form for the user's image key.
+# The client uploads the file to S3 itself and then calls /v1/user/self/pic/complete
+def presign_profile_picture(user):
+    data = request.get_json(silent=True)
+    filename = data.get('file_name', '') if isinstance(data, dict) else ''
+    if filename == '':
+        logging.error("No selected file")
+        return jsonify({'message': 'No selected file'}), 400
+    if not allowed_file(filename):
+        logging.error("Invalid file type")
+        return jsonify({'message': 'Invalid file type'}), 400
+    if get_user_image_record(user):
+        logging.error("An image already exists for this user")
+        return jsonify({'message': 'An image already exists for this user'}), 400
+
+    # Generate a unique filename for the image
+    file_name = secure_filename(f"{user.id}_{filename}")
+    expires_in = get_presigned_expiry()
+    content_type = IMAGE_CONTENT_TYPES[filename.rsplit('.', 1)[1].lower()]
+    upload = create_presigned_upload(os.getenv('AWS_S3_BUCKET'), file_name, get_max_upload_size(), content_type,
+                                     expires_in)
+    logging.info("Presigned upload created")
+    return jsonify({
+        'file_name': file_name,
+        'upload_url': upload['url'],
+        'upload_fields': upload['fields'],
+        'expires_in': expires_in
+    }), 200
+
+
+# Upload a profile picture by streaming the multipart body to an S3 multipart upload.
+# The file is never held in memory or spooled to disk, so worker memory stays flat
+# however large the upload is; anything over S3_UPLOAD_MAX_SIZE is cut off early.
+def stream_profile_picture(user):
+    max_size = get_max_upload_size()
+    # Reject uploads that announce an oversized body before reading any of it
+    if request.content_length is not None and request.content_length > max_size:
+        logging.error("Upload too large")
+        return jsonify({'message': 'File too large'}), 413
+    if get_user_image_record(user):
+        logging.error("An image already exists for this user")
+        return jsonify({'message': 'An image already exists for this user'}), 400
+
+    try:
+        streamed_file = open_streamed_file(request.stream, request.content_type)
+    except MalformedMultipart as e:
+        logging.error("Malformed multipart body: %s", e)
+        return jsonify({'message': 'Malformed multipart body'}), 400
+    if streamed_file is None:
+        logging.error("No file part")
+        return jsonify({'message': 'No file part'}), 400
+    filename, chunks = streamed_file
+    if filename == '':
+        logging.error("No selected file")
+        return jsonify({'message': 'No selected file'}), 400
+    if not allowed_file(filename):
+        logging.error("Invalid file type")
+        return jsonify({'message': 'Invalid file type'}), 400
+
+    # Generate a unique filename for the image
+    file_name = secure_filename(f"{user.id}_{filename}")
+    try:
+        uploaded = stream_upload_to_s3(
+            chunks, os.getenv('AWS_S3_BUCKET'), file_name,
+            part_size=max(S3_MIN_PART_SIZE, int(os.getenv('S3_UPLOAD_PART_SIZE', str(S3_MIN_PART_SIZE)))),
+            max_size=max_size,
+            concurrency=int(os.getenv('S3_UPLOAD_CONCURRENCY', '4'))
+        )
+    except UploadTooLarge:
+        logging.error("Upload too large")
+        return jsonify({'message': 'File too large'}), 413
+    except MalformedMultipart as e:
+        # The body ended or broke off partway through the file
+        logging.error("Malformed multipart body: %s", e)
+        return jsonify({'message': 'Malformed multipart body'}), 400
+    if not uploaded:
+        logging.error("Failed to upload to S3")
+        return jsonify({'message': 'Failed to upload to S3'}), 500
+    user_info = save_image_record(user, file_name)
+    if user_info is None:
+        return duplicate_image_response(user, file_name)
+    logging.info("Profile picture uploaded successfully!")
+    return user_info, 201
+
+
 # Password validation function
 def validate_password(password):
     if not password or len(password) < 5:
@@ -162,61 +360,129 @@ def validate_password(password):
 # Flask app begins here
 def create_app(testing=None):
     app = Flask(__name__)
+    # Time spent encoding JSON responses is reported as the serialization phase
+    app.json = TimedJSONProvider(app)
 
     # Configure logging
     logging.info("\nLogging for application has been configured successfully!\n")
-    logging.info(f"Hostname: {socket.gethostname()}")
-    # Initialize StatsD client
-    statsd_client = StatsClient('localhost', 8125)
+    logging.info("Hostname: %s", socket.gethostname())
     # Configure the app
     configure_app(app, testing)
+    # Background publisher for the SNS outbox. Started once the database is initialized,
+    # tests drain it explicitly against a stub client instead
+    app.extensions['sns_outbox'] = create_outbox_dispatcher(app)
+    # Subscribes to invalidations from other instances once started
+    app.extensions['user_cache'] = user_cache
+    # Bulk user creation, behind /v1/admin/users/import and `flask import-users`
+    app.extensions['bulk_import'] = create_bulk_importer(
+        password_hasher, signup_email_validator, validate_password, create_verification_link, after_commit=notify_outbox
+    )
+    # Opt-in stack sampler and per-request cProfile dumps, driven by the request hooks
+    profiler = create_profiler()
+    app.extensions['profiler'] = profiler
+    # Per-statement counts and latencies, and the slow query log. None when disabled
+    query_stats = create_query_stats()
+    app.extensions['query_stats'] = query_stats
 
     with app.app_context():
         # Add these database query monitoring events
-        @event.listens_for(db.engine, 'before_cursor_execute')
+        # The start time is kept per statement: a per-connection setdefault only ever held
+        # the first statement's start, so later durations kept growing
+        # Each statement is also a child span of the current trace, without its parameters
         def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
-            conn.info.setdefault('query_start_time', time.time())
-            statsd_client.incr('database.query.count')
+            conn.info['query_start_time'] = time.perf_counter()
+            conn.info['query_span'] = tracer.start_span('db.query', kind='client', attributes={
+                'db.system': conn.dialect.name, 'db.statement': statement, 'db.executemany': executemany})
+            metrics.incr('database.query.count')
 
-        @event.listens_for(db.engine, 'after_cursor_execute')
         def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
-            total_time = time.time() - conn.info['query_start_time']
-            statsd_client.timing('database.query.duration', total_time * 1000)  # Convert to milliseconds
-
-    # Health check for database connection. By default GET method
+            total_time = time.perf_counter() - conn.info.pop('query_start_time', time.perf_counter())
+            metrics.timing('database.query.duration', total_time * 1000)  # Convert to milliseconds
+            add_phase_time('db', total_time)
+            query_id = None
+            if query_stats is not None:
+                query_id = query_stats.record(statement, total_time, cursor.rowcount, conn, parameters, executemany)
+            span = conn.info.pop('query_span', None)
+            if span is not None:
+                span.set_attribute('db.rowcount', cursor.rowcount)
+                span.set_attribute('db.query_id', query_id)
+                tracer.end_span(span)
+
+        # A failed statement never reaches after_cursor_execute
+        def handle_db_error(exception_context):
+            if query_stats is not None and exception_context.statement:
+                query_stats.record_error(exception_context.statement)
+            if exception_context.connection is not None:
+                span = exception_context.connection.info.pop('query_span', None)
+                tracer.end_span(span, exception_context.original_exception)
+
+        # On every engine, so statements sent to the read replica are measured too
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(engine, 'handle_error', handle_db_error)
+
+        # Connection pool gauges and failover detection, on the replica's pool too
+        for key, engine in db.engines.items():
+            register_pool_metrics(engine, 'primary' if key is None else key)
+            register_failover_handler(engine)
+        if REPLICA_BIND_KEY in db.engines:
+            register_replica_fallback(db.engines[REPLICA_BIND_KEY])
+        # Cached readiness and deep health checks. The background probe is started with the
+        # outbox dispatcher; until then checks run on demand
+        app.extensions['health'] = create_health_monitor(db.engines)
+
+    # Liveness: the process is up and serving requests. Nothing else is checked
+    @app.route('/livez')
+    def liveness_check():
+        return '', 200
+
+    # Health check for database connection. By default GET method.
+    # Answers from the result of the last background database probe instead of querying on every call
     @app.route('/healthz')
     def health_check():
         try:
-            # This method should not accept any data in the request
-            error_response = reject_body_for_get()
-            if error_response:
-                return error_response
-            validation_response = validate_request(request)
-            if validation_response:
-                return validation_response
-            db.session.execute(text('SELECT 1'))
-            logging.info("Health check passed")
+            if not app.extensions['health'].is_ready():
+                return '', 503
             return '', 200
-        except OperationalError:
-            logging.error("Database connection error")
-            return '', 503
         except Exception as e:
-            logging.error(f"Error in health check: {e}")
+            logging.error("Error in health check: %s", e)
+            return '', 500
+
+    # Deep health check: the databases plus S3 and SNS reachability, with the status of each
+    @app.route('/healthz/deep')
+    def deep_health_check():
+        try:
+            if not internal_request_allowed(request):
+                return jsonify({'message': 'Not Found'}), 404
+            status = app.extensions['health'].deep_status()
+            healthy = all(value == 'ok' for value in status.values())
+            return jsonify(status), 200 if healthy else 503
+        except Exception as e:
+            logging.error("Error in deep health check: %s", e)
             return '', 500
 
+    # Latency histograms in the Prometheus text format, for local introspection and scraping
+    # Scrapers send their own headers, so the usual request validation does not apply
+    @app.route('/metrics', methods=['GET'])
+    @request_rules(enabled=False)
+    def prometheus_metrics():
+        if not internal_request_allowed(request):
+            return jsonify({'message': 'Not Found'}), 404
+        response = make_response(latency.render_prometheus(), 200)
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
+
     # Method to Create user
     @app.route('/v1/user', methods=['POST'])
     def create_user():
         try:
-            validation_response = validate_request(request)
-            if validation_response:
-                return validation_response
             data = request.get_json()
             # Email address validation. If error occurs, this library returns appropriate messages
             try:
-                validate_email(data['email'])
+                signup_email_validator.validate(data['email'])
             except EmailNotValidError as e:
-                logging.error(f"Invalid email address: {e}")
+                logging.error("Invalid email address: %s", e)
                 return jsonify({'message': str(e)}), 400
             if User.query.filter_by(email=data['email']).first():
                 logging.error("User already exists!")
@@ -226,57 +492,134 @@ def create_app(testing=None):
             # Validate password
             is_valid, message = validate_password(data['password'])
             if not is_valid:
-                logging.error(f"Password validation failed: {message}")
+                logging.error("Password validation failed: %s", message)
                 return jsonify({'message': message}), 400
-            hashed = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt())
-            # Have to use decode here to avoid the password to be double-encoded
+            # The hasher returns the hash decoded to avoid the password to be double-encoded
             # Seems to be an issue when using postgresql db
-            # without the below command (decode), was facing "Invalid Salt" error when
+            # without decoding, was facing "Invalid Salt" error when
             # trying to match the password for existing user
-            hashed_decoded = hashed.decode('utf-8')
+            hashed_decoded = password_hasher.hash(data['password'])
             new_user = User(
                 first_name=data['first_name'],
                 last_name=data['last_name'],
                 email=data['email'],
                 password=hashed_decoded,
                 verification_token=verification_token,
-                verification_token_created=get_est_time(),
+                verification_token_created=utc_now(),
                 verification_email_count=0
             )
             db.session.add(new_user)
-            db.session.commit()
-            # Generate verification link and publish to SNS
+            # Flush to get the user's id for the outbox row
+            db.session.flush()
+            # Generate verification link and queue it for SNS in the same transaction as the user.
+            # The outbox dispatcher publishes it and increments verification_email_count
             verification_link = create_verification_link(new_user.email, verification_token)
-            sns_data = {
-                'email': new_user.email,
-                'first_name': new_user.first_name,
-                'verification_link': verification_link
-            }
-
-            if not publish_to_sns(sns_data):
-                logging.error("Failed to publish verification message to SNS")
-                return jsonify({'message': 'Failed to publish verification message to SNS'}), 500
-
-            # Increment verification_email_count by 1
-            new_user.verification_email_count += 1
+            enqueue_verification(new_user, verification_link)
             db.session.commit()
+            mark_write(new_user.email)
+            notify_outbox()
 
             user_info = {
                 'id': new_user.id,
                 'first_name': new_user.first_name,
                 'last_name': new_user.last_name,
                 'email': new_user.email,
-                'account_created': new_user.account_created,
-                'account_updated': new_user.account_updated
+                'account_created': to_est_isoformat(new_user.account_created),
+                'account_updated': to_est_isoformat(new_user.account_updated)
             }
-            logging.info("User created successfully!\n Info: %s", user_info)
+            logging.info("User created successfully: %s", new_user.id)
             return user_info, 201
+        except PasswordHasherSaturated:
+            raise
         except Exception as e:
-            logging.error(f"Error in creating user: {e}")
+            logging.error("Error in creating user: %s", e)
             return jsonify({'message': f"Missing fields. {str(e)}"}), 400
 
+    # Bulk user creation for onboarding. The body is NDJSON, or CSV with a text/csv content type,
+    # with first_name, last_name, email and password per row. It is read as it arrives and one
+    # NDJSON result per row is streamed back, with the status POST /v1/user would have returned.
+    # Only served locally or with the ADMIN_TOKEN bearer token
+    @app.route('/v1/admin/users/import', methods=['POST'])
+    def bulk_import_users():
+        if not internal_request_allowed(request, 'ADMIN_TOKEN'):
+            return jsonify({'message': 'Not Found'}), 404
+        importer = app.extensions['bulk_import']
+        stream = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8', newline='')
+        rows = read_rows(stream, detect_format(request.mimetype))
+
+        def generate():
+            for result in importer.import_rows(rows):
+                yield json.dumps(result) + '\n'
+        logging.info("Bulk user import started")
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    # Bulk user creation from a file, or - for stdin, e.g.
+    #   flask --app app import-users users.csv
+    # Prints one result per row and a summary at the end
+    @app.cli.command('import-users')
+    @click.argument('file', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default=None,
+                  help='Defaults to csv for .csv files, ndjson otherwise')
+    def import_users_command(file, fmt):
+        rows = read_rows(file, fmt or detect_format(file.name))
+        created = failed = 0
+        for result in app.extensions['bulk_import'].import_rows(rows):
+            click.echo(json.dumps(result))
+            if result['status'] == 201:
+                created += 1
+            else:
+                failed += 1
+        click.echo(f"{created} users created, {failed} rows failed", err=True)
+
+    # Profiler status, and runtime control of this worker's profilers:
+    # {"sampler": true|false, "request_rate": 0.01}. Only served locally or with ADMIN_TOKEN
+    @app.route('/v1/admin/profiling', methods=['GET', 'POST'])
+    def profiling_settings():
+        if not internal_request_allowed(request, 'ADMIN_TOKEN'):
+            return jsonify({'message': 'Not Found'}), 404
+        if request.method == 'POST':
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict) or not set(data) <= {'sampler', 'request_rate'}:
+                return jsonify({'message': 'Bad Request'}), 400
+            if 'request_rate' in data:
+                rate = data['request_rate']
+                if not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+                    return jsonify({'message': 'request_rate must be between 0 and 1'}), 400
+                profiler.request_profiler.rate = rate
+            if data.get('sampler') is True:
+                profiler.sampler.start()
+            elif data.get('sampler') is False:
+                profiler.sampler.stop()
+            logging.info("Profiling settings changed: %s", data)
+        return jsonify(profiler.status()), 200
+
+    # Statement statistics: the top `limit` fingerprints by total time, mean, p99, max or
+    # count. DELETE starts over
+    @app.route('/v1/admin/queries', methods=['GET', 'DELETE'])
+    @request_rules(query_params=['limit', 'sort'])
+    def query_statistics():
+        if query_stats is None or not internal_request_allowed(request, 'ADMIN_TOKEN'):
+            return jsonify({'message': 'Not Found'}), 404
+        if request.method == 'DELETE':
+            query_stats.clear()
+            return '', 204
+        sort = request.args.get('sort', 'total')
+        limit = request.args.get('limit', '20')
+        if sort not in SORT_KEYS or not limit.isdigit() or int(limit) < 1:
+            return jsonify({'message': f"sort must be one of {', '.join(SORT_KEYS)} and limit a positive number"}), 400
+        return jsonify({'fingerprints': len(query_stats), 'queries': query_stats.top(int(limit), sort)}), 200
+
+    # Stack samples collected so far in the folded format, e.g. for flamegraph.pl
+    @app.route('/v1/admin/profiling/stacks', methods=['GET'])
+    def profiling_stacks():
+        if not internal_request_allowed(request, 'ADMIN_TOKEN'):
+            return jsonify({'message': 'Not Found'}), 404
+        return Response(profiler.sampler.folded(), mimetype='text/plain')
+
     # Method to verify email
+    # Opened from an email in a browser, which sends headers of its own
     @app.route('/v1/verify-email', methods=['GET'])
+    @request_rules(enabled=False)
     def verify_email():
         try:
             # Get the verification token from the query parameters
@@ -284,27 +627,29 @@ def create_app(testing=None):
             if not token:
                 return jsonify({'message': 'Missing verification token'}), 400
 
-            # Check if the token is valid in the database
-            user = User.query.filter_by(verification_token=token).first()
-            if not user:
-                return jsonify({'message': 'Invalid verification token'}), 404
-
-            # Check if the token is still within the expiration time (2 minutes)
-            token_created = datetime.fromisoformat(user.verification_token_created)
-            now = datetime.now(token_created.tzinfo)
-            expiration_time = token_created + timedelta(minutes=2)
-            if now > expiration_time:
-                return jsonify({'message': 'Verification token expired'}), 400
-
-            # Update the user's verified status
-            user.is_verified = True
-            user.verification_token = None
-            user.verification_token_created = None
+            # Verify the user in a single statement if the token is valid and still within
+            # the expiration time (2 minutes). The expiry check runs in SQL with the database clock.
+            # Filtering on is_verified lets this use the partial index on unverified users
+            verified_email = db.session.execute(
+                update(User)
+                .where(User.verification_token == token,
+                       User.is_verified == False,  # noqa: E712
+                       User.verification_token_created > db_now_minus(VERIFICATION_TOKEN_TTL))
+                .values(is_verified=True, verification_token=None, verification_token_created=None)
+                .returning(User.email)
+            ).scalar()
             db.session.commit()
+            if verified_email is not None:
+                mark_write(verified_email)
+                user_cache.invalidate(verified_email)
+                return jsonify({'message': 'Email verified successfully'}), 200
 
-            return jsonify({'message': 'Email verified successfully'}), 200
+            # Nothing updated, tell an expired token apart from an unknown one
+            if User.query.filter_by(verification_token=token, is_verified=False).first():
+                return jsonify({'message': 'Verification token expired'}), 400
+            return jsonify({'message': 'Invalid verification token'}), 404
         except Exception as e:
-            logging.error(f"Error in verifying email: {e}")
+            logging.error("Error in verifying email: %s", e)
             return jsonify({'message': 'Error verifying email'}), 500
 
     # Method to Update existing user info after authentication
@@ -313,17 +658,13 @@ def create_app(testing=None):
     @require_verified_user
     def update_user_info():
         try:
-            validation_response = validate_request(request)
-            if validation_response:
-                return validation_response
-            user_email = auth.current_user()
-            user = User.query.filter_by(email=user_email).first()
+            user = current_user()
             if user:
                 data = request.get_json()
                 allowed_fields = {'first_name', 'last_name', 'password'}
                 for field in data.keys():
                     if field not in allowed_fields:
-                        logging.error(f"Invalid field in request: {field}")
+                        logging.error("Invalid field in request: %s", field)
                         return jsonify({'message': f'Invalid field in request: {field}'}), 400
                 # Update user info based on the fields provided. User can choose to update any field. Not mandatory to update all fields
                 if 'first_name' in data:
@@ -333,48 +674,53 @@ def create_app(testing=None):
                 if 'password' in data:
                     is_valid, message = validate_password(data['password'])
                     if not is_valid:
-                        logging.error(f"Password validation failed: {message}")
+                        logging.error("Password validation failed: %s", message)
                         return jsonify({'message': message}), 400
-                    existing_pwd = bcrypt.hashpw(data['password'].encode('utf-8'), bcrypt.gensalt())
-                    user.password = existing_pwd.decode('utf-8')
-                user.account_updated = get_est_time()
+                    user.password = password_hasher.hash(data['password'])
+                user.account_updated = utc_now()
                 db.session.commit()
+                mark_write(user.email)
+                user_cache.invalidate(user.email)
+                response_cache.invalidate(user.id)
+                if 'password' in data:
+                    # Old credentials must stop working straight away
+                    auth_cache.invalidate(user.email)
                 logging.info("User info updated successfully!")
                 return jsonify({'message': 'User info updated successfully!'}), 204
             else:
                 logging.error("User not found!")
                 return jsonify({'message': 'User not found!'}), 404
+        except PasswordHasherSaturated:
+            raise
         except Exception as e:
-            logging.error(f"Error in updating user info: {e}")
+            logging.error("Error in updating user info: %s", e)
             return jsonify({'message': f"Missing fields. {str(e)}"}), 400
 
     # Method to get existing user's info after authentication
+    # Every change to the user sets account_updated, so it versions the response
     @app.route('/v1/user/self', methods=['GET'])
+    @request_rules(extra_headers=['If-None-Match'])
+    @read_only
     @auth.login_required
     @require_verified_user
     def get_user_info():
         try:
-            # This method should not accept any data in the request
-            error_response = reject_body_for_get()
-            if error_response:
-                return error_response
-            validation_response = validate_request(request)
-            if validation_response:
-                return validation_response
-            user_email = auth.current_user()
-            user = User.query.filter_by(email=user_email).first()
-            user_info = {
-                'id': user.id,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'email': user.email,
-                'account_created': user.account_created,
-                'account_updated': user.account_updated
-            }
+            user = current_user()
+            etag = make_etag('user', user.id, user.account_updated.isoformat())
+
+            def build():
+                return {
+                    'id': user.id,
+                    'first_name': user.first_name,
+                    'last_name': user.last_name,
+                    'email': user.email,
+                    'account_created': to_est_isoformat(user.account_created),
+                    'account_updated': to_est_isoformat(user.account_updated)
+                }
             logging.info("User info fetched successfully!")
-            return jsonify(user_info), 200
+            return conditional_json_response(user, 'user', etag, build)
         except Exception as e:
-            logging.error(f"Error in getting user info: {e}")
+            logging.error("Error in getting user info: %s", e)
             return jsonify({'message': 'User not found!'}), 404
 
     @app.route('/v1/user/self/pic', methods=['POST'])
@@ -382,11 +728,14 @@ def create_app(testing=None):
     @require_verified_user
     def upload_profile_picture():
         try:
-            validation_response = validate_request(request)
-            if validation_response:
-                return validation_response
-            user_email = auth.current_user()
-            user = User.query.filter_by(email=user_email).first()
+            user = current_user()
+
+            # Streaming mode pipes the request body straight to S3 instead of buffering it
+            if image_upload_mode() == 'stream':
+                return stream_profile_picture(user)
+            # Presigned mode hands the client a form to upload to S3 directly
+            if image_upload_mode() == 'presigned':
+                return presign_profile_picture(user)
 
             if 'file' not in request.files:
                 logging.error("No file part")
@@ -400,7 +749,7 @@ def create_app(testing=None):
 
             if file and allowed_file(file.filename):
                 # Check if user already has an image
-                existing_image = Image.query.filter_by(user_id=user.id).first()
+                existing_image = get_user_image_record(user)
                 if existing_image:
                     logging.error("An image already exists for this user")
                     return jsonify({'message': 'An image already exists for this user'}), 400
@@ -412,61 +761,89 @@ def create_app(testing=None):
                     logging.error("Failed to upload to S3")
                     return jsonify({'message': 'Failed to upload to S3'}), 500
                 # Create a new image record in the database
-                new_image = Image(
-                    file_name=file_name,
-                    user_id=user.id,
-                    url=f"{os.getenv('AWS_S3_BUCKET')}/{user.id}/{file_name}",
-                )
-                db.session.add(new_image)
-                db.session.commit()
-                user_info = {
-                    'id': new_image.id,
-                    'file_name': file_name,
-                    'url': new_image.url,
-                    'upload_date': new_image.upload_date,
-                    'user_id': new_image.user_id
-                }
+                user_info = save_image_record(user, file_name)
+                if user_info is None:
+                    return duplicate_image_response(user, file_name)
                 logging.info("Profile picture uploaded successfully!")
                 return user_info, 201
             else:
                 logging.error("Invalid file type")
                 return jsonify({'message': 'Invalid file type'}), 400
         except Exception as e:
-            logging.error(f"Error in uploading profile picture: {e}")
+            logging.error("Error in uploading profile picture: %s", e)
             return jsonify({'message': 'Error uploading profile picture'}), 500
 
+    # Step 2 of a presigned upload: record the image once the client has uploaded it to S3
+    @app.route('/v1/user/self/pic/complete', methods=['POST'])
+    @auth.login_required
+    @require_verified_user
+    def complete_profile_picture_upload():
+        try:
+            if image_upload_mode() != 'presigned':
+                return jsonify({'message': 'Not Found'}), 404
+            user = current_user()
+            data = request.get_json(silent=True)
+            file_name = data.get('file_name', '') if isinstance(data, dict) else ''
+            # Only keys handed out for this user can be claimed
+            if not file_name.startswith(f"{user.id}_") or file_name != secure_filename(file_name):
+                logging.error("Invalid file name in upload completion")
+                return jsonify({'message': 'Invalid file name'}), 400
+            if get_user_image_record(user):
+                logging.error("An image already exists for this user")
+                return jsonify({'message': 'An image already exists for this user'}), 400
+            size = get_object_size(os.getenv('AWS_S3_BUCKET'), file_name)
+            if size is None:
+                logging.error("Uploaded file not found in S3")
+                return jsonify({'message': 'Uploaded file not found'}), 400
+            user_info = save_image_record(user, file_name)
+            if user_info is None:
+                return duplicate_image_response(user, file_name)
+            logging.info("Profile picture upload completed successfully!")
+            return jsonify(user_info), 201
+        except Exception as e:
+            logging.error("Error in completing profile picture upload: %s", e)
+            return jsonify({'message': 'Error uploading profile picture'}), 500
+
+    # An image is never modified, only deleted and re-uploaded under a new id, so the id
+    # (and the presigned URL, which changes when it is refreshed) versions the response
     @app.route('/v1/user/self/pic', methods=['GET'])
+    @request_rules(extra_headers=['If-None-Match'])
+    @read_only
     @auth.login_required
     @require_verified_user
     def get_user_image():
         try:
-            # This method should not accept any data in the request
-            error_response = reject_body_for_get()
-            if error_response:
-                return error_response
-            validation_response = validate_request(request)
-            if validation_response:
-                return validation_response
             # Check if user has an existing image
-            user_email = auth.current_user()
-            user = User.query.filter_by(email=user_email).first()
-            existing_image = Image.query.filter_by(user_id=user.id).first()
+            user = current_user()
+            existing_image = get_user_image_record(user)
             if not existing_image:
                 logging.error("No image found for this user")
                 return jsonify({'message': 'No image found for this user'}), 404
 
+            download_url = None
+            if image_upload_mode() == 'presigned':
+                # Short-lived URL the client can fetch the image from directly
+                download_url = get_presigned_download_url(
+                    os.getenv('AWS_S3_BUCKET'), existing_image.file_name, user.id, get_presigned_expiry()
+                )
+            etag = make_etag('image', existing_image.id, download_url)
+
             # Return the image details
-            user_info = {
-                'id': existing_image.id,
-                'file_name': existing_image.file_name,
-                'url': existing_image.url,
-                'upload_date': existing_image.upload_date,
-                'user_id': existing_image.user_id
-            }
+            def build():
+                user_info = {
+                    'id': existing_image.id,
+                    'file_name': existing_image.file_name,
+                    'url': existing_image.url,
+                    'upload_date': to_est_date(existing_image.upload_date),
+                    'user_id': existing_image.user_id
+                }
+                if download_url is not None:
+                    user_info['download_url'] = download_url
+                return user_info
             logging.info("Profile picture details fetched successfully!")
-            return jsonify(user_info), 200
+            return conditional_json_response(user, 'image', etag, build)
         except Exception as e:
-            logging.error(f"Error in fetching profile picture details: {e}")
+            logging.error("Error in fetching profile picture details: %s", e)
             return jsonify({'message': 'Error fetching profile picture details'}), 500
 
     @app.route('/v1/user/self/pic', methods=['DELETE'])
@@ -474,19 +851,11 @@ def create_app(testing=None):
     @require_verified_user
     def delete_user_image():
         try:
-            # This method should not accept any data in the request
-            error_response = reject_body_for_get()
-            if error_response:
-                return error_response
-            validation_response = validate_request(request)
-            if validation_response:
-                return validation_response
             # Check if user has an existing image
-            user_email = auth.current_user()
-            user = User.query.filter_by(email=user_email).first()
-            logging.info(f"Endpoint: {request.endpoint}")
-            logging.info(f"User: {user}")
-            existing_image = Image.query.filter_by(user_id=user.id).first()
+            user = current_user()
+            logging.debug("Endpoint: %s", request.endpoint)
+            logging.debug("User: %s", user)
+            existing_image = get_user_image_record(user)
             if not existing_image:
                 logging.error("No image found for this user")
                 return jsonify({'message': 'No image found for this user'}), 404
@@ -498,10 +867,14 @@ def create_app(testing=None):
             # Delete the existing image record from the database
             db.session.delete(existing_image)
             db.session.commit()
+            mark_write(user.email)
+            presigned_url_cache.invalidate(user.id)
+            user_cache.invalidate(user.email)
+            response_cache.invalidate(user.id)
             logging.info("Profile picture deleted successfully!")
             return '', 204
         except Exception as e:
-            logging.error(f"Error in deleting profile picture: {e}")
+            logging.error("Error in deleting profile picture: %s", e)
             return jsonify({'message': 'Error deleting profile picture'}), 500
 
     # Decorator to handle error for authentication failures
@@ -515,9 +888,7 @@ def create_app(testing=None):
             logging.error("No authentication provided")
             return jsonify({'message': 'Unauthorized'}), 401
 
-        email = request.authorization.username
-        user = User.query.filter_by(email=email).first()
-        if user is None:
+        if not g.get('auth_user_exists', True):
             return jsonify({'message': 'User not found!'}), 404
         return jsonify({'message': 'Unauthorized'}), 401
 
@@ -530,36 +901,95 @@ def create_app(testing=None):
             'If you entered the URL manually please check your spelling and try again.'
         )}), 404
 
+    # Decorator to shed load when the password hashing pool is full.
+    # Failing fast keeps workers free for health checks and cheap requests
+    @app.errorhandler(PasswordHasherSaturated)
+    def password_hasher_saturated(e):
+        response = make_response(jsonify({'message': 'Service Unavailable'}), 503)
+        response.headers['Retry-After'] = '1'
+        return response
+
     # Decorator to handle error for all requests where the method for that request path is invalid
     @app.errorhandler(405)
     def method_not_allowed(e):
         return jsonify({'message': 'Method Not Allowed'}), 405
 
-    # Decorator to apply 'no-cache' to all routes
+    # Decorator to apply 'no-cache' to all routes. Clients may still store responses, but
+    # have to revalidate them; the user and image metadata carry an ETag for that
     @app.after_request
     def after_request(response):
         response.headers['Cache-Control'] = 'no-cache'
         return response
 
+    # Decorator to start the request's root span, continuing the ALB's trace if there is one.
+    # Registered first so the span covers the other hooks
+    @app.before_request
+    def start_request_trace():
+        tracer.start_request(request.endpoint or 'unknown', header=request.headers.get(TRACE_HEADER), attributes={
+            'http.method': request.method,
+            'http.route': request.url_rule.rule if request.url_rule else None})
+
     # Decorator to calculate the time taken for each request
     @app.before_request
     def start_timer():
         request.start_time = time.time()
+        profiler.request_started(request.endpoint, request.headers)
 
-    # Decorator to log the time taken for each request
+    # Decorator to make sure an identity never leaks from a previous request
+    @app.before_request
+    def reset_current_user():
+        g.pop('user', None)
+        g.pop('auth_user_exists', None)
+        g.pop('db_primary_pinned', None)
+        g.pop('phase_times', None)
+
+    # Decorator to count requests and record the time taken, per endpoint, method and status.
+    # The duration and its split into phases also go to the latency histograms behind /metrics
     @app.after_request
     def log_request_time(response):
+        tags = {'endpoint': request.endpoint or 'unknown', 'method': request.method, 'status': response.status_code}
+        metrics.incr('api.requests', tags=tags)
         if hasattr(request, 'start_time'):
             duration = time.time() - request.start_time
-            endpoint = request.endpoint or 'unknown'
-            statsd_client.timing(f'api.{endpoint}.duration', duration * 1000)  # in ms
+            metrics.timing('api.duration', duration * 1000, tags=tags)  # in ms
+            record_request(tags['endpoint'], tags['method'], duration)
+        return profiler.request_finished(response)
+
+    # Decorator to stop sampling this thread, and profiling it if the request failed
+    @app.teardown_request
+    def end_request_profiling(exc):
+        profiler.request_torn_down()
+
+    # Decorator to return the trace id, so a client can quote it when reporting a problem
+    @app.after_request
+    def add_trace_header(response):
+        span = tracer.request_span()
+        if span is not None:
+            span.set_attribute('http.status_code', response.status_code)
+            response.headers[TRACE_HEADER] = format_trace_header(span)
         return response
 
-    # Decorator to increment the request count for each endpoint
-    @app.before_request
-    def increment_request_count():
-        endpoint = request.endpoint or 'unknown'
-        statsd_client.incr(f'api.{endpoint}.requests')
+    # Decorator to end the request's span once the response is done, streamed ones included
+    @app.teardown_request
+    def end_request_trace(exc):
+        tracer.end_request(exc)
+
+    # Request metadata for benchmarks/replay.py, when REQUEST_CAPTURE_FILE is set.
+    # Query parameter values are dropped, so verification tokens are not written out
+    request_capture = create_request_capture()
+    if request_capture is not None:
+        @app.after_request
+        def capture_request(response):
+            if hasattr(request, 'start_time'):
+                email = request.authorization.username if current_user() is not None else None
+                query = '&'.join(f"{name}=" for name in request.args)
+                request_capture.record(request.start_time, request.method, request.path, query,
+                                       response.status_code, time.time() - request.start_time, email)
+            return response
+
+    # Header, query parameter and GET body validation, before any view runs.
+    # Registered after the hooks above so the request timer and identity reset still run first
+    RequestValidator(ALLOWED_HEADERS | ALB_ADDED_HEADERS | profiler.request_headers).init_app(app)
 
     # end of routes, functions and decorators
     return app
@@ -568,4 +998,8 @@ def create_app(testing=None):
 if __name__ == '__main__':
     app = create_app()
     init_db(app, db)
+    app.extensions['sns_outbox'].start()
+    app.extensions['health'].start()
+    app.extensions['user_cache'].start()
+    app.extensions['profiler'].start()
     app.run(host='0.0.0.0', port=os.getenv('PORT'), debug=bool(os.getenv('DEBUG_MODE')))
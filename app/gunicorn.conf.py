@@ -0,0 +1,64 @@
+# Gunicorn configuration for the webapp. All settings can be tuned per environment
+# through environment variables, e.g. in the systemd unit or the .env file.
+#   gunicorn --config gunicorn.conf.py wsgi:app
+# Send SIGHUP to the master (systemctl reload webapp-systemd) for a graceful reload:
+# new workers are started with the new code and old ones finish in-flight requests.
+import multiprocessing
+import subprocess
+import sys
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env before reading any settings
+load_dotenv()
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# Pre-fork worker model. gthread workers serve several requests per process, which
+# suits us since bcrypt, S3 and SNS calls release the GIL while they wait
+workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+# Keep idle connections open longer than the ALB idle timeout (60s by default),
+# otherwise the ALB may reuse a connection we are just closing and return a 502
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '65'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+
+# Recycle workers every so often to bound memory growth
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '0'))
+
+# Logging is configured by the app itself
+accesslog = None
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+# Runs once in the master before any worker is forked.
+# Creating the database and tables here avoids every worker racing to do it. It runs in
+# a separate process: the master must not import the app, or workers forked after a
+# reload (SIGHUP) would reuse its modules instead of loading the new code, and inherit
+# the app's module-level clients and threads
+def on_starting(server):
+    result = subprocess.run([sys.executable, '-m', 'utils.db_init'], cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode != 0:
+        server.log.error("Database initialization exited with status %s", result.returncode)
+
+
+# Background threads do not survive fork, so each worker starts its own
+def post_worker_init(worker):
+    worker.wsgi.extensions['sns_outbox'].start()
+    worker.wsgi.extensions['health'].start()
+    worker.wsgi.extensions['user_cache'].start()
+    worker.wsgi.extensions['profiler'].start()
+
+
+def worker_exit(server, worker):
+    wsgi = getattr(worker, 'wsgi', None)
+    if wsgi is not None:
+        wsgi.extensions['sns_outbox'].stop()
+        wsgi.extensions['health'].stop()
+        wsgi.extensions['user_cache'].stop()
+        wsgi.extensions['profiler'].stop()
@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import hmac
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+
+# In-process cache of recently verified (email, password) pairs.
+# bcrypt.checkpw is deliberately slow, so repeat callers with the same credentials
+# skip it for AUTH_CACHE_TTL seconds. Only successful checks are cached and the
+# plaintext password is never stored: entries are keyed on an HMAC of the credentials
+# using a per-process secret, so a memory dump does not reveal usable hashes either.
+# The stored bcrypt hash is part of the key, so once a password changes the old one
+# misses the cache in every worker and instance, without any invalidation message.
+class AuthCache:
+    def __init__(self, ttl=60, max_size=10000, secret=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._secret = secret or os.urandom(32)
+        self._entries = OrderedDict()
+        self._keys_by_email = {}
+        self._lock = threading.Lock()
+
+    def _key(self, email, password, password_hash):
+        message = b'\x00'.join(value.encode('utf-8') for value in (email, password_hash, password))
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def get(self, email, password, password_hash):
+        if self.max_size <= 0:
+            return False
+        key = self._key(email, password, password_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            if entry[1] < time.monotonic():
+                self._remove(key)
+                return False
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return True
+
+    def add(self, email, password, password_hash):
+        if self.max_size <= 0:
+            return
+        key = self._key(email, password, password_hash)
+        with self._lock:
+            self._entries[key] = (email, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            self._keys_by_email.setdefault(email, set()).add(key)
+            # Evict least recently used entries once we go over capacity
+            while len(self._entries) > self.max_size:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+
+    # Drop every cached credential for a user in this process, e.g. after a password
+    # change. Not required for correctness, the changed hash already misses the cache
+    def invalidate(self, email):
+        with self._lock:
+            for key in self._keys_by_email.pop(email, set()):
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_email.clear()
+
+    def _remove(self, key):
+        email, _ = self._entries.pop(key)
+        keys = self._keys_by_email.get(email)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_email[email]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def create_auth_cache():
+    enabled = os.getenv('AUTH_CACHE_ENABLED', 'true').lower() == 'true'
+    max_size = int(os.getenv('AUTH_CACHE_MAX_SIZE', '10000')) if enabled else 0
+    ttl = float(os.getenv('AUTH_CACHE_TTL', '60'))
+    logger.info("Auth cache configured with ttl=%ss, max_size=%s", ttl, max_size)
+    return AuthCache(ttl=ttl, max_size=max_size)
@@ -0,0 +1,208 @@
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from email_validator import EmailNotValidError
+from utils.models import db, User, OutboxMessage, utc_now
+from utils.sns_outbox import build_verification_message
+from utils.passwords import PasswordHasherSaturated
+from utils.metrics import metrics
+import csv
+import json
+import uuid
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+BULK_IMPORT_FIELDS = ('first_name', 'last_name', 'email', 'password')
+
+
+# Rows of an import file as (line number, dict) pairs, read lazily from a text stream.
+# NDJSON has one JSON object per line, CSV a header row with the field names.
+# A line that cannot be parsed comes back as (line number, None)
+def read_rows(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+# Format of an import from its content type or file name, 'ndjson' unless it looks like CSV
+def detect_format(name):
+    return 'csv' if name and ('csv' in name.lower()) else 'ndjson'
+
+
+# Creates users in bulk, chunk_size rows at a time:
+#   - rows are validated like POST /v1/user, then the passwords of the valid ones are
+#     hashed in parallel on the password hashing pool
+#   - existing emails are looked up with one query per chunk
+#   - users and their verification messages are inserted with one executemany each and
+#     committed together, so the outbox dispatcher sends the emails in PublishBatch calls
+# import_rows() yields one result per row as soon as its chunk is committed, so callers
+# can stream them back instead of holding the whole import in memory.
+class BulkUserImporter:
+    def __init__(self, password_hasher, email_validator, validate_password, verification_link,
+                 chunk_size=500, after_commit=None):
+        self.password_hasher = password_hasher
+        self.email_validator = email_validator
+        self.validate_password = validate_password
+        self.verification_link = verification_link
+        self.chunk_size = chunk_size
+        self.after_commit = after_commit
+
+    def import_rows(self, rows):
+        seen = set()
+        chunk = []
+        for line_number, row in rows:
+            chunk.append((line_number, row))
+            if len(chunk) >= self.chunk_size:
+                yield from self._import_chunk(chunk, seen)
+                chunk = []
+        if chunk:
+            yield from self._import_chunk(chunk, seen)
+
+    def _import_chunk(self, chunk, seen):
+        results = {}
+        valid = []
+        for line_number, row in chunk:
+            error = self._validate(row, seen)
+            if error:
+                results[line_number] = self._result(line_number, row, 400, message=error)
+            else:
+                seen.add(row['email'])
+                valid.append((line_number, row))
+
+        existing = set()
+        if valid:
+            emails = [row['email'] for _, row in valid]
+            existing = set(db.session.scalars(select(User.email).where(User.email.in_(emails))))
+        pending = []
+        for line_number, row in valid:
+            if row['email'] in existing:
+                results[line_number] = self._result(line_number, row, 400, message='User already exists!')
+            else:
+                pending.append((line_number, row))
+
+        if pending:
+            try:
+                hashes = self.password_hasher.hash_many([row['password'] for _, row in pending])
+                users = [self._new_user(row, hashed) for (_, row), hashed in zip(pending, hashes)]
+                for (line_number, row), user in zip(pending, self._insert(users)):
+                    if user is None:
+                        results[line_number] = self._result(line_number, row, 400, message='User already exists!')
+                    else:
+                        results[line_number] = self._result(line_number, row, 201, id=str(user['id']))
+            except PasswordHasherSaturated:
+                for line_number, row in pending:
+                    results[line_number] = self._result(line_number, row, 503, message='Service Unavailable')
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Error in bulk importing users: %s", e)
+                for line_number, row in pending:
+                    results[line_number] = self._result(line_number, row, 500, message='Error in creating user')
+
+        created = sum(1 for result in results.values() if result['status'] == 201)
+        metrics.incr('bulk_import.rows', len(chunk) - created, tags={'status': 'failed'})
+        metrics.incr('bulk_import.rows', created, tags={'status': 'created'})
+        for line_number, _ in chunk:
+            yield results[line_number]
+
+    def _validate(self, row, seen):
+        if row is None:
+            return 'Invalid row'
+        missing = [field for field in BULK_IMPORT_FIELDS if not row.get(field)]
+        if missing:
+            return f"Missing fields: {', '.join(missing)}"
+        for field in row:
+            if field not in BULK_IMPORT_FIELDS:
+                return f"Invalid field in request: {field}"
+        if not all(isinstance(row[field], str) for field in BULK_IMPORT_FIELDS):
+            return 'Fields must be strings'
+        if row['email'] in seen:
+            return 'Duplicate email in import'
+        try:
+            self.email_validator.validate(row['email'])
+        except EmailNotValidError as e:
+            return str(e)
+        is_valid, message = self.validate_password(row['password'])
+        if not is_valid:
+            return message
+        return None
+
+    def _new_user(self, row, hashed):
+        now = utc_now()
+        return {
+            'id': uuid.uuid4(),
+            'first_name': row['first_name'],
+            'last_name': row['last_name'],
+            'email': row['email'],
+            'password': hashed,
+            'account_created': now,
+            'account_updated': now,
+            'is_verified': False,
+            'verification_token': str(uuid.uuid4()),
+            'verification_token_created': now,
+            'verification_email_count': 0,
+        }
+
+    def _outbox_row(self, user):
+        link = self.verification_link(user['email'], user['verification_token'])
+        return {
+            'user_id': user['id'],
+            'topic_arn': os.getenv('AWS_SNS_TOPIC_ARN', ''),
+            'payload': json.dumps(build_verification_message(User(**user), link)),
+            'attempts': 0,
+            'created_at': user['account_created'],
+            'next_attempt_at': user['account_created'],
+        }
+
+    # Insert the users and their outbox rows in one transaction. If another request
+    # created one of the emails since the lookup, the chunk is retried row by row so
+    # only that row fails. Returns the inserted users, None for the ones that failed
+    def _insert(self, users):
+        try:
+            db.session.execute(insert(User), users)
+            db.session.execute(insert(OutboxMessage), [self._outbox_row(user) for user in users])
+            db.session.commit()
+            self._committed()
+            return users
+        except IntegrityError:
+            db.session.rollback()
+        inserted = []
+        for user in users:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(User), [user])
+                    db.session.execute(insert(OutboxMessage), [self._outbox_row(user)])
+                inserted.append(user)
+            except IntegrityError:
+                inserted.append(None)
+        db.session.commit()
+        self._committed()
+        return inserted
+
+    def _committed(self):
+        # e.g. wake up the outbox dispatcher
+        if self.after_commit is not None:
+            self.after_commit()
+
+    @staticmethod
+    def _result(line_number, row, status, **fields):
+        email = row.get('email') if isinstance(row, dict) else None
+        return {'line': line_number, 'email': email, 'status': status, **fields}
+
+
+def create_bulk_importer(password_hasher, email_validator, validate_password, verification_link,
+                         after_commit=None):
+    chunk_size = int(os.getenv('BULK_IMPORT_CHUNK_SIZE', '500'))
+    return BulkUserImporter(password_hasher, email_validator, validate_password, verification_link,
+                            chunk_size=chunk_size, after_commit=after_commit)
@@ -1,5 +1,6 @@
 from sqlalchemy_utils import database_exists, create_database
 from sqlalchemy.exc import OperationalError
+from utils.migrations import run_migrations
 import logging
 
 # Get a logger for this module
@@ -13,12 +14,27 @@ def init_db(app, db):
             # Check if the database exists, if not create it
             if not database_exists(app.config['SQLALCHEMY_DATABASE_URI']):
                 create_database(app.config['SQLALCHEMY_DATABASE_URI'])
-                logger.info(f"Created database: {app.config['SQLALCHEMY_DATABASE_URI']}")
+                logger.info("Created database: %s", app.config['SQLALCHEMY_DATABASE_URI'])
 
-            # Create all tables
-            db.create_all()
+            # Create all tables. Only on the primary, a read replica gets them through replication
+            db.create_all(bind_key=None)
             logger.info("Database tables created successfully.")
+
+            # Bring existing databases up to date with the models
+            if run_migrations(db.engine):
+                logger.info("Database migrations applied successfully.")
         except OperationalError as e:
-            logger.error(f"Error connecting to the database: {e}")
+            logger.error("Error connecting to the database: %s", e)
         except Exception as e:
-            logger.error(f"Error initializing database: {e}")
+            logger.error("Error initializing database: %s", e)
+
+
+# Run on its own from the app directory, e.g. by the gunicorn master before it forks
+# workers, so the master never imports the app:  python -m utils.db_init
+if __name__ == '__main__':
+    from flask import Flask
+    from app import configure_app
+    from utils.models import db
+    init_app = Flask('init_db')
+    configure_app(init_app, None)
+    init_db(init_app, db)
@@ -0,0 +1,110 @@
+from utils.metrics import metrics
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy import event
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# SQLSTATE returned when writing through a connection to a read-only instance.
+# After an RDS failover, pooled connections can still point at the old primary
+# which has come back as a reader
+READ_ONLY_SQL_TRANSACTION = '25006'
+
+
+# QueuePool that times every checkout through its public connect(): the wait for a free
+# connection, plus opening a new one or the pre-ping when those happen. Reported as the
+# database.pool.wait timer, and checkouts that hit DB_POOL_TIMEOUT as database.pool.timeout.
+# register_pool_metrics sets the tags
+class TimedQueuePool(QueuePool):
+    metric_tags = None
+
+    def connect(self):
+        start_time = time.perf_counter()
+        try:
+            connection = super().connect()
+        except TimeoutError:
+            metrics.incr('database.pool.timeout', tags=self.metric_tags)
+            raise
+        metrics.timing('database.pool.wait', (time.perf_counter() - start_time) * 1000, tags=self.metric_tags)  # in ms
+        return connection
+
+    # engine.dispose() replaces the pool with a new one
+    def recreate(self):
+        pool = super().recreate()
+        pool.metric_tags = self.metric_tags
+        return pool
+
+
+def _env_bool(name, default):
+    return os.getenv(name, default).lower() == 'true'
+
+
+# Engine options for PostgreSQL, tunable through environment variables
+def get_engine_options():
+    statement_timeout_ms = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000'))
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        'pool_timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+        # Recycle connections before RDS or a NAT silently drops them
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        # Test connections on checkout so stale ones (e.g. after a failover) are replaced
+        'pool_pre_ping': _env_bool('DB_POOL_PRE_PING', 'true'),
+        'connect_args': {
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5')),
+            # TCP keepalives detect a dead peer instead of hanging on it
+            'keepalives': 1,
+            'keepalives_idle': int(os.getenv('DB_KEEPALIVES_IDLE', '30')),
+            'keepalives_interval': int(os.getenv('DB_KEEPALIVES_INTERVAL', '10')),
+            'keepalives_count': int(os.getenv('DB_KEEPALIVES_COUNT', '3')),
+        },
+    }
+    if statement_timeout_ms > 0:
+        options['connect_args']['options'] = f"-c statement_timeout={statement_timeout_ms}"
+    logger.info("Database pool configured with pool_size=%s, max_overflow=%s, pool_recycle=%s, pre_ping=%s",
+                options['pool_size'], options['max_overflow'], options['pool_recycle'], options['pool_pre_ping'])
+    return options
+
+
+# Treat "read-only transaction" errors as disconnects. SQLAlchemy then invalidates the
+# whole pool, so the next requests reconnect through DNS to the new primary
+def register_failover_handler(engine):
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        pgcode = getattr(context.original_exception, 'pgcode', None)
+        if pgcode == READ_ONLY_SQL_TRANSACTION:
+            logger.error("Write on a read-only database connection, invalidating pool (RDS failover?)")
+            context.is_disconnect = True
+
+
+# Pool occupancy gauges, taken from the pool's public counters on every checkout and
+# checkin. A pool with no idle connections and no overflow left makes requests wait
+# up to DB_POOL_TIMEOUT seconds for a connection, which database.pool.wait shows
+def register_pool_metrics(engine, bind='primary'):
+    # SQLite's in-memory pools have no counters
+    if not hasattr(engine.pool, 'checkedout'):
+        return
+    tags = {'bind': bind}
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.metric_tags = tags
+
+    # Read through the engine, since dispose() replaces the pool. The checkin event fires
+    # before the connection is back in the pool, so it is counted as returned
+    def report(returning=0):
+        pool = engine.pool
+        metrics.gauge('database.pool.checked_out', pool.checkedout() - returning, tags=tags)
+        metrics.gauge('database.pool.idle', pool.checkedin() + returning, tags=tags)
+        metrics.gauge('database.pool.overflow', max(pool.overflow(), 0), tags=tags)
+
+    @event.listens_for(engine, 'checkout')
+    def pool_checkout(dbapi_connection, connection_record, connection_proxy):
+        report()
+
+    @event.listens_for(engine, 'checkin')
+    def pool_checkin(dbapi_connection, connection_record):
+        report(returning=1)
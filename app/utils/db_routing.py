@@ -0,0 +1,147 @@
+from flask_sqlalchemy.session import Session
+from flask import g, has_app_context, current_app
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from contextlib import contextmanager
+from functools import wraps
+from sqlalchemy.sql import Insert, Update, Delete, Select
+import threading
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# Bind key of the read replica in SQLALCHEMY_BINDS
+REPLICA_BIND_KEY = 'replica'
+
+
+# Session that sends reads to the read replica while replica reads are switched on
+# for the current request (see replica_reads). Flushes, INSERT/UPDATE/DELETE and
+# SELECT ... FOR UPDATE always go to the primary, as does everything when no replica
+# is configured or the replica could not be reached recently.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and _replica_reads_enabled() and not _is_write(clause):
+            engine = self._db.engines.get(REPLICA_BIND_KEY)
+            if engine is not None and not replica_status.is_down():
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _is_write(clause):
+    if isinstance(clause, (Insert, Update, Delete)):
+        return True
+    return isinstance(clause, Select) and clause._for_update_arg is not None
+
+
+def _replica_reads_enabled():
+    return has_app_context() and g.get('db_read_replica', False)
+
+
+# Whether the replica is reachable. After a failed or dropped connection, reads go to
+# the primary for retry_after seconds, then the replica is tried again
+class ReplicaStatus:
+    def __init__(self, retry_after=30.0):
+        self.retry_after = retry_after
+        self._down_until = 0.0
+
+    def mark_down(self):
+        if not self.is_down():
+            logger.error("Read replica unreachable, reading from the primary for %ss", self.retry_after)
+        self._down_until = time.monotonic() + self.retry_after
+
+    def is_down(self):
+        return time.monotonic() < self._down_until
+
+    def reset(self):
+        self._down_until = 0.0
+
+
+replica_status = ReplicaStatus(retry_after=float(os.getenv('DB_REPLICA_RETRY_SECONDS', '30')))
+
+
+# Mark the replica down when connecting to it fails or a connection to it drops
+def register_replica_fallback(engine):
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        if context.connection is None or context.is_disconnect:
+            replica_status.mark_down()
+
+
+# Remembers who wrote recently, so their reads stay on the primary until the replica
+# has caught up (read-your-writes). The window should comfortably cover replica lag.
+# Kept per process, so it only holds while the client stays on the same instance.
+class StickyWrites:
+    def __init__(self, window=5.0, max_size=10000):
+        self.window = window
+        self.max_size = max_size
+        self._until = {}
+        self._lock = threading.Lock()
+
+    def mark(self, identity):
+        if identity is None or self.window <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._until[identity] = now + self.window
+            if len(self._until) > self.max_size:
+                # Expired entries are only dropped when the map gets big
+                self._until = {key: until for key, until in self._until.items() if until > now}
+
+    def is_sticky(self, identity):
+        if identity is None:
+            return False
+        with self._lock:
+            until = self._until.get(identity)
+        return until is not None and until > time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._until.clear()
+
+
+sticky_writes = StickyWrites(window=float(os.getenv('DB_REPLICA_STICKY_SECONDS', '5')))
+
+
+# Send reads inside the block to the replica. If `identity` wrote recently, the rest of
+# the request is pinned to the primary instead, so it reads its own writes
+@contextmanager
+def replica_reads(identity=None):
+    if sticky_writes.is_sticky(identity):
+        g.db_primary_pinned = True
+    previous = g.get('db_read_replica', False)
+    g.db_read_replica = not g.get('db_primary_pinned', False)
+    try:
+        yield
+    finally:
+        g.db_read_replica = previous
+
+
+# Run `read` with replica reads on (see replica_reads). If the replica cannot be
+# reached, the read is rolled back and run again on the primary, so a dead replica
+# costs one failed connection attempt instead of failing requests. Only for reads,
+# which are safe to repeat
+def read_with_fallback(read, identity=None):
+    with replica_reads(identity):
+        try:
+            return read()
+        except OperationalError:
+            if not (g.db_read_replica and replica_status.is_down()):
+                raise
+    current_app.extensions['sqlalchemy'].session.rollback()
+    return read()
+
+
+# Decorator for read-only endpoints: all their queries may go to the replica
+def read_only(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        return read_with_fallback(lambda: f(*args, **kwargs))
+    return decorated_function
+
+
+# Call after committing a write on behalf of `identity`
+def mark_write(identity):
+    sticky_writes.mark(identity)
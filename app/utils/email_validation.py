@@ -0,0 +1,141 @@
+from email_validator import validate_email, caching_resolver, EmailUndeliverableError
+from email_validator.deliverability import validate_email_deliverability
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from utils.metrics import metrics
+import threading
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+
+# Per-domain cache of deliverability results. Undeliverable domains are cached too
+# (for negative_ttl), so a burst of signups with a bad domain costs one DNS lookup
+class DomainCache:
+    def __init__(self, ttl=3600, negative_ttl=300, max_size=10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns (found, error). error is None for a deliverable domain
+    def get(self, domain):
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is None:
+                return False, None
+            if entry[1] < time.monotonic():
+                del self._entries[domain]
+                return False, None
+            self._entries.move_to_end(domain)
+            return True, entry[0]
+
+    def set(self, domain, error=None):
+        ttl = self.negative_ttl if error else self.ttl
+        with self._lock:
+            self._entries[domain] = (error, time.monotonic() + ttl)
+            self._entries.move_to_end(domain)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Email validation for signups.
+# Syntax is always checked locally. Deliverability (MX lookup) depends on mode:
+#   - 'off': syntax only
+#   - 'sync': look the domain up on the request, bounded by timeout, through the domain cache
+#   - 'async': accept on a cache miss and look the domain up in the background, so the
+#     next signup for that domain is answered from the cache
+class SignupEmailValidator:
+    def __init__(self, mode='sync', timeout=2, cache=None, dns_resolver=None):
+        if mode not in ('off', 'sync', 'async'):
+            raise ValueError(f"Invalid email deliverability mode: {mode}")
+        self.mode = mode
+        self.timeout = timeout
+        self.cache = cache or DomainCache()
+        self._dns_resolver = dns_resolver
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+
+    # Validate an email address. Raises EmailNotValidError, like email_validator does
+    def validate(self, email):
+        validated = validate_email(email, check_deliverability=False)
+        if self.mode == 'off':
+            return validated
+        found, error = self.cache.get(validated.ascii_domain)
+        if found:
+            metrics.incr('email.domain_cache.hit')
+            if error:
+                raise EmailUndeliverableError(error)
+            return validated
+        metrics.incr('email.domain_cache.miss')
+        if self.mode == 'async':
+            self._check_in_background(validated.ascii_domain, validated.domain)
+        else:
+            self.check_domain(validated.ascii_domain, validated.domain)
+        return validated
+
+    def _get_resolver(self):
+        with self._lock:
+            if self._dns_resolver is None:
+                # Our own resolver so the timeout does not leak into dnspython's default one
+                self._dns_resolver = caching_resolver(timeout=self.timeout)
+            return self._dns_resolver
+
+    # Look up a domain and cache the result. Raises EmailUndeliverableError if it cannot receive email
+    def check_domain(self, ascii_domain, domain):
+        start_time = time.time()
+        try:
+            info = validate_email_deliverability(ascii_domain, domain, dns_resolver=self._get_resolver())
+        except EmailUndeliverableError as e:
+            self.cache.set(ascii_domain, str(e))
+            raise
+        finally:
+            metrics.timing('email.dns.duration', (time.time() - start_time) * 1000)  # in ms
+        if 'unknown-deliverability' in info:
+            # Timeouts and resolver errors are not cached, the next signup tries again
+            metrics.incr('email.dns.unknown')
+            logger.error("Could not check deliverability of %s: %s", ascii_domain, info['unknown-deliverability'])
+        else:
+            self.cache.set(ascii_domain)
+
+    def _check_in_background(self, ascii_domain, domain):
+        with self._lock:
+            if ascii_domain in self._pending:
+                return
+            self._pending.add(ascii_domain)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='email-dns')
+        self._executor.submit(self._background_check, ascii_domain, domain)
+
+    def _background_check(self, ascii_domain, domain):
+        try:
+            self.check_domain(ascii_domain, domain)
+        except EmailUndeliverableError as e:
+            logger.error("Accepted signup for undeliverable domain %s: %s", ascii_domain, e)
+        except Exception as e:
+            logger.error("Error checking deliverability of %s: %s", ascii_domain, e)
+        finally:
+            with self._lock:
+                self._pending.discard(ascii_domain)
+
+
+def create_email_validator():
+    cache = DomainCache(
+        ttl=float(os.getenv('EMAIL_DOMAIN_CACHE_TTL', '3600')),
+        negative_ttl=float(os.getenv('EMAIL_DOMAIN_NEGATIVE_TTL', '300')),
+        max_size=int(os.getenv('EMAIL_DOMAIN_CACHE_MAX_SIZE', '10000'))
+    )
+    return SignupEmailValidator(
+        mode=os.getenv('EMAIL_DELIVERABILITY_MODE', 'sync'),
+        timeout=float(os.getenv('EMAIL_DNS_TIMEOUT', '2')),
+        cache=cache
+    )
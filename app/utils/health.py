@@ -0,0 +1,156 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from botocore.config import Config
+from sqlalchemy import text
+from utils.metrics import metrics
+import threading
+import boto3
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+
+# The result of a check, cached for ttl seconds. result() only runs the check when the
+# cached result is too old, and only on one thread at a time: others keep getting the
+# previous result meanwhile. Changes between healthy and unhealthy are logged, passing
+# checks are not.
+class CachedCheck:
+    def __init__(self, name, check, ttl):
+        self.name = name
+        self.check = check
+        self.ttl = ttl
+        self.healthy = None
+        self.error = None
+        self.checked_at = None
+        self._refresh_lock = threading.Lock()
+
+    def run(self):
+        try:
+            self.check()
+            healthy, error = True, None
+        except Exception as e:
+            healthy, error = False, str(e)
+        if healthy != self.healthy:
+            if healthy:
+                logger.info("Health check %s passing", self.name)
+            else:
+                logger.error("Health check %s failing: %s", self.name, error)
+        self.healthy, self.error, self.checked_at = healthy, error, time.monotonic()
+        metrics.gauge('health.status', 1 if healthy else 0, tags={'check': self.name})
+        return healthy
+
+    def is_fresh(self):
+        return self.checked_at is not None and time.monotonic() - self.checked_at < self.ttl
+
+    def result(self):
+        if self.is_fresh():
+            return self.healthy
+        # Wait for a running check only if there is no earlier result to fall back on
+        if self._refresh_lock.acquire(blocking=self.checked_at is None):
+            try:
+                if not self.is_fresh():
+                    self.run()
+            finally:
+                self._refresh_lock.release()
+        return self.healthy
+
+
+# Tiered health checks:
+#   - liveness: the process answers, nothing else is checked
+#   - readiness: the primary database answers SELECT 1. A background thread refreshes the result
+#     every interval, so a probe only reads the cached value
+#   - deep: readiness plus the replica, S3 and SNS reachability, run in parallel within a timeout and
+#     cached for longer, so an outside caller cannot turn it into load on AWS
+class HealthMonitor:
+    def __init__(self, readiness_checks, deep_checks, interval=5.0, deep_ttl=30.0, deep_timeout=2.0):
+        self.interval = interval
+        self.deep_timeout = deep_timeout
+        # Twice the interval, so a probe never waits on the database while the thread runs
+        self.readiness = [CachedCheck(name, check, interval * 2) for name, check in readiness_checks.items()]
+        self.deep = [CachedCheck(name, check, deep_ttl) for name, check in deep_checks.items()]
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self.deep)), thread_name_prefix='health')
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='health-check', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            for check in self.readiness:
+                check.run()
+            self._stopping.wait(self.interval)
+
+    def is_ready(self):
+        return all(check.result() for check in self.readiness)
+
+    # Status of every check by name: 'ok', 'failing' or 'timeout'
+    def deep_status(self):
+        status = {check.name: 'ok' if check.result() else 'failing' for check in self.readiness}
+        futures = {self._executor.submit(check.result): check for check in self.deep}
+        done, _ = wait(futures, timeout=self.deep_timeout)
+        for future, check in futures.items():
+            if future not in done:
+                status[check.name] = 'timeout'
+            else:
+                status[check.name] = 'ok' if future.result() else 'failing'
+        return status
+
+
+def _database_check(engine):
+    def check():
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+    return check
+
+
+# AWS client for the deep checks, with short timeouts and no retries. Built once, when
+# the monitor is created: clients are thread-safe, creating them from the default
+# session on the concurrent check threads is not
+def _aws_client(service, timeout):
+    config = Config(connect_timeout=timeout, read_timeout=timeout, retries={'max_attempts': 1})
+    return boto3.session.Session().client(service, region_name=os.getenv('AWS_REGION'), config=config)
+
+
+def _s3_check(client, bucket):
+    def check():
+        client.head_bucket(Bucket=bucket)
+    return check
+
+
+def _sns_check(client, topic_arn):
+    def check():
+        client.get_topic_attributes(TopicArn=topic_arn)
+    return check
+
+
+# Build the monitor for an app. Readiness only depends on the primary database: when the
+# replica cannot be reached, db_routing runs reads on the primary instead (see
+# read_with_fallback), so the instance can still serve every request. The replica is a
+# deep check, along with S3 and SNS when they are configured
+def create_health_monitor(engines):
+    timeout = float(os.getenv('HEALTH_DEEP_TIMEOUT', '2'))
+    readiness_checks = {'database': _database_check(engines[None])}
+    deep_checks = {
+        f"database_{key}": _database_check(engine)
+        for key, engine in engines.items() if key is not None
+    }
+    if os.getenv('AWS_S3_BUCKET'):
+        deep_checks['s3'] = _s3_check(_aws_client('s3', timeout), os.getenv('AWS_S3_BUCKET'))
+    if os.getenv('AWS_SNS_TOPIC_ARN'):
+        deep_checks['sns'] = _sns_check(_aws_client('sns', timeout), os.getenv('AWS_SNS_TOPIC_ARN'))
+    return HealthMonitor(
+        readiness_checks,
+        deep_checks,
+        interval=float(os.getenv('HEALTH_CHECK_INTERVAL', '5')),
+        deep_ttl=float(os.getenv('HEALTH_DEEP_CACHE_SECONDS', '30')),
+        deep_timeout=timeout
+    )
@@ -0,0 +1,175 @@
+from flask import g, has_request_context
+from flask.json.provider import DefaultJSONProvider
+from contextlib import contextmanager
+import threading
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# Request time is split into phases: auth (bcrypt), db (SQL statements), s3, sns and
+# serialization (JSON encoding). A phase is only recorded for requests that spent time in it
+# Quantiles exported for every histogram
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+# HDR-style histogram of durations. Values are kept in microseconds in log-linear
+# buckets: 2**sub_bucket_bits buckets for every power of two, so any recorded value is
+# reported within 1 / 2**(sub_bucket_bits - 1) of its true value (about 3% by default)
+# whatever its magnitude, at a memory cost of a few hundred counters.
+class LatencyHistogram:
+    def __init__(self, sub_bucket_bits=6):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _index(self, micros):
+        shift = max(0, micros.bit_length() - self.sub_bucket_bits)
+        return shift, micros >> shift
+
+    # Record a duration in seconds
+    def record(self, seconds):
+        micros = max(0, int(seconds * 1000000))
+        key = self._index(micros)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    # Value in seconds below which the given fraction of recorded values fall
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for shift, value in sorted(self.counts, key=lambda key: key[1] << key[0]):
+            seen += self.counts[(shift, value)]
+            if seen >= rank:
+                # Upper edge of the bucket, so quantiles never understate the latency
+                return min(self.max, (((value + 1) << shift) - 1) / 1000000)
+        return self.max
+
+
+# Histograms keyed by metric name and labels. Quantiles cover the last one to two
+# windows (the current histogram merged with the previous one), so they follow the
+# tail latency of now, while the counts and sums are totals since start like the
+# Prometheus format expects.
+class LatencyRegistry:
+    def __init__(self, window=60.0):
+        self.window = window
+        self._lock = threading.Lock()
+        self._series = {}
+        self._rotated_at = time.monotonic()
+
+    def record(self, name, labels, seconds):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._maybe_rotate()
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'current': LatencyHistogram(), 'previous': LatencyHistogram(),
+                                              'count': 0, 'sum': 0.0}
+            series['current'].record(seconds)
+            series['count'] += 1
+            series['sum'] += seconds
+
+    def _maybe_rotate(self):
+        now = time.monotonic()
+        if now - self._rotated_at >= self.window:
+            for series in self._series.values():
+                series['previous'] = series['current'] if now - self._rotated_at < 2 * self.window else LatencyHistogram()
+                series['current'] = LatencyHistogram()
+            self._rotated_at = now
+
+    def snapshot(self):
+        with self._lock:
+            self._maybe_rotate()
+            result = []
+            for (name, labels), series in sorted(self._series.items()):
+                histogram = LatencyHistogram()
+                histogram.merge(series['previous'])
+                histogram.merge(series['current'])
+                result.append((name, dict(labels), histogram, series['count'], series['sum']))
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    # Prometheus text exposition format: one summary per metric name, plus a gauge with
+    # the largest value seen in the window
+    def render_prometheus(self):
+        lines = []
+        described = set()
+        maxima = []
+        for name, labels, histogram, count, total in self.snapshot():
+            if name not in described:
+                described.add(name)
+                lines.append(f"# TYPE {name} summary")
+            for q in QUANTILES:
+                lines.append(f"{name}{_labels(labels, quantile=q)} {histogram.quantile(q):.6f}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+            maxima.append((f"{name}_max", labels, histogram.max))
+        for name, labels, value in maxima:
+            if name not in described:
+                described.add(name)
+                lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name}{_labels(labels)} {value:.6f}")
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+
+latency = LatencyRegistry(window=float(os.getenv('LATENCY_WINDOW_SECONDS', '60')))
+
+
+# Add time spent in a phase to the current request. Outside a request (e.g. the SNS
+# outbox thread) it goes straight to the background histogram
+def add_phase_time(phase, seconds):
+    if has_request_context():
+        phase_times = g.setdefault('phase_times', {})
+        phase_times[phase] = phase_times.get(phase, 0.0) + seconds
+    else:
+        latency.record('webapp_background_duration_seconds', {'phase': phase}, seconds)
+
+
+@contextmanager
+def measure_phase(phase):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(phase, time.perf_counter() - start_time)
+
+
+# Called once a response is ready: records the request duration and the time each
+# phase took within it
+def record_request(endpoint, method, seconds):
+    latency.record('webapp_request_duration_seconds', {'endpoint': endpoint, 'method': method}, seconds)
+    for phase, phase_seconds in g.pop('phase_times', {}).items():
+        latency.record('webapp_request_phase_duration_seconds', {'endpoint': endpoint, 'phase': phase}, phase_seconds)
+
+
+# JSON provider that counts the time spent serializing responses as a phase
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with measure_phase('serialization'):
+            return super().dumps(obj, **kwargs)
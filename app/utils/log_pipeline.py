@@ -0,0 +1,213 @@
+from logging.handlers import QueueHandler
+from utils.tracing import tracer, TraceContextFilter
+import threading
+import logging
+import copy
+import atexit
+import queue
+import json
+import time
+import os
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Pass as `extra` for records that must never be sampled away, such as failed logins
+UNSAMPLED = {'sampled': True}
+
+
+# Lets through the first `burst` records of each message template per `window` seconds
+# and drops the rest. The next record let through carries the number dropped, so a
+# flood of identical errors costs one line instead of thousands. Records logged with
+# extra=UNSAMPLED are always let through.
+# Templates are only stable with lazy formatting: logging.error("... %s", e), not f-strings
+class SamplingFilter(logging.Filter):
+    def __init__(self, burst=10, window=60.0, level=logging.WARNING):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.level = level
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.burst <= 0 or record.levelno < self.level:
+            return True
+        # The same filter can sit on several handlers, decide once per record
+        decision = getattr(record, 'sampled', None)
+        if decision is None:
+            decision = record.sampled = self._sample(record)
+        return decision
+
+    def _sample(self, record):
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window_start, seen, suppressed = self._counts.get(key, (now, 0, 0))
+            if now - window_start >= self.window:
+                window_start, seen = now, 0
+            if seen < self.burst:
+                self._counts[key] = (window_start, seen + 1, 0)
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            self._counts[key] = (window_start, seen, suppressed + 1)
+            return False
+
+
+# One JSON object per line, which the CloudWatch agent ships as is
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'timestamp': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if getattr(record, 'trace_id', None):
+            entry['trace_id'] = record.trace_id
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+# QueueHandler that never blocks the caller. Like the stdlib one, it renders msg % args
+# and the traceback on the calling thread, so arguments such as ORM objects are read in
+# the state they had when logged, by the thread that owns their session. The listener
+# thread only does the JSON formatting and the writes. Sampling filters run before this,
+# on the unformatted template. When the queue is full the record is dropped and counted
+# instead of waiting for the disk.
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Background thread that takes records off the queue and writes them to the handlers
+# in batches: up to batch_size records, or whatever arrived within flush_interval,
+# followed by a single flush per handler
+class BatchingQueueListener:
+    _sentinel = None
+
+    def __init__(self, log_queue, handlers, batch_size=100, flush_interval=0.5):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(self._sentinel)
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                return
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is self._sentinel:
+                    self.write_batch(batch)
+                    return
+                batch.append(record)
+            self.write_batch(batch)
+
+    def write_batch(self, records):
+        for handler in self.handlers:
+            lines = []
+            for record in records:
+                if record.levelno < handler.level:
+                    continue
+                try:
+                    lines.append(handler.format(record) + handler.terminator)
+                except Exception:
+                    handler.handleError(record)
+            if not lines:
+                continue
+            handler.acquire()
+            try:
+                handler.stream.write(''.join(lines))
+                handler.flush()
+            except Exception:
+                handler.handleError(records[-1])
+            finally:
+                handler.release()
+
+
+def _create_handlers(formatter):
+    handlers = [
+        logging.FileHandler(os.getenv('LOG_FILE', '/var/log/webapp/csye6225-webapp.log')),  # Log file name
+        logging.StreamHandler()  # Also log to console
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+# Configure the root logger from environment variables:
+#   - LOG_MODE=sync (default): text lines written on the calling thread, as before
+#   - LOG_MODE=async: records go through a bounded queue to a background thread that
+#     writes JSON lines in batches, so requests never wait on disk flushes. Lines logged
+#     while a trace is current carry its trace_id. Repeated warnings and errors are
+#     sampled, except records logged with extra=UNSAMPLED
+def configure_logging():
+    if os.getenv('LOG_MODE', 'sync') != 'async':
+        logging.basicConfig(level=logging.INFO, handlers=_create_handlers(logging.Formatter(LOG_FORMAT)))
+        return None
+
+    queue_size = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+    queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    queue_handler.addFilter(SamplingFilter(
+        burst=int(os.getenv('LOG_SAMPLE_BURST', '10')),
+        window=float(os.getenv('LOG_SAMPLE_WINDOW', '60'))
+    ))
+    # Read on the logging thread, the writer thread has no trace context
+    queue_handler.addFilter(TraceContextFilter(tracer))
+    listener = BatchingQueueListener(
+        queue_handler.queue,
+        _create_handlers(JsonFormatter()),
+        batch_size=int(os.getenv('LOG_BATCH_SIZE', '100')),
+        flush_interval=float(os.getenv('LOG_FLUSH_INTERVAL', '0.5'))
+    )
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    listener.start()
+    # Write out what is still queued when the process exits
+    atexit.register(listener.stop)
+
+    # Threads do not survive fork: gunicorn workers need their own queue and writer thread
+    def restart_in_child():
+        queue_handler.queue = listener.queue = queue.Queue(queue_size)
+        listener.start()
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=restart_in_child)
+    return listener
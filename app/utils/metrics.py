@@ -0,0 +1,208 @@
+from contextlib import contextmanager
+import threading
+import random
+import socket
+import atexit
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# Keeps a datagram below the usual 1500 byte MTU once IP and UDP headers are added
+MAX_PACKET_SIZE = 1432
+
+
+def _format_tags(tags):
+    return ','.join(f"{key}:{value}" for key, value in sorted(tags.items()))
+
+
+# StatsD client shared by the whole process. Metric calls only update in-process
+# aggregates, they never touch the socket:
+#   - counters are summed and gauges keep their last value
+#   - timers keep up to max_timer_samples values per interval (a random sample beyond
+#     that, sent with the matching @rate so counts stay right)
+# A background thread flushes everything every flush_interval seconds, or sooner when
+# max_buffer values are waiting, packing many lines into each UDP datagram.
+# Tags are sent DogStatsD style (|#endpoint:x,method:GET), which the CloudWatch agent
+# turns into dimensions. With tag_format='name' they are appended to the metric name
+# instead, for plain StatsD servers like the local Graphite setup.
+class Metrics:
+    def __init__(self, host='localhost', port=8125, prefix=None, flush_interval=1.0, max_buffer=5000,
+                 max_timer_samples=1000, tag_format='dogstatsd', enabled=True):
+        if tag_format not in ('dogstatsd', 'name'):
+            raise ValueError(f"Invalid metrics tag format: {tag_format}")
+        self.address = (host, port)
+        self.prefix = prefix
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_timer_samples = max_timer_samples
+        self.tag_format = tag_format
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._reset()
+        self._socket = None
+        self._thread = None
+
+    def _reset(self):
+        self._counters = {}
+        self._gauges = {}
+        self._timers = {}
+        self._buffered = 0
+
+    def _key(self, name, tags):
+        return (name, tuple(sorted(tags.items())) if tags else ())
+
+    def incr(self, name, count=1, tags=None):
+        if not self.enabled:
+            return
+        key = self._key(name, tags)
+        with self._lock:
+            if key not in self._counters:
+                self._buffered += 1
+            self._counters[key] = self._counters.get(key, 0) + count
+            self._check_buffer()
+
+    def gauge(self, name, value, tags=None):
+        if not self.enabled:
+            return
+        key = self._key(name, tags)
+        with self._lock:
+            if key not in self._gauges:
+                self._buffered += 1
+            self._gauges[key] = value
+            self._check_buffer()
+
+    # Record a duration in milliseconds
+    def timing(self, name, value, tags=None):
+        if not self.enabled:
+            return
+        key = self._key(name, tags)
+        with self._lock:
+            samples = self._timers.get(key)
+            if samples is None:
+                samples = self._timers[key] = [[], 0]
+            samples[1] += 1
+            if len(samples[0]) < self.max_timer_samples:
+                samples[0].append(value)
+                self._buffered += 1
+                self._check_buffer()
+            else:
+                # Reservoir sampling keeps a uniform sample of the whole interval
+                index = random.randrange(samples[1])  # nosec B311 - not used for security
+                if index < self.max_timer_samples:
+                    samples[0][index] = value
+
+    @contextmanager
+    def timer(self, name, tags=None):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, (time.perf_counter() - start_time) * 1000, tags)
+
+    def _check_buffer(self):
+        if self._buffered >= self.max_buffer:
+            self._wakeup.set()
+
+    def start(self):
+        if self.enabled and (self._thread is None or not self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Error flushing metrics: %s", e)
+
+    def _line(self, name, value, metric_type, tags, rate=1):
+        if self.prefix:
+            name = f"{self.prefix}.{name}"
+        if tags and self.tag_format == 'name':
+            name = '.'.join([name] + [str(tag_value) for _, tag_value in tags])
+        line = f"{name}:{value}|{metric_type}"
+        if rate < 1:
+            line += f"|@{rate:.6f}"
+        if tags and self.tag_format == 'dogstatsd':
+            line += f"|#{_format_tags(dict(tags))}"
+        return line
+
+    # Take everything aggregated so far and render it as StatsD lines
+    def collect(self):
+        with self._lock:
+            counters, gauges, timers = self._counters, self._gauges, self._timers
+            self._reset()
+        lines = []
+        for (name, tags), value in counters.items():
+            lines.append(self._line(name, value, 'c', tags))
+        for (name, tags), value in gauges.items():
+            lines.append(self._line(name, value, 'g', tags))
+        for (name, tags), (samples, total) in timers.items():
+            rate = len(samples) / total
+            for value in samples:
+                lines.append(self._line(name, round(value, 3), 'ms', tags, rate))
+        return lines
+
+    # Send everything aggregated so far, packing lines into as few datagrams as possible
+    def flush(self):
+        lines = self.collect()
+        if not lines:
+            return 0
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        packets = 0
+        packet = ''
+        for line in lines:
+            if packet and len(packet) + len(line) + 1 > MAX_PACKET_SIZE:
+                packets += self._send(packet)
+                packet = ''
+            packet = f"{packet}\n{line}" if packet else line
+        packets += self._send(packet)
+        return packets
+
+    def _send(self, packet):
+        try:
+            self._socket.sendto(packet.encode('utf-8'), self.address)
+        except OSError as e:
+            # StatsD is best effort, a missing agent must not break anything
+            logger.debug("Could not send metrics: %s", e)
+        return 1
+
+    def _after_fork(self):
+        # The lock may have been held by another thread at fork time, and the flush
+        # thread did not survive it
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._reset()
+        self._socket = None
+        self._thread = None
+        self.start()
+
+
+def create_metrics():
+    metrics = Metrics(
+        host=os.getenv('STATSD_HOST', 'localhost'),
+        port=int(os.getenv('STATSD_PORT', '8125')),
+        prefix=os.getenv('STATSD_PREFIX') or None,
+        flush_interval=float(os.getenv('METRICS_FLUSH_INTERVAL', '1')),
+        max_buffer=int(os.getenv('METRICS_MAX_BUFFER', '5000')),
+        max_timer_samples=int(os.getenv('METRICS_MAX_TIMER_SAMPLES', '1000')),
+        tag_format=os.getenv('METRICS_TAG_FORMAT', 'dogstatsd'),
+        enabled=os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    )
+    metrics.start()
+    # Send what is still buffered when the process exits
+    atexit.register(metrics.flush)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=metrics._after_fork)
+    return metrics
+
+
+# The one metrics client every module uses
+metrics = create_metrics()
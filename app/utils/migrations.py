@@ -0,0 +1,138 @@
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the Postgres advisory lock that serializes migrations
+# when several instances start at the same time
+MIGRATION_LOCK_KEY = 6225
+
+# db.create_all only creates missing tables, so schema changes to existing tables are
+# applied here. Every migration must be idempotent: on a fresh database create_all has
+# already built the final schema and the migration only gets recorded.
+# On Postgres, indexes are built with CREATE INDEX CONCURRENTLY so the tables stay
+# writable while an existing RDS database is migrated.
+
+
+def _index_is_invalid(conn, name):
+    # A failed CREATE INDEX CONCURRENTLY leaves an invalid index behind that
+    # IF NOT EXISTS would silently accept, so it has to be dropped and rebuilt
+    return conn.execute(text(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name AND NOT i.indisvalid"
+    ), {'name': name}).first() is not None
+
+
+def _create_index_concurrently(conn, name, statement):
+    if _index_is_invalid(conn, name):
+        logger.info("Dropping invalid index %s", name)
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    conn.execute(text(statement))
+
+
+def _0001_images_user_id_unique(conn, dialect):
+    if dialect != 'postgresql':
+        # Other databases are only used for tests, where create_all builds the constraint
+        return
+    constraint_exists = conn.execute(text(
+        "SELECT 1 FROM pg_constraint WHERE conname = 'uq_images_user_id'"
+    )).first() is not None
+    if constraint_exists:
+        return
+    _create_index_concurrently(
+        conn, 'uq_images_user_id',
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS uq_images_user_id ON images (user_id)"
+    )
+    # Attaching an existing unique index as a constraint only takes a brief lock
+    conn.execute(text("ALTER TABLE images ADD CONSTRAINT uq_images_user_id UNIQUE USING INDEX uq_images_user_id"))
+
+
+def _0002_users_unverified_token_index(conn, dialect):
+    if dialect != 'postgresql':
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_unverified_verification_token "
+            "ON users (verification_token) WHERE NOT is_verified"
+        ))
+        return
+    _create_index_concurrently(
+        conn, 'ix_users_unverified_verification_token',
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_users_unverified_verification_token "
+        "ON users (verification_token) WHERE NOT is_verified"
+    )
+
+
+def _column_type(conn, table, column):
+    return conn.execute(text(
+        "SELECT data_type FROM information_schema.columns WHERE table_name = :table AND column_name = :column"
+    ), {'table': table, 'column': column}).scalar()
+
+
+# Timestamps used to be stored as ISO 8601 strings in EST (with the offset), and
+# upload_date as a bare EST date. Convert them in place to timestamptz.
+# Changing a column type rewrites the table under an exclusive lock; these tables are
+# small enough for that to take seconds, so it is done in one transaction per table.
+def _0003_native_timestamps(conn, dialect):
+    if dialect != 'postgresql':
+        return
+    user_columns = ['account_created', 'account_updated', 'verification_token_created']
+    pending = [column for column in user_columns if _column_type(conn, 'users', column) != 'timestamp with time zone']
+    if pending:
+        clauses = []
+        for column in pending:
+            clauses.append(f"ALTER COLUMN {column} TYPE timestamptz USING NULLIF({column}, '')::timestamptz")
+            clauses.append(f"ALTER COLUMN {column} SET DEFAULT now()")
+        conn.execute(text(f"ALTER TABLE users {', '.join(clauses)}"))
+    if _column_type(conn, 'images', 'upload_date') != 'timestamp with time zone':
+        conn.execute(text(
+            "ALTER TABLE images "
+            "ALTER COLUMN upload_date TYPE timestamptz "
+            "USING (NULLIF(upload_date, '')::date)::timestamp AT TIME ZONE 'US/Eastern', "
+            "ALTER COLUMN upload_date SET DEFAULT now()"
+        ))
+
+
+# Applied in order. Never reorder or rename entries, only append
+MIGRATIONS = [
+    ('0001_images_user_id_unique', _0001_images_user_id_unique),
+    ('0002_users_unverified_token_index', _0002_users_unverified_token_index),
+    ('0003_native_timestamps', _0003_native_timestamps),
+]
+
+
+def run_migrations(engine):
+    dialect = engine.dialect.name
+    # Autocommit, since CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version VARCHAR(255) PRIMARY KEY, "
+            "applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+        ))
+        if dialect == 'postgresql':
+            # No DB_STATEMENT_TIMEOUT_MS here: index builds and column rewrites on a large
+            # table take longer, and a cancelled migration would fail again on every start
+            conn.execute(text("SET statement_timeout = 0"))
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+        try:
+            applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+            for version, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info("Applying migration %s", version)
+                try:
+                    migration(conn, dialect)
+                except SQLAlchemyError as e:
+                    # Leave it unrecorded so the next start retries, and stop here since
+                    # later migrations may depend on this one
+                    logger.error("Migration %s failed: %s", version, e)
+                    return False
+                conn.execute(text("INSERT INTO schema_migrations (version) VALUES (:version)"), {'version': version})
+                logger.info("Migration %s applied", version)
+            return True
+        finally:
+            if dialect == 'postgresql':
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': MIGRATION_LOCK_KEY})
+                # Back to the pool's timeout before the connection is reused
+                conn.execute(text("RESET statement_timeout"))
@@ -1,38 +1,95 @@
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from utils.db_routing import RoutingSession
+from datetime import datetime, timezone, timedelta
 import uuid
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.sql.expression import FunctionElement
+from sqlalchemy.ext.compiler import compiles
 import pytz
 import logging
 
-db = SQLAlchemy()
+# The routing session sends reads to the read replica when one is configured
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 # Get a logger for this module
 logger = logging.getLogger(__name__)
 
 
 # Had to use 'pytz' to set timezone to EST.
-# The timestamps were stored in EST timezone in the db, but when pulled
-# from the db they were converted to GMT and displayed in Postman.
-def get_est_time():
-    est = pytz.timezone('US/Eastern')
-    return datetime.now(pytz.utc).astimezone(est).isoformat()
+# Timestamps are stored as timestamptz (UTC) and converted to EST only when
+# they are returned by the API. The zone is built once and reused.
+EST = pytz.timezone('US/Eastern')
+
+# How long a verification link stays valid
+VERIFICATION_TOKEN_TTL = timedelta(minutes=2)
+
+
+def utc_now():
+    return datetime.now(timezone.utc)
+
+
+# ISO 8601 string in EST, the format the API has always returned timestamps in
+def to_est_isoformat(value):
+    if value is None:
+        return None
+    # SQLite (unit tests) does not keep the zone, values are stored in UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(EST).isoformat()
+
+
+def to_est_date(value):
+    return to_est_isoformat(value)[:10] if value is not None else None
+
+
+# SQL expression for "now minus interval", evaluated with the database clock.
+# Lets expiry checks happen in the WHERE clause instead of in Python.
+# The interval and the app-clock cutoff are bound parameters, so they are part of every
+# execution instead of being baked into the compiled statement SQLAlchemy caches
+class db_now_minus(FunctionElement):
+    type = db.DateTime(timezone=True)
+    inherit_cache = True
+
+    def __init__(self, interval):
+        super().__init__(
+            db.bindparam('ttl', interval, type_=db.Interval(), unique=True),
+            db.bindparam('cutoff', utc_now() - interval, type_=db.DateTime(timezone=True), unique=True),
+        )
+
+
+@compiles(db_now_minus, 'postgresql')
+def _compile_db_now_minus_postgresql(element, compiler, **kw):
+    ttl, _ = element.clauses.clauses
+    return f"now() - {compiler.process(ttl, **kw)}"
+
+
+# Other databases (SQLite in the unit tests) get the cutoff from the app clock instead
+@compiles(db_now_minus)
+def _compile_db_now_minus(element, compiler, **kw):
+    _, cutoff = element.clauses.clauses
+    return compiler.process(cutoff, **kw)
 
 
 class User(db.Model):
     logger.info("Creating User model...")
     __tablename__ = 'users'
+    __table_args__ = (
+        # verify_email looks users up by token. Tokens are cleared on verification,
+        # so only unverified users need to be in the index
+        db.Index('ix_users_unverified_verification_token', 'verification_token', unique=True,
+                 postgresql_where=db.text('NOT is_verified'), sqlite_where=db.text('NOT is_verified')),
+    )
 
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     first_name = db.Column(db.String(50), nullable=False)
     last_name = db.Column(db.String(50), nullable=False)
     email = db.Column(db.String(100), unique=True, nullable=False)
     password = db.Column(db.String(255), nullable=False)
-    account_created = db.Column(db.String, default=get_est_time)
-    account_updated = db.Column(db.String, default=get_est_time, onupdate=get_est_time)
+    account_created = db.Column(db.DateTime(timezone=True), default=utc_now, server_default=db.func.now())
+    account_updated = db.Column(db.DateTime(timezone=True), default=utc_now, onupdate=utc_now, server_default=db.func.now())
     is_verified = db.Column(db.Boolean, default=False)
     verification_token = db.Column(db.String, default=uuid.uuid4)
-    verification_token_created = db.Column(db.String, default=get_est_time)
+    verification_token_created = db.Column(db.DateTime(timezone=True), default=utc_now, server_default=db.func.now())
     verification_email_count = db.Column(db.Integer, default=0)
 
     logger.info("User model created")
@@ -44,11 +101,15 @@ class User(db.Model):
 class Image(db.Model):
     logger.info("Creating Image model...")
     __tablename__ = 'images'
+    __table_args__ = (
+        # One profile picture per user. Also serves the lookups by user_id
+        db.UniqueConstraint('user_id', name='uq_images_user_id'),
+    )
 
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     file_name = db.Column(db.String(255), nullable=False)
     url = db.Column(db.String(255), nullable=False)
-    upload_date = db.Column(db.String, nullable=False, default=lambda: get_est_time()[:10])
+    upload_date = db.Column(db.DateTime(timezone=True), nullable=False, default=utc_now, server_default=db.func.now())
     user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), nullable=False)
 
     user = db.relationship('User', backref='images', lazy='joined')
@@ -57,3 +118,25 @@ class Image(db.Model):
 
     def __repr__(self):
         return f'<Image {self.file_name}>'
+
+
+# Transactional outbox for SNS messages. Rows are written in the same commit as the
+# change that produced them and published later by utils.sns_outbox.OutboxDispatcher
+class OutboxMessage(db.Model):
+    logger.info("Creating OutboxMessage model...")
+    __tablename__ = 'sns_outbox'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(UUID(as_uuid=True), db.ForeignKey('users.id'), nullable=True)
+    topic_arn = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utc_now)
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utc_now)
+    sent_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    logger.info("OutboxMessage model created")
+
+    def __repr__(self):
+        return f'<OutboxMessage {self.id}>'
@@ -0,0 +1,54 @@
+from werkzeug.sansio.multipart import MultipartDecoder, File, Data, Epilogue, NEED_DATA
+from werkzeug.http import parse_options_header
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+
+# Raised for a body that is not valid multipart/form-data, including one that ends
+# before its closing boundary. Mapped to a 400 by the app, as in buffered mode
+class MalformedMultipart(ValueError):
+    pass
+
+
+def _iter_events(decoder, stream, read_size):
+    while True:
+        try:
+            event = decoder.next_event()
+        except ValueError as e:
+            raise MalformedMultipart(str(e)) from e
+        if event is NEED_DATA:
+            data = stream.read(read_size)
+            # An empty read means the body is complete
+            decoder.receive_data(data or None)
+            continue
+        yield event
+        if isinstance(event, Epilogue):
+            return
+
+
+def _iter_file_data(events):
+    for event in events:
+        if isinstance(event, Data):
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                return
+
+
+# Incrementally parse a multipart/form-data body and return (filename, chunks) for the
+# first file part named `field_name`, where chunks lazily yields the file's bytes as they
+# are read from the stream. Nothing is buffered beyond a single read. Returns None when
+# the body is not multipart or has no such file part. Raises MalformedMultipart for an
+# invalid or truncated body, here or while chunks is being read.
+def open_streamed_file(stream, content_type, field_name='file', read_size=64 * 1024):
+    mimetype, options = parse_options_header(content_type or '')
+    if mimetype != 'multipart/form-data' or 'boundary' not in options:
+        return None
+    decoder = MultipartDecoder(options['boundary'].encode('latin-1'))
+    events = _iter_events(decoder, stream, read_size)
+    for event in events:
+        if isinstance(event, File) and event.name == field_name:
+            return event.filename, _iter_file_data(events)
+    return None
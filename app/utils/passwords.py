@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+from utils.metrics import metrics
+from utils.latency import add_phase_time
+import threading
+import bcrypt
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+
+# Raised when too many hash operations are already queued, or one did not finish within
+# the timeout. Mapped to a 503 by the app
+class PasswordHasherSaturated(Exception):
+    pass
+
+
+# Module level so they can be pickled and sent to a process pool
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+# Runs bcrypt off the request thread on a bounded pool.
+# mode:
+#   - 'thread': bcrypt releases the GIL while hashing, so a thread pool gives real parallelism
+#   - 'process': a process pool, for interpreters/builds where that is not the case
+#   - 'inline': hash on the calling thread (the old behaviour)
+# At most max_queue operations may be queued or running at once; beyond that callers get
+# PasswordHasherSaturated immediately instead of waiting behind a burst of signups.
+# A slot is only given back once its job is done, not when the caller stops waiting for
+# it after `timeout` seconds, so jobs that run late still count against max_queue.
+class PasswordHasher:
+    def __init__(self, mode='thread', workers=None, max_queue=None, rounds=12, timeout=30):
+        if mode not in ('thread', 'process', 'inline'):
+            raise ValueError(f"Invalid password hashing mode: {mode}")
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue or self.workers * 4
+        self.rounds = rounds
+        self.timeout = timeout
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_queue)
+        self._depth = 0
+
+    def hash(self, password):
+        hashed = self._run('hash', _hashpw, password.encode('utf-8'), self.rounds)
+        # Decode so the hash is stored as text, see create_user
+        return hashed.decode('utf-8')
+
+    def check(self, password, hashed):
+        return self._run('check', _checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+    # Hash a batch of passwords in parallel, e.g. for a bulk import. Unlike hash(), waits
+    # for a free slot instead of failing, and holds at most `workers` slots at a time so
+    # interactive signups keep the rest of the queue
+    def hash_many(self, passwords):
+        if self.mode == 'inline':
+            return [self.hash(password) for password in passwords]
+        hashes = []
+        for start in range(0, len(passwords), self.workers):
+            window = passwords[start:start + self.workers]
+            start_time = time.time()
+            futures = []
+            for password in window:
+                if not self._slots.acquire(timeout=self.timeout):
+                    raise PasswordHasherSaturated()
+                futures.append(self._submit(_hashpw, password.encode('utf-8'), self.rounds))
+            hashes.extend(self._result(future).decode('utf-8') for future in futures)
+            duration = time.time() - start_time
+            metrics.timing('password_hash.duration', duration * 1000 / len(window), tags={'operation': 'hash_many'})  # in ms
+        return hashes
+
+    def _get_executor(self):
+        # Created lazily so a pre-forking server builds the pool in each worker
+        with self._lock:
+            if self._executor is None:
+                if self.mode == 'process':
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+            return self._executor
+
+    def _update_depth(self, delta):
+        with self._lock:
+            self._depth += delta
+            depth = self._depth
+        metrics.gauge('password_hash.queue_depth', depth)
+
+    # Submit a job for a slot the caller holds. The slot is released when the job is done
+    def _submit(self, func, *args):
+        self._update_depth(1)
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def _release(self):
+        self._slots.release()
+        self._update_depth(-1)
+
+    def _result(self, future):
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            metrics.incr('password_hash.timeout')
+            logger.error("Password hashing did not finish within %ss", self.timeout)
+            raise PasswordHasherSaturated()
+
+    def _run(self, operation, func, *args):
+        start_time = time.time()
+        if self.mode == 'inline':
+            result = func(*args)
+        else:
+            if not self._slots.acquire(blocking=False):
+                metrics.incr('password_hash.rejected')
+                logger.error("Password hashing pool saturated, rejecting request")
+                raise PasswordHasherSaturated()
+            result = self._result(self._submit(func, *args))
+        duration = time.time() - start_time
+        metrics.timing('password_hash.duration', duration * 1000, tags={'operation': operation})  # in ms
+        add_phase_time('auth', duration)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+def create_password_hasher():
+    mode = os.getenv('PASSWORD_HASH_MODE', 'thread')
+    workers = int(os.getenv('PASSWORD_HASH_WORKERS', '0')) or None
+    max_queue = int(os.getenv('PASSWORD_HASH_MAX_QUEUE', '0')) or None
+    rounds = int(os.getenv('BCRYPT_ROUNDS', '12'))
+    timeout = float(os.getenv('PASSWORD_HASH_TIMEOUT', '30'))
+    hasher = PasswordHasher(mode=mode, workers=workers, max_queue=max_queue, rounds=rounds, timeout=timeout)
+    logger.info("Password hashing configured with mode=%s, workers=%s, max_queue=%s, rounds=%s",
+                hasher.mode, hasher.workers, hasher.max_queue, hasher.rounds)
+    return hasher
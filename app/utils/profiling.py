@@ -0,0 +1,282 @@
+from collections import Counter, deque
+import cProfile
+import threading
+import random
+import hmac
+import time
+import sys
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# Header that asks for a cProfile dump of a request, with PROFILE_TOKEN as its value
+PROFILE_HEADER = 'X-Profile-Token'
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    # ';' separates frames in the folded format
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+
+
+# Statistical profiler: a background thread takes the Python stack of every thread that
+# is serving a request every `interval` seconds and counts identical stacks. The counts
+# are written in the folded format of flamegraph.pl and speedscope, one
+# "endpoint;outer frame;...;inner frame count" line per stack, with the endpoint as root.
+# Walking the stacks holds the GIL, so the sampler measures its own cost and waits long
+# enough between samples to stay under max_overhead of the process' time.
+class StackSampler:
+    def __init__(self, output=None, interval=0.01, max_overhead=0.01, flush_interval=30, max_stacks=20000):
+        self.output = output
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.flush_interval = flush_interval
+        self.max_stacks = max_stacks
+        self.samples = 0
+        self.sampling_time = 0.0
+        self._stacks = Counter()
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._started_at = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # Fraction of wall time spent sampling since start
+    @property
+    def overhead(self):
+        if self._started_at is None:
+            return 0.0
+        return self.sampling_time / max(time.monotonic() - self._started_at, 1e-9)
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+        logger.info("Stack sampler started with interval=%ss, max_overhead=%s", self.interval, self.max_overhead)
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(timeout=5)
+            self._thread = None
+            self.flush()
+
+    # Called by the request hooks, so only threads serving a request are sampled
+    def enter_request(self, endpoint):
+        self._threads[threading.get_ident()] = endpoint or 'unknown'
+
+    def exit_request(self):
+        self._threads.pop(threading.get_ident(), None)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stopping.is_set():
+            cost = self.sample_once()
+            # Wait at least `interval`, and long enough that sampling stays within max_overhead
+            self._stopping.wait(max(self.interval, cost / self.max_overhead - cost))
+            if self.output and time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+
+    # Take one sample of all request threads. Returns the time it took
+    def sample_once(self):
+        start = time.perf_counter()
+        threads = dict(self._threads)
+        frames = sys._current_frames()
+        stacks = []
+        for ident, endpoint in threads.items():
+            frame = frames.get(ident)
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            if labels:
+                labels.append(endpoint)
+                stacks.append(';'.join(reversed(labels)))
+        del frames
+        with self._lock:
+            for stack in stacks:
+                # Memory stays bounded however many distinct stacks show up
+                if stack not in self._stacks and len(self._stacks) >= self.max_stacks:
+                    stack = 'truncated'
+                self._stacks[stack] += 1
+            self.samples += 1
+        cost = time.perf_counter() - start
+        self.sampling_time += cost
+        return cost
+
+    def folded(self):
+        with self._lock:
+            return ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+    def clear(self):
+        with self._lock:
+            self._stacks.clear()
+
+    # Rewrite the output file with the counts so far. One file per process
+    def flush(self):
+        if not self.output:
+            return
+        path = f"{self.output}.{os.getpid()}"
+        try:
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                f.write(self.folded())
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            logger.error("Failed to write stack samples: %s", e)
+
+
+# cProfile dumps of individual requests, for a random `rate` of requests and for requests
+# carrying the PROFILE_HEADER with the right token. A profiled request runs a few times
+# slower, so at most one request per process is profiled at a time and at most
+# max_per_minute of them a minute. Dumps are written once the response has been sent, as
+# <dir>/<endpoint>-<time>-<pid>.prof, and only the newest max_files are kept.
+class RequestProfiler:
+    def __init__(self, output_dir, rate=0.0, token=None, max_per_minute=6, max_files=100):
+        self.output_dir = output_dir
+        self.rate = rate
+        self.token = token
+        self.max_per_minute = max_per_minute
+        self.max_files = max_files
+        self.written = 0
+        self._active = threading.Lock()
+        # The profile of the request on this thread, if any
+        self._local = threading.local()
+        self._recent = deque()
+        self._lock = threading.Lock()
+
+    def _requested_by_header(self, header_value):
+        return bool(self.token and header_value) and hmac.compare_digest(header_value.encode(), self.token.encode())
+
+    def _within_budget(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and self._recent[0] < now - 60:
+                self._recent.popleft()
+            if len(self._recent) >= self.max_per_minute:
+                return False
+            self._recent.append(now)
+            return True
+
+    def start(self, endpoint, header_value=None):
+        if not (self._requested_by_header(header_value) or (self.rate > 0 and random.random() < self.rate)):
+            return
+        if not self._active.acquire(blocking=False):
+            return
+        if not self._within_budget():
+            self._active.release()
+            return
+        profile = cProfile.Profile()
+        self._local.profile = (profile, endpoint or 'unknown')
+        profile.enable()
+
+    def finish(self, response):
+        request_profile = self._pop()
+        if request_profile is None:
+            return response
+        profile, endpoint = request_profile
+        profile.disable()
+        self._active.release()
+        name = f"{endpoint}-{int(time.time() * 1000)}-{os.getpid()}.prof"
+        response.headers['X-Profile-Id'] = name
+        # Written after the response went out, so the client does not wait for it
+        response.call_on_close(lambda: self._dump(profile, name))
+        return response
+
+    # For requests that ended without a response, e.g. on an unhandled error
+    def abandon(self):
+        request_profile = self._pop()
+        if request_profile is not None:
+            request_profile[0].disable()
+            self._active.release()
+
+    def _pop(self):
+        request_profile = getattr(self._local, 'profile', None)
+        self._local.profile = None
+        return request_profile
+
+    def _dump(self, profile, name):
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            profile.dump_stats(os.path.join(self.output_dir, name))
+            self.written += 1
+            dumps = sorted((entry for entry in os.scandir(self.output_dir) if entry.name.endswith('.prof')),
+                           key=lambda entry: entry.stat().st_mtime)
+            for entry in dumps[:max(0, len(dumps) - self.max_files)]:
+                os.remove(entry.path)
+        except OSError as e:
+            logger.error("Failed to write request profile %s: %s", name, e)
+
+
+# Both profilers behind the request hooks
+class Profiler:
+    def __init__(self, sampler, request_profiler):
+        self.sampler = sampler
+        self.request_profiler = request_profiler
+
+    # Headers the request validation has to accept
+    @property
+    def request_headers(self):
+        return {PROFILE_HEADER} if self.request_profiler.token else set()
+
+    def request_started(self, endpoint, headers):
+        self.sampler.enter_request(endpoint)
+        self.request_profiler.start(endpoint, headers.get(PROFILE_HEADER))
+
+    def request_finished(self, response):
+        return self.request_profiler.finish(response)
+
+    def request_torn_down(self):
+        self.sampler.exit_request()
+        self.request_profiler.abandon()
+
+    # The sampler thread does not survive fork, so each worker starts its own
+    def start(self):
+        if os.getenv('PROFILE_SAMPLER_ENABLED', 'false').lower() == 'true':
+            self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+
+    def status(self):
+        return {
+            'sampler': {
+                'running': self.sampler.running,
+                'interval': self.sampler.interval,
+                'max_overhead': self.sampler.max_overhead,
+                'overhead': round(self.sampler.overhead, 5),
+                'samples': self.sampler.samples,
+            },
+            'request_profiles': {
+                'rate': self.request_profiler.rate,
+                'max_per_minute': self.request_profiler.max_per_minute,
+                'written': self.request_profiler.written,
+                'output_dir': self.request_profiler.output_dir,
+            },
+        }
+
+
+def create_profiler():
+    sampler = StackSampler(
+        output=os.getenv('PROFILE_SAMPLER_OUTPUT') or None,
+        interval=float(os.getenv('PROFILE_SAMPLER_INTERVAL', '0.01')),
+        max_overhead=float(os.getenv('PROFILE_SAMPLER_MAX_OVERHEAD', '0.01')),
+        flush_interval=float(os.getenv('PROFILE_SAMPLER_FLUSH_INTERVAL', '30')),
+    )
+    request_profiler = RequestProfiler(
+        output_dir=os.getenv('PROFILE_DIR', '/tmp/webapp-profiles'),
+        rate=float(os.getenv('PROFILE_REQUEST_RATE', '0')),
+        token=os.getenv('PROFILE_TOKEN') or None,
+        max_per_minute=int(os.getenv('PROFILE_MAX_PER_MINUTE', '6')),
+        max_files=int(os.getenv('PROFILE_MAX_FILES', '100')),
+    )
+    return Profiler(sampler, request_profiler)
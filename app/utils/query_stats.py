@@ -0,0 +1,199 @@
+from utils.latency import LatencyHistogram
+from utils.metrics import metrics
+import threading
+import hashlib
+import time
+import re
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+_COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+_STRINGS = re.compile(r"'(?:[^']|'')*'")
+_NUMBERS = re.compile(r'(?<![\w$])-?\d+(?:\.\d+)?\b')
+# psycopg2 (%(name)s, %s), sqlite (?) and asyncpg ($1) placeholders
+_PARAMETERS = re.compile(r'%\(\w+\)s|%s|\?|\$\d+')
+_IN_LISTS = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.I)
+# The rows of a multi-row INSERT ... VALUES (...), (...)
+_ROW_LISTS = re.compile(r'(\([^()]*\))(?:\s*,\s*\([^()]*\))+')
+_WHITESPACE = re.compile(r'\s+')
+
+# Statements EXPLAIN can plan
+_EXPLAINABLE = ('select', 'insert', 'update', 'delete', 'with')
+SORT_KEYS = ('total', 'mean', 'p99', 'max', 'count')
+
+
+# Normalized SQL text, so statements that only differ in their parameters, literals or
+# the length of their IN lists and VALUES rows are counted together
+def fingerprint(statement):
+    text = _COMMENTS.sub(' ', statement)
+    text = _STRINGS.sub('?', text)
+    text = _PARAMETERS.sub('?', text)
+    text = _NUMBERS.sub('?', text)
+    text = _IN_LISTS.sub('IN (...)', text)
+    text = _ROW_LISTS.sub(r'\1', text)
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+# Query plan of a statement that just ran, from the same connection and parameters.
+# Only plans, nothing is executed again. Literals are masked in the output, so
+# parameter values such as emails do not end up in the log
+def explain_statement(connection, statement, parameters):
+    dialect = connection.dialect.name
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+    # A failed statement aborts a PostgreSQL transaction, the savepoint keeps the
+    # request's transaction usable if EXPLAIN fails
+    savepoint = dialect == 'postgresql'
+    cursor = connection.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT query_stats_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+        except Exception:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT query_stats_explain')
+            raise
+        if savepoint:
+            cursor.execute('RELEASE SAVEPOINT query_stats_explain')
+    finally:
+        cursor.close()
+    # PostgreSQL returns one line per row, SQLite the detail in the last column
+    return _STRINGS.sub("'?'", '\n'.join(str(row[-1]) for row in rows))
+
+
+class StatementStats:
+    def __init__(self, query_id, text):
+        self.query_id = query_id
+        self.fingerprint = text
+        self.histogram = LatencyHistogram()
+        self.rows = 0
+        self.errors = 0
+        self.slow = 0
+        self.plan = None
+        self.explained_at = None
+
+    def to_dict(self):
+        histogram = self.histogram
+        return {
+            'id': self.query_id,
+            'fingerprint': self.fingerprint,
+            'count': histogram.count,
+            'errors': self.errors,
+            'slow': self.slow,
+            'rows': self.rows,
+            'total_ms': round(histogram.total * 1000, 3),
+            'mean_ms': round(histogram.total / histogram.count * 1000, 3) if histogram.count else 0.0,
+            'p50_ms': round(histogram.quantile(0.5) * 1000, 3),
+            'p99_ms': round(histogram.quantile(0.99) * 1000, 3),
+            'max_ms': round(histogram.max * 1000, 3),
+            'plan': self.plan,
+        }
+
+
+# Per-statement statistics, like pg_stat_statements but per process and across the
+# primary and the replica: a count, latency histogram, rows and errors per fingerprint.
+# Statements slower than slow_threshold seconds are logged with their fingerprint and,
+# at most once per explain_interval seconds per fingerprint, their EXPLAIN output.
+# Fingerprints are cached per statement text, since the ORM sends the same few strings
+# over and over. Beyond max_fingerprints distinct ones, new statements count as 'other'.
+class QueryStats:
+    def __init__(self, slow_threshold=0.2, explain=True, explain_interval=300, max_fingerprints=1000,
+                 max_cached_statements=5000):
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.max_fingerprints = max_fingerprints
+        self.max_cached_statements = max_cached_statements
+        self._statements = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+
+    def _identify(self, statement):
+        identity = self._fingerprints.get(statement)
+        if identity is None:
+            text = fingerprint(statement)
+            identity = (hashlib.sha1(text.encode('utf-8'), usedforsecurity=False).hexdigest()[:16], text)
+            if len(self._fingerprints) >= self.max_cached_statements:
+                self._fingerprints.clear()
+            self._fingerprints[statement] = identity
+        return identity
+
+    def _entry(self, statement):
+        query_id, text = self._identify(statement)
+        entry = self._statements.get(query_id)
+        if entry is None:
+            if len(self._statements) >= self.max_fingerprints:
+                query_id, text = 'other', 'other'
+                entry = self._statements.get(query_id)
+            if entry is None:
+                entry = self._statements[query_id] = StatementStats(query_id, text)
+        return entry
+
+    # Record a statement that ran for `seconds`. Returns its query id
+    def record(self, statement, seconds, rows=None, connection=None, parameters=None, executemany=False):
+        with self._lock:
+            entry = self._entry(statement)
+            entry.histogram.record(seconds)
+            if rows is not None and rows > 0:
+                entry.rows += rows
+            slow = seconds >= self.slow_threshold
+            explain = False
+            if slow:
+                entry.slow += 1
+                now = time.monotonic()
+                explainable = self.explain and connection is not None and not executemany
+                if explainable and statement.lstrip().lower().startswith(_EXPLAINABLE):
+                    if entry.explained_at is None or now - entry.explained_at >= self.explain_interval:
+                        entry.explained_at = now
+                        explain = True
+        if slow:
+            self._log_slow(entry, seconds, connection, statement, parameters, explain)
+        return entry.query_id
+
+    def record_error(self, statement):
+        with self._lock:
+            self._entry(statement).errors += 1
+
+    def _log_slow(self, entry, seconds, connection, statement, parameters, explain):
+        metrics.incr('database.query.slow')
+        plan = None
+        if explain:
+            try:
+                plan = entry.plan = explain_statement(connection, statement, parameters)
+            except Exception as e:
+                logger.debug("Could not explain query %s: %s", entry.query_id, e)
+        if plan:
+            logger.warning("Slow query %s (%.1f ms): %s\n%s", entry.query_id, seconds * 1000, entry.fingerprint, plan)
+        else:
+            logger.warning("Slow query %s (%.1f ms): %s", entry.query_id, seconds * 1000, entry.fingerprint)
+
+    # The n statements with the highest total time, mean, p99, max or count
+    def top(self, n=10, sort='total'):
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Invalid sort key: {sort}")
+        with self._lock:
+            statements = [entry.to_dict() for entry in self._statements.values()]
+        key = 'count' if sort == 'count' else f"{sort}_ms"
+        return sorted(statements, key=lambda statement: statement[key], reverse=True)[:n]
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+
+    def __len__(self):
+        return len(self._statements)
+
+
+def create_query_stats():
+    if os.getenv('QUERY_STATS_ENABLED', 'true').lower() != 'true':
+        return None
+    return QueryStats(
+        slow_threshold=float(os.getenv('QUERY_SLOW_THRESHOLD_MS', '200')) / 1000,
+        explain=os.getenv('QUERY_EXPLAIN_ENABLED', 'true').lower() == 'true',
+        explain_interval=float(os.getenv('QUERY_EXPLAIN_INTERVAL', '300')),
+        max_fingerprints=int(os.getenv('QUERY_STATS_MAX_FINGERPRINTS', '1000'))
+    )
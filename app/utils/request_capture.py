@@ -0,0 +1,122 @@
+import threading
+import hashlib
+import hmac
+import json
+import re
+import os
+import logging
+from datetime import datetime
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# A Werkzeug access line: 127.0.0.1 - - [18/Oct/2026 04:37:08] "GET /v1/user/self HTTP/1.1" 200 -
+ACCESS_LINE = re.compile(r'"(?P<method>[A-Z]+) (?P<target>\S+) HTTP/[\d.]+" (?P<status>\d{3})')
+# Text log line, see log_pipeline.LOG_FORMAT
+TEXT_LOG_LINE = re.compile(r'^(?P<asctime>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - (?P<name>\S+) - \w+ - (?P<message>.*)$')
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+
+# Appends one JSON line per request to a capture file, for benchmarks/replay.py:
+#   {"ts": 1760762228.3, "method": "GET", "path": "/v1/user/self", "query": "", "status": 200,
+#    "duration_ms": 3.1, "user": "9f2c1e..."}
+# Only request metadata is kept, never headers or bodies. `user` is an HMAC of the
+# authenticated email, so a replay can keep each user's requests together without the
+# capture revealing who they were. Workers must share `secret` for the keys to match.
+class RequestCapture:
+    def __init__(self, path, secret=None):
+        self.path = path
+        self._secret = secret or os.urandom(32)
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def user_key(self, email):
+        if not email:
+            return None
+        return hmac.new(self._secret, email.encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+    def record(self, ts, method, path, query, status, duration, email=None):
+        entry = {
+            'ts': round(ts, 6),
+            'method': method,
+            'path': path,
+            'query': query,
+            'status': status,
+            'duration_ms': round(duration * 1000, 3) if duration is not None else None,
+            'user': self.user_key(email),
+        }
+        line = json.dumps(entry) + '\n'
+        try:
+            with self._lock:
+                # Opened per process, after a pre-forking server has forked. Lines are short
+                # enough to be appended atomically by concurrent workers
+                if self._file is None or self._pid != os.getpid():
+                    self._file = open(self.path, 'a', buffering=1, encoding='utf-8')
+                    self._pid = os.getpid()
+                self._file.write(line)
+        except OSError as e:
+            logger.error("Failed to write request capture: %s", e)
+
+
+# Request captures derived from an app log: the Werkzeug access lines the development
+# server writes, in the text or JSON (LOG_MODE=async) format. Durations and users are
+# not in the log, so they are left empty
+def captures_from_log(lines):
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            asctime, name, message = entry.get('timestamp'), entry.get('logger'), entry.get('message', '')
+        else:
+            match = TEXT_LOG_LINE.match(line)
+            if match is None:
+                continue
+            asctime, name, message = match.group('asctime'), match.group('name'), match.group('message')
+        if name != 'werkzeug':
+            continue
+        access = ACCESS_LINE.search(ANSI_ESCAPE.sub('', message))
+        if access is None or not asctime:
+            continue
+        path, _, query = access.group('target').partition('?')
+        # Values are dropped like in captures written by the app
+        query = '&'.join(f"{pair.partition('=')[0]}=" for pair in query.split('&') if pair)
+        yield {
+            'ts': datetime.strptime(asctime, '%Y-%m-%d %H:%M:%S,%f').timestamp(),
+            'method': access.group('method'),
+            'path': path,
+            'query': query,
+            'status': int(access.group('status')),
+            'duration_ms': None,
+            'user': None,
+        }
+
+
+# The user key secret, which every worker and instance must share for a replay to
+# keep each user's requests together: REQUEST_CAPTURE_SECRET, or else one derived from
+# SECRET_KEY. A per-process random secret would split users across workers
+def _capture_secret():
+    secret = os.getenv('REQUEST_CAPTURE_SECRET')
+    if secret:
+        return secret.encode('utf-8')
+    secret_key = os.getenv('SECRET_KEY')
+    if secret_key:
+        return hmac.new(secret_key.encode('utf-8'), b'request-capture', hashlib.sha256).digest()
+    return None
+
+
+def create_request_capture():
+    path = os.getenv('REQUEST_CAPTURE_FILE')
+    if not path:
+        return None
+    secret = _capture_secret()
+    if secret is None:
+        logger.warning("Request capture disabled: set REQUEST_CAPTURE_SECRET or SECRET_KEY so workers share user keys")
+        return None
+    logger.info("Capturing request metadata to %s", path)
+    return RequestCapture(path, secret=secret)
@@ -0,0 +1,101 @@
+from flask import request, jsonify, make_response
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+
+# WSGI environ key of a header: 'X-Forwarded-For' -> 'HTTP_X_FORWARDED_FOR'.
+# The server has already normalized incoming headers this way, so comparing environ keys
+# is case-insensitive: 'x-amzn-requestid' from an HTTP/2 ALB and 'X-Amzn-RequestId'
+# map to the same key
+def environ_key(header):
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+# Validation rules of a route:
+#   - allowed_headers: header names accepted on top of the global ones, or None to accept any header
+#   - query_params: names of accepted query parameters (none by default)
+#   - reject_get_body: a GET request must not carry a body
+class RouteRules:
+    __slots__ = ('allowed_headers', 'query_params', 'reject_get_body', 'enabled')
+
+    def __init__(self, extra_headers=(), query_params=(), reject_get_body=True, check_headers=True, enabled=True):
+        self.allowed_headers = frozenset(environ_key(name) for name in extra_headers) if check_headers else None
+        self.query_params = frozenset(query_params)
+        self.reject_get_body = reject_get_body
+        self.enabled = enabled
+
+    # Copy of these rules with the global allowed headers added
+    def with_global_headers(self, allowed_headers):
+        merged = RouteRules(query_params=self.query_params, reject_get_body=self.reject_get_body, enabled=self.enabled)
+        merged.allowed_headers = allowed_headers | self.allowed_headers
+        return merged
+
+
+# Decorator to change the validation rules of a route, e.g. @request_rules(query_params=['token'])
+# or @request_rules(enabled=False). Put it right under @app.route
+def request_rules(**kwargs):
+    def decorator(f):
+        f.request_rules = RouteRules(**kwargs)
+        return f
+    return decorator
+
+
+# Validates every request before it is dispatched to its view: no unknown headers, no
+# query parameters and no body on GET requests, unless the route's rules allow them.
+# The allowed header names are turned into one frozenset of environ keys up front, and
+# the rules of each endpoint are resolved once, so a valid request costs a single pass
+# over the environ with set lookups.
+class RequestValidator:
+    def __init__(self, allowed_headers):
+        self.allowed_headers = frozenset(environ_key(name) for name in allowed_headers)
+        self.default_rules = RouteRules()
+        self._rules = {}
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self.validate)
+
+    def rules_for(self, endpoint):
+        rules = self._rules.get(endpoint)
+        if rules is None:
+            view = self.app.view_functions.get(endpoint)
+            rules = getattr(view, 'request_rules', self.default_rules)
+            if rules.allowed_headers is not None:
+                # Merged once per endpoint, not on every request
+                rules = rules.with_global_headers(self.allowed_headers)
+            self._rules[endpoint] = rules
+        return rules
+
+    def validate(self):
+        # Unknown paths and methods are left to the 404 and 405 handlers
+        if request.endpoint is None:
+            return None
+        rules = self.rules_for(request.endpoint)
+        if not rules.enabled:
+            return None
+        environ = request.environ
+        # This method should not accept any data in the request
+        if rules.reject_get_body and environ['REQUEST_METHOD'] == 'GET' and self._has_body(environ):
+            logger.error("GET requests should not contain a body")
+            return jsonify({'message': 'GET requests should not contain a body'}), 400
+        # Check for query parameters if added additionally
+        if environ.get('QUERY_STRING') and not rules.query_params.issuperset(request.args.keys()):
+            logger.error("Query parameters are not allowed")
+            return jsonify({'message': 'Bad Request'}), 400
+        # Check for new headers if added. Stops at the first unknown one
+        allowed = rules.allowed_headers
+        if allowed is not None:
+            for key in environ:
+                if key.startswith('HTTP_') and key not in allowed:
+                    logger.error("Invalid headers in request")
+                    return make_response(jsonify({"error": "Bad Request"}), 400)
+        return None
+
+    @staticmethod
+    def _has_body(environ):
+        # Only read the body when the request announces one
+        if environ.get('CONTENT_LENGTH', '0') in ('', '0') and 'HTTP_TRANSFER_ENCODING' not in environ:
+            return False
+        return bool(request.data or request.form)
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+import threading
+import hashlib
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+
+# Strong ETag built from the values a response is derived from, e.g. the user id and
+# account_updated. Hashed so it does not expose them
+def make_etag(*parts):
+    return hashlib.sha256('\x00'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+
+# In-process cache of serialized JSON responses per user, e.g. (user_id, 'user') for
+# GET /v1/user/self. An entry is only served while its ETag matches the one computed
+# from the current data, so a stale entry (say, written by another worker before an
+# update) is never returned. Writes invalidate the user's entries to free them early.
+class ResponseCache:
+    def __init__(self, ttl=300, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, kind, etag):
+        if self.max_size <= 0:
+            return None
+        key = (user_id, kind)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            cached_etag, body, expires_at = entry
+            if cached_etag != etag or expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return body
+
+    def add(self, user_id, kind, etag, body):
+        if self.max_size <= 0:
+            return
+        key = (user_id, kind)
+        with self._lock:
+            self._entries[key] = (etag, body, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            # Evict least recently used entries once we go over capacity
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # Drop every cached response of a user
+    def invalidate(self, user_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def create_response_cache():
+    enabled = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+    max_size = int(os.getenv('RESPONSE_CACHE_MAX_SIZE', '10000')) if enabled else 0
+    ttl = float(os.getenv('RESPONSE_CACHE_TTL', '300'))
+    logger.info("Response cache configured with ttl=%ss, max_size=%s", ttl, max_size)
+    return ResponseCache(ttl=ttl, max_size=max_size)
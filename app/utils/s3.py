@@ -1,19 +1,22 @@
+from collections import OrderedDict
 import boto3
 import os
 from botocore.exceptions import ClientError
-from statsd import StatsClient
+from utils.metrics import metrics
+from utils.latency import add_phase_time
+from utils.tracing import tracer
 import time
+import inspect
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import logging
 
 # Get a logger for this module
 logger = logging.getLogger(__name__)
 
 # Initialize the S3 client using the default credential provider chain
-s3_client = boto3.client('s3', region_name=os.getenv('AWS_REGION'))
-
-# Initialize StatsD client
-statsd_client = StatsClient()
+s3_client = tracer.instrument_boto_client(boto3.client('s3', region_name=os.getenv('AWS_REGION')))
 
 
 # Decorators to measure the number of calls, duration, and package size of S3 operations
@@ -21,7 +24,7 @@ def measure_s3_call_count(func):
     @wraps(func)
     def wrapper(*args, **kwargs):
         endpoint = func.__name__
-        statsd_client.incr(f's3.{endpoint}.calls')
+        metrics.incr('s3.calls', tags={'operation': endpoint})
         return func(*args, **kwargs)
     return wrapper
 
@@ -33,7 +36,8 @@ def measure_s3_call_duration(func):
         result = func(*args, **kwargs)
         duration = time.time() - start_time
         endpoint = func.__name__
-        statsd_client.timing(f's3.{endpoint}.duration', duration * 1000)  # in ms
+        metrics.timing('s3.duration', duration * 1000, tags={'operation': endpoint})  # in ms
+        add_phase_time('s3', duration)
         return result
     return wrapper
 
@@ -45,11 +49,30 @@ def measure_s3_package_size(func):
         file_size = file.tell()  # Get the current position of the cursor, which is the size of the file
         file.seek(0)  # Reset the cursor to the beginning of the file
         endpoint = func.__name__
-        statsd_client.gauge(f's3.{endpoint}.package_size', file_size)  # Send the file size to StatsD
+        metrics.gauge('s3.package_size', file_size, tags={'operation': endpoint})  # Send the file size to StatsD
         return func(file, bucket_name, object_name)
     return wrapper
 
 
+# Decorator to trace S3 operations as child spans of the current request. A call that
+# returns False or None failed, since the operations log and swallow ClientError
+def trace_s3_call(func):
+    parameters = inspect.signature(func).parameters
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        arguments = dict(zip(parameters, args), **kwargs)
+        attributes = {'s3.operation': func.__name__, 's3.bucket': arguments.get('bucket_name'),
+                      's3.key': arguments.get('object_name')}
+        with tracer.span(f"s3.{func.__name__}", kind='client', attributes=attributes) as span:
+            result = func(*args, **kwargs)
+            if span is not None and (result is False or result is None):
+                span.error = 'S3 call failed'
+            return result
+    return wrapper
+
+
+@trace_s3_call
 @measure_s3_call_count
 @measure_s3_call_duration
 @measure_s3_package_size
@@ -60,10 +83,11 @@ def upload_to_s3(file, bucket_name, object_name):
         logger.info("Upload to S3 successful")
         return True
     except ClientError as e:
-        logger.error(f"Failed to upload to S3: {e}")
+        logger.error("Failed to upload to S3: %s", e)
         return False
 
 
+@trace_s3_call
 @measure_s3_call_count
 @measure_s3_call_duration
 def delete_from_s3(bucket_name, object_name):
@@ -73,5 +97,177 @@ def delete_from_s3(bucket_name, object_name):
         logger.info("Deletion from S3 successful")
         return True
     except ClientError as e:
-        logger.error(f"Failed to delete from S3: {e}")
+        logger.error("Failed to delete from S3: %s", e)
         return False
+
+
+# Raised by stream_upload_to_s3 as soon as a stream goes over its size limit
+class UploadTooLarge(Exception):
+    pass
+
+
+# Minimum size of every part but the last in an S3 multipart upload
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Shared pool that uploads the parts of all streamed uploads in this process
+_transfer_pool = None
+_transfer_pool_lock = threading.Lock()
+
+
+def get_transfer_pool():
+    global _transfer_pool
+    with _transfer_pool_lock:
+        if _transfer_pool is None:
+            _transfer_pool = ThreadPoolExecutor(
+                max_workers=int(os.getenv('S3_TRANSFER_POOL_SIZE', '16')),
+                thread_name_prefix='s3-transfer'
+            )
+        return _transfer_pool
+
+
+def _upload_part(bucket_name, object_name, upload_id, part_number, body):
+    response = s3_client.upload_part(
+        Bucket=bucket_name, Key=object_name, UploadId=upload_id, PartNumber=part_number, Body=body
+    )
+    return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+
+# Upload an iterable of byte chunks with an S3 multipart upload, without ever holding the
+# whole object. Chunks are cut into part_size parts and up to `concurrency` parts of this
+# upload are in flight on the transfer pool at once, so memory stays around
+# part_size * (concurrency + 1) whatever the object size. Errors raised while reading
+# `chunks` abort the upload and are re-raised for the caller, like UploadTooLarge.
+@trace_s3_call
+@measure_s3_call_count
+@measure_s3_call_duration
+def stream_upload_to_s3(chunks, bucket_name, object_name, part_size=S3_MIN_PART_SIZE, max_size=None, concurrency=4):
+    logger.info("Starting streamed upload to S3")
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=object_name)['UploadId']
+    pool = get_transfer_pool()
+    in_flight = threading.BoundedSemaphore(concurrency)
+    futures = []
+    total_size = 0
+    source_error = None
+
+    def read_chunks():
+        nonlocal source_error
+        try:
+            yield from chunks
+        except Exception as e:
+            source_error = e
+            raise
+
+    def submit(body):
+        in_flight.acquire()
+        future = pool.submit(_upload_part, bucket_name, object_name, upload_id, len(futures) + 1, body)
+        future.add_done_callback(lambda _: in_flight.release())
+        futures.append(future)
+
+    try:
+        buffer = bytearray()
+        for chunk in read_chunks():
+            total_size += len(chunk)
+            if max_size is not None and total_size > max_size:
+                raise UploadTooLarge(f"Upload exceeds the maximum size of {max_size} bytes")
+            buffer += chunk
+            while len(buffer) >= part_size:
+                submit(bytes(buffer[:part_size]))
+                del buffer[:part_size]
+        # The last part may be smaller than the minimum, and an empty object still needs one part
+        if buffer or not futures:
+            submit(bytes(buffer))
+        parts = [future.result() for future in futures]
+        s3_client.complete_multipart_upload(
+            Bucket=bucket_name, Key=object_name, UploadId=upload_id, MultipartUpload={'Parts': parts}
+        )
+        metrics.gauge('s3.package_size', total_size, tags={'operation': 'stream_upload_to_s3'})
+        logger.info("Streamed upload to S3 successful")
+        return True
+    except Exception as e:
+        for future in futures:
+            future.cancel()
+        try:
+            s3_client.abort_multipart_upload(Bucket=bucket_name, Key=object_name, UploadId=upload_id)
+        except ClientError as abort_error:
+            logger.error("Failed to abort multipart upload: %s", abort_error)
+        if isinstance(e, UploadTooLarge) or e is source_error:
+            raise
+        logger.error("Failed streamed upload to S3: %s", e)
+        return False
+
+
+# Presigned POST form that lets a client upload an object straight to S3.
+# The policy pins the key, the Content-Type and caps the size, so the form cannot be
+# reused for anything else, such as serving HTML from the bucket
+@measure_s3_call_count
+def create_presigned_upload(bucket_name, object_name, max_size, content_type, expires_in=300):
+    return s3_client.generate_presigned_post(
+        bucket_name, object_name,
+        Fields={'Content-Type': content_type},
+        Conditions=[['content-length-range', 1, max_size], {'Content-Type': content_type}],
+        ExpiresIn=expires_in
+    )
+
+
+# Size of an uploaded object, or None if it does not exist
+@trace_s3_call
+@measure_s3_call_count
+@measure_s3_call_duration
+def get_object_size(bucket_name, object_name):
+    try:
+        return s3_client.head_object(Bucket=bucket_name, Key=object_name)['ContentLength']
+    except ClientError as e:
+        logger.error("Failed to find object in S3: %s", e)
+        return None
+
+
+# Presigned GET URLs cached per user until shortly before they expire, so polling
+# clients get a stable URL and we do not sign a new one on every request.
+# Holds at most max_size users, evicting the least recently used; expired entries are
+# dropped when they are read
+class PresignedUrlCache:
+    def __init__(self, refresh_margin=30, max_size=10000):
+        self.refresh_margin = refresh_margin
+        self.max_size = max_size
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cache_key, object_name):
+        with self._lock:
+            entry = self._urls.get(cache_key)
+            if entry is None:
+                return None
+            if entry[2] - self.refresh_margin <= time.time():
+                del self._urls[cache_key]
+                return None
+            self._urls.move_to_end(cache_key)
+        return entry[1] if entry[0] == object_name else None
+
+    def set(self, cache_key, object_name, url, expires_at):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._urls[cache_key] = (object_name, url, expires_at)
+            self._urls.move_to_end(cache_key)
+            while len(self._urls) > self.max_size:
+                self._urls.popitem(last=False)
+
+    def invalidate(self, cache_key):
+        with self._lock:
+            self._urls.pop(cache_key, None)
+
+    def __len__(self):
+        return len(self._urls)
+
+
+presigned_url_cache = PresignedUrlCache(max_size=int(os.getenv('S3_PRESIGNED_CACHE_SIZE', '10000')))
+
+
+def get_presigned_download_url(bucket_name, object_name, cache_key, expires_in=300):
+    url = presigned_url_cache.get(cache_key, object_name)
+    if url is None:
+        url = s3_client.generate_presigned_url(
+            'get_object', Params={'Bucket': bucket_name, 'Key': object_name}, ExpiresIn=expires_in
+        )
+        presigned_url_cache.set(cache_key, object_name, url, time.time() + expires_in)
+    return url
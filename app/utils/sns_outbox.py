@@ -0,0 +1,226 @@
+from utils.models import db, User, OutboxMessage, utc_now, to_est_isoformat, VERIFICATION_TOKEN_TTL
+from botocore.exceptions import BotoCoreError, ClientError
+from datetime import timedelta, timezone
+from utils.metrics import metrics
+from utils.latency import add_phase_time
+from utils.tracing import tracer
+import threading
+import random
+import boto3
+import json
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# PublishBatch accepts at most 10 entries per call
+SNS_MAX_BATCH_SIZE = 10
+
+_sns_client = None
+_sns_client_lock = threading.Lock()
+
+
+# One SNS client shared by the whole process. boto3 clients are thread safe and
+# building one per publish costs a credential lookup and a fresh connection pool
+def get_sns_client():
+    global _sns_client
+    with _sns_client_lock:
+        if _sns_client is None:
+            _sns_client = tracer.instrument_boto_client(boto3.client('sns', region_name=os.getenv('AWS_REGION')))
+        return _sns_client
+
+
+def build_verification_message(user, verification_link):
+    return {
+        'email': user.email,
+        'first_name': user.first_name,
+        'verification_link': verification_link,
+        'expiration_time': to_est_isoformat(user.verification_token_created + VERIFICATION_TOKEN_TTL)
+    }
+
+
+# Add a verification message to the current session. It is committed together with
+# the caller's changes, so a user row never exists without its message (or vice versa)
+def enqueue_verification(user, verification_link):
+    message = OutboxMessage(
+        user_id=user.id,
+        topic_arn=os.getenv('AWS_SNS_TOPIC_ARN', ''),
+        payload=json.dumps(build_verification_message(user, verification_link))
+    )
+    db.session.add(message)
+    return message
+
+
+# Background worker that drains the outbox in PublishBatch calls.
+# Rows are claimed with SELECT ... FOR UPDATE SKIP LOCKED so several workers or
+# instances can run a dispatcher against the same table without double-publishing.
+# Failed entries are retried with exponential backoff until max_attempts is reached, or
+# until message_ttl after they were queued: a verification link is useless once its
+# token has expired, so such messages are given up on instead of being sent late.
+class OutboxDispatcher:
+    def __init__(self, app, client_factory=get_sns_client, batch_size=SNS_MAX_BATCH_SIZE,
+                 poll_interval=5.0, max_attempts=8, base_backoff=1.0, max_backoff=300.0,
+                 message_ttl=VERIFICATION_TOKEN_TTL):
+        self.app = app
+        self.client_factory = client_factory
+        self.batch_size = min(batch_size, SNS_MAX_BATCH_SIZE)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.message_ttl = message_ttl
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='sns-outbox', daemon=True)
+            self._thread.start()
+            logger.info("SNS outbox dispatcher started")
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    # Called after a commit that added messages so they go out without waiting a poll interval
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                # Keep going while full batches come back, there is probably more queued
+                while self.drain_batch() == self.batch_size and not self._stopping.is_set():
+                    pass
+            except Exception as e:
+                logger.error("Error draining SNS outbox: %s", e)
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    # Publish everything that is currently due. Returns the number of messages sent
+    def drain(self):
+        sent = 0
+        while True:
+            claimed = self.drain_batch()
+            sent += claimed
+            if claimed < self.batch_size:
+                return sent
+
+    # Claim and publish a single batch. Returns the number of messages claimed
+    def drain_batch(self):
+        with self.app.app_context():
+            try:
+                messages = (
+                    OutboxMessage.query
+                    .filter(OutboxMessage.sent_at.is_(None),
+                            OutboxMessage.attempts < self.max_attempts,
+                            OutboxMessage.next_attempt_at <= utc_now())
+                    .order_by(OutboxMessage.id)
+                    .limit(self.batch_size)
+                    .with_for_update(skip_locked=True)
+                    .all()
+                )
+                if not messages:
+                    db.session.commit()
+                    return 0
+                now = utc_now()
+                by_topic = {}
+                for message in messages:
+                    if self._expired(message, now):
+                        self._give_up(message, 'Expired before it could be sent')
+                    else:
+                        by_topic.setdefault(message.topic_arn, []).append(message)
+                # Publishing runs after the requests that queued the messages, so it is
+                # traced on its own. Polls that find nothing to send are not traced
+                with tracer.span('sns.outbox.drain', attributes={'messages': len(messages)}, root=True):
+                    for topic_arn, batch in by_topic.items():
+                        self._publish(topic_arn, batch)
+                    db.session.commit()
+                metrics.gauge('sns.outbox.batch_size', len(messages))
+                return len(messages)
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def _publish(self, topic_arn, batch):
+        entries = [{'Id': str(message.id), 'Message': message.payload} for message in batch]
+        start_time = time.time()
+        try:
+            attributes = {'sns.topic_arn': topic_arn, 'sns.messages': len(entries)}
+            with tracer.span('sns.publish_batch', kind='client', attributes=attributes) as span:
+                response = self.client_factory().publish_batch(TopicArn=topic_arn, PublishBatchRequestEntries=entries)
+                if span is not None and response.get('Failed'):
+                    span.set_attribute('sns.failed', len(response['Failed']))
+        except (BotoCoreError, ClientError) as e:
+            logger.error("Error publishing batch to SNS: %s", e)
+            for message in batch:
+                self._retry_later(message, str(e))
+            return
+        finally:
+            duration = time.time() - start_time
+            metrics.timing('sns.publish_batch.duration', duration * 1000)  # in ms
+            add_phase_time('sns', duration)
+
+        by_id = {str(message.id): message for message in batch}
+        for entry in response.get('Successful', []):
+            message = by_id[entry['Id']]
+            message.attempts += 1
+            message.sent_at = utc_now()
+            if message.user_id is not None:
+                db.session.query(User).filter(User.id == message.user_id).update(
+                    {User.verification_email_count: User.verification_email_count + 1},
+                    synchronize_session=False
+                )
+            logger.info("SNS message published successfully: %s", entry.get('MessageId'))
+        for entry in response.get('Failed', []):
+            self._retry_later(by_id[entry['Id']], f"{entry.get('Code')}: {entry.get('Message')}")
+        metrics.incr('sns.outbox.sent', len(response.get('Successful', [])))
+        metrics.incr('sns.outbox.failed', len(response.get('Failed', [])))
+
+    def _retry_later(self, message, error):
+        message.attempts += 1
+        message.last_error = error
+        backoff = min(self.max_backoff, self.base_backoff * (2 ** (message.attempts - 1)))
+        # Jitter so a failed batch does not retry in lockstep across workers
+        backoff += random.uniform(0, backoff / 2)  # nosec B311 - not used for security
+        message.next_attempt_at = utc_now() + timedelta(seconds=backoff)
+        if self._expired(message, message.next_attempt_at):
+            self._give_up(message, f"Expired before it could be sent: {error}")
+        elif message.attempts >= self.max_attempts:
+            logger.error("Giving up on SNS message %s after %s attempts: %s", message.id, message.attempts, error)
+        else:
+            logger.error("Failed to publish SNS message %s, retrying in %.1fs: %s", message.id, backoff, error)
+
+    # Whether a message would go out after its link stopped working
+    def _expired(self, message, at):
+        if self.message_ttl is None:
+            return False
+        created_at = message.created_at
+        # SQLite (unit tests) does not keep the zone, values are stored in UTC
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        return created_at + self.message_ttl <= at
+
+    # Stop retrying: rows at max_attempts are no longer claimed
+    def _give_up(self, message, error):
+        message.attempts = max(message.attempts, self.max_attempts)
+        message.last_error = error
+        metrics.incr('sns.outbox.expired')
+        logger.error("Giving up on SNS message %s: %s", message.id, error)
+
+
+def create_outbox_dispatcher(app):
+    return OutboxDispatcher(
+        app,
+        poll_interval=float(os.getenv('SNS_OUTBOX_POLL_INTERVAL', '5')),
+        max_attempts=int(os.getenv('SNS_OUTBOX_MAX_ATTEMPTS', '8'))
+    )
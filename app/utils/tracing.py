@@ -0,0 +1,399 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+import urllib.request
+import threading
+import logging
+import random
+import atexit
+import queue
+import json
+import time
+import os
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+# Set by the ALB on every request, and read by AWS services downstream
+TRACE_HEADER = 'X-Amzn-Trace-Id'
+
+# OTLP span kinds and status codes
+SPAN_KINDS = {'internal': 1, 'server': 2, 'client': 3}
+STATUS_ERROR = 2
+
+# Span the code running in this thread belongs to, if any
+_current_span = ContextVar('current_span', default=None)
+# Root span of the request being served, and the token to deactivate it
+_request_trace = ContextVar('request_trace', default=None)
+
+
+# X-Ray trace ids look like 1-<8 hex digits of epoch seconds>-<24 random hex digits>
+def new_trace_id():
+    return f"1-{int(time.time()):08x}-{random.getrandbits(96):024x}"
+
+
+def new_span_id():
+    return f"{random.getrandbits(64):016x}"
+
+
+# Root=1-5759e988-bd862e3fe1be46a994272793;Parent=53995c3f42cd8ad8;Sampled=1
+# Returns (trace id, parent span id, sampled), with None for anything missing
+def parse_trace_header(value):
+    fields = {}
+    for part in (value or '').split(';'):
+        key, _, field = part.strip().partition('=')
+        fields[key] = field
+    root = fields.get('Root')
+    if not root or len(root.split('-')) != 3:
+        return None, None, None
+    sampled = {'1': True, '0': False}.get(fields.get('Sampled'))
+    return root, fields.get('Parent') or None, sampled
+
+
+def format_trace_header(span):
+    return f"Root={span.trace_id};Parent={span.span_id};Sampled={1 if span.sampled else 0}"
+
+
+class Span:
+    def __init__(self, name, trace_id, parent_id=None, sampled=True, kind='internal', attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.start_time = time.time()
+        self.duration = None
+        self.error = None
+        self._start = time.perf_counter()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._start
+            if error is not None:
+                self.error = str(error) or type(error).__name__
+
+    # One line of the collector file
+    def to_dict(self):
+        entry = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start': round(self.start_time, 6),
+            'duration_ms': round((self.duration or 0) * 1000, 3),
+            'attributes': self.attributes,
+        }
+        if self.error is not None:
+            entry['error'] = self.error
+        return entry
+
+
+# Span dicts in the OTLP/HTTP JSON encoding, as accepted by the OpenTelemetry and ADOT
+# collectors on :4318/v1/traces. X-Ray trace ids map to OTLP ones by dropping the dashes
+# and the version, which is how the collector's X-Ray exporter maps them back
+def to_otlp(spans, service):
+    def value(raw):
+        if isinstance(raw, bool):
+            return {'boolValue': raw}
+        if isinstance(raw, int):
+            return {'intValue': str(raw)}
+        if isinstance(raw, float):
+            return {'doubleValue': raw}
+        return {'stringValue': str(raw)}
+
+    otlp_spans = []
+    for span in spans:
+        start = int(span['start'] * 1e9)
+        otlp_span = {
+            'traceId': span['trace_id'][2:].replace('-', ''),
+            'spanId': span['span_id'],
+            'name': span['name'],
+            'kind': SPAN_KINDS.get(span['kind'], 1),
+            'startTimeUnixNano': str(start),
+            'endTimeUnixNano': str(start + int(span['duration_ms'] * 1e6)),
+            'attributes': [{'key': key, 'value': value(raw)} for key, raw in span['attributes'].items()],
+        }
+        if span['parent_id']:
+            otlp_span['parentSpanId'] = span['parent_id']
+        if 'error' in span:
+            otlp_span['status'] = {'code': STATUS_ERROR, 'message': span['error']}
+        otlp_spans.append(otlp_span)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}}]},
+        'scopeSpans': [{'scope': {'name': 'webapp'}, 'spans': otlp_spans}],
+    }]}
+
+
+# Appends one JSON line per span. Each batch is a single write, so lines from
+# concurrent workers do not interleave
+class FileSpanSink:
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, spans):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(span, default=str) + '\n' for span in spans))
+
+
+# POSTs each batch to an OTLP/HTTP collector endpoint
+class HttpSpanSink:
+    def __init__(self, url, service='webapp', timeout=2.0):
+        self.url = url
+        self.service = service
+        self.timeout = timeout
+
+    def write(self, spans):
+        body = json.dumps(to_otlp(spans, self.service), default=str).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:  # nosec B310 - configured collector URL
+            response.read()
+
+
+# Finished spans go through a bounded queue to a background thread that hands them to
+# the sink in batches: up to batch_size spans, or whatever arrived within
+# flush_interval. Requests never wait on the sink; when the queue is full spans are
+# dropped and counted, like log records in log_pipeline
+class BatchSpanExporter:
+    _sentinel = None
+
+    def __init__(self, sink, max_queue_size=2048, batch_size=256, flush_interval=2.0):
+        self.sink = sink
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queue_size)
+        self.dropped = 0
+        self.failed = 0
+        self._thread = None
+
+    def export(self, span):
+        try:
+            self.queue.put_nowait(span.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5):
+        if self._thread is not None and self._thread.is_alive():
+            self.queue.put(self._sentinel)
+            self._thread.join(timeout)
+        self._thread = None
+        self.flush()
+
+    def _run(self):
+        while True:
+            span = self.queue.get()
+            if span is self._sentinel:
+                return
+            batch = [span]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    span = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is self._sentinel:
+                    self.write_batch(batch)
+                    return
+                batch.append(span)
+            self.write_batch(batch)
+
+    # Write out whatever is queued, on the calling thread
+    def flush(self):
+        batch = []
+        while True:
+            try:
+                span = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if span is not self._sentinel:
+                batch.append(span)
+            if len(batch) >= self.batch_size:
+                self.write_batch(batch)
+                batch = []
+        if batch:
+            self.write_batch(batch)
+
+    def write_batch(self, spans):
+        try:
+            self.sink.write(spans)
+        except Exception as e:
+            # Tracing is best effort, a missing collector must not break anything
+            self.failed += len(spans)
+            logger.warning("Failed to export %s spans: %s", len(spans), e)
+
+    def _after_fork(self):
+        # The exporter thread did not survive fork, and spans queued in the parent
+        # belong to the parent
+        self.queue = queue.Queue(self.max_queue_size)
+        self._thread = None
+        self.start()
+
+
+# Creates spans and keeps track of the current one. A request gets a root span that
+# continues the ALB's trace (X-Amzn-Trace-Id); SQL statements and S3 and SNS calls made
+# while it is current become its children. Whether a trace is exported is decided once
+# at its root: the upstream Sampled flag if there is one, otherwise sample_rate.
+# Unsampled traces still get ids, so their log lines can be correlated, but no children.
+# Without an exporter tracing is off and every call is a no-op.
+class Tracer:
+    def __init__(self, exporter=None, sample_rate=1.0, max_attribute_length=1000):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.max_attribute_length = max_attribute_length
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def current_span(self):
+        return _current_span.get()
+
+    def current_trace_id(self):
+        span = _current_span.get()
+        return span.trace_id if span is not None else None
+
+    # A new span, not made current. Without a current span one is only created with
+    # root=True, so e.g. migrations and health probes do not start traces of their own
+    def start_span(self, name, kind='internal', attributes=None, root=False, header=None):
+        if not self.enabled:
+            return None
+        if attributes:
+            attributes = {key: self._truncate(value) for key, value in attributes.items() if value is not None}
+        parent = _current_span.get()
+        if parent is not None:
+            if not parent.sampled:
+                return None
+            return Span(name, parent.trace_id, parent.span_id, True, kind, attributes)
+        if not root:
+            return None
+        trace_id, parent_id, sampled = parse_trace_header(header)
+        if trace_id is None:
+            trace_id, parent_id = new_trace_id(), None
+        if sampled is None:
+            sampled = random.random() < self.sample_rate  # nosec B311 - not used for security
+        return Span(name, trace_id, parent_id, sampled, kind, attributes)
+
+    def end_span(self, span, error=None):
+        if span is None:
+            return
+        span.end(error)
+        if span.sampled:
+            self.exporter.export(span)
+
+    # Make a span current. Returns a token for deactivate()
+    def activate(self, span):
+        return _current_span.set(span)
+
+    def deactivate(self, token):
+        _current_span.reset(token)
+
+    # Root span of a request, current until end_request()
+    def start_request(self, name, header=None, attributes=None):
+        span = self.start_span(name, 'server', attributes, root=True, header=header)
+        if span is not None:
+            _request_trace.set((span, self.activate(span)))
+        return span
+
+    def request_span(self):
+        request_trace = _request_trace.get()
+        return request_trace[0] if request_trace is not None else None
+
+    def end_request(self, error=None):
+        request_trace = _request_trace.get()
+        if request_trace is None:
+            return
+        _request_trace.set(None)
+        span, token = request_trace
+        self.end_span(span, error)
+        self.deactivate(token)
+
+    # Run a block of code in a span of its own
+    @contextmanager
+    def span(self, name, kind='internal', attributes=None, root=False):
+        span = self.start_span(name, kind, attributes, root)
+        if span is None:
+            yield None
+            return
+        token = self.activate(span)
+        try:
+            yield span
+        except Exception as e:
+            self.end_span(span, e)
+            raise
+        else:
+            self.end_span(span)
+        finally:
+            self.deactivate(token)
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_attribute_length:
+            return value[:self.max_attribute_length] + '...'
+        return value
+
+    # Send the current trace along with every call a boto3 client makes, so S3 and SNS
+    # (and the Lambda subscribed to the topic) show up in the same X-Ray trace
+    def instrument_boto_client(self, client):
+        def add_trace_header(request, **kwargs):
+            span = _current_span.get()
+            if span is not None:
+                request.headers[TRACE_HEADER] = format_trace_header(span)
+        client.meta.events.register('before-send', add_trace_header)
+        return client
+
+    def start(self):
+        if self.exporter is not None:
+            self.exporter.start()
+
+    def stop(self):
+        if self.exporter is not None:
+            self.exporter.stop()
+
+
+# Adds the current trace id to log records, so log lines can be matched to traces
+class TraceContextFilter(logging.Filter):
+    def __init__(self, tracer):
+        super().__init__()
+        self.tracer = tracer
+
+    def filter(self, record):
+        if not hasattr(record, 'trace_id'):
+            record.trace_id = self.tracer.current_trace_id()
+        return True
+
+
+def create_tracer():
+    if os.getenv('TRACING_ENABLED', 'false').lower() != 'true':
+        return Tracer()
+    url = os.getenv('TRACE_EXPORT_URL')
+    if url:
+        sink = HttpSpanSink(url, service=os.getenv('TRACE_SERVICE_NAME', 'webapp'),
+                            timeout=float(os.getenv('TRACE_EXPORT_TIMEOUT', '2')))
+    else:
+        sink = FileSpanSink(os.getenv('TRACE_EXPORT_FILE', '/var/log/webapp/traces.jsonl'))
+    exporter = BatchSpanExporter(
+        sink,
+        max_queue_size=int(os.getenv('TRACE_QUEUE_SIZE', '2048')),
+        batch_size=int(os.getenv('TRACE_BATCH_SIZE', '256')),
+        flush_interval=float(os.getenv('TRACE_FLUSH_INTERVAL', '2'))
+    )
+    tracer = Tracer(exporter, sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', '0.1')))
+    tracer.start()
+    # Export what is still queued when the process exits
+    atexit.register(tracer.stop)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=exporter._after_fork)
+    return tracer
+
+
+# The one tracer every module uses
+tracer = create_tracer()
@@ -0,0 +1,313 @@
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from utils.models import db, User, Image
+from utils.metrics import metrics
+import threading
+import json
+import uuid
+import time
+import os
+import logging
+
+# Get a logger for this module
+logger = logging.getLogger(__name__)
+
+
+# Column values of a row, e.g. {'id': UUID(...), 'email': ..., 'account_updated': datetime(...)}
+def row_values(obj):
+    return {column.key: getattr(obj, column.key) for column in obj.__table__.columns}
+
+
+def _encode(value):
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def _decode(model, values):
+    decoded = {}
+    for column in model.__table__.columns:
+        if column.key not in values:
+            continue
+        value = values[column.key]
+        if value is not None:
+            python_type = column.type.python_type
+            if python_type is uuid.UUID:
+                value = uuid.UUID(value)
+            elif python_type is datetime:
+                value = datetime.fromisoformat(value)
+        decoded[column.key] = value
+    return decoded
+
+
+# Columns never cached: the verification token would let anyone who can read the shared
+# cache verify the account. A materialized user loads it from the database if read
+UNCACHED_COLUMNS = ('verification_token',)
+
+
+# A user and their profile picture as plain values, safe to keep across requests and
+# sessions. JSON in the shared cache, so nothing executable is ever read back from it
+def snapshot(user):
+    values = {key: value for key, value in row_values(user).items() if key not in UNCACHED_COLUMNS}
+    return {'user': values, 'images': [row_values(image) for image in user.images]}
+
+
+def dump_snapshot(record):
+    return json.dumps({
+        'user': {key: _encode(value) for key, value in record['user'].items()},
+        'images': [{key: _encode(value) for key, value in image.items()} for image in record['images']],
+    })
+
+
+def load_snapshot(data):
+    record = json.loads(data)
+    return {'user': _decode(User, record['user']), 'images': [_decode(Image, image) for image in record['images']]}
+
+
+# Turn a snapshot back into a User attached to the current session, without a query.
+# The objects are marked as loaded and unmodified, so updating or deleting them
+# afterwards works as if they had been read from the database
+def materialize(record):
+    user = User(**record['user'])
+    make_transient_to_detached(user)
+    images = []
+    for values in record['images']:
+        image = Image(**values)
+        make_transient_to_detached(image)
+        set_committed_value(image, 'user', user)
+        images.append(image)
+    set_committed_value(user, 'images', images)
+    return db.session.merge(user, load=False)
+
+
+# In-memory stand-in for the subset of the Redis client the user cache uses: get, set
+# with expiry, publish and pubsub().subscribe/run_in_thread. Messages are delivered
+# straight away on the publishing thread. Used in tests, and shared between caches in
+# the same process to simulate several instances
+class MemorySharedCache:
+    def __init__(self):
+        self._values = {}
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._values[key] = (value, time.monotonic() + ex if ex else None)
+        return True
+
+    def publish(self, channel, message):
+        with self._lock:
+            handlers = list(self._handlers.get(channel, ()))
+        for handler in handlers:
+            handler({'type': 'message', 'channel': channel, 'data': message})
+        return len(handlers)
+
+    def pubsub(self, **kwargs):
+        return _MemoryPubSub(self)
+
+
+class _MemoryPubSub:
+    def __init__(self, cache):
+        self._cache = cache
+        self._subscribed = []
+
+    def subscribe(self, **handlers):
+        with self._cache._lock:
+            for channel, handler in handlers.items():
+                self._cache._handlers.setdefault(channel, []).append(handler)
+                self._subscribed.append((channel, handler))
+
+    # Delivery is synchronous, so there is no thread to run. Returns itself to stop
+    def run_in_thread(self, **kwargs):
+        return self
+
+    def stop(self):
+        with self._cache._lock:
+            for channel, handler in self._subscribed:
+                self._cache._handlers[channel].remove(handler)
+            self._subscribed = []
+
+
+# Two-level cache of user records (the user and their profile picture), by email.
+#   - L1: in-process LRU with a short TTL, so most requests need no round trip at all
+#   - L2: optional cache shared by all instances (Redis, or anything with the same API)
+# Writes go to the database first, then invalidate() the user:
+#   - the user's version stamp in L2 is replaced. L2 records are stored under the version
+#     they were read at, so records read before the write can no longer be found, even if
+#     a slow reader stores its copy after the invalidation
+#   - an invalidation message is published so every instance drops its L1 copy. The L1
+#     TTL bounds how stale a copy can get if a message is lost
+# The version stamp is the time of the write. Until fill_delay seconds later, records are
+# not cached at all: other instances may still read the old row from a lagging replica.
+class UserCache:
+    def __init__(self, ttl=5, shared_ttl=300, max_size=10000, shared=None, prefix='webapp:',
+                 fill_delay=5):
+        self.ttl = ttl
+        self.shared_ttl = shared_ttl
+        self.max_size = max_size
+        self.shared = shared
+        self.prefix = prefix
+        self.fill_delay = fill_delay
+        self.channel = f"{prefix}user-invalidations"
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._subscription = None
+
+    def _version_key(self, email):
+        return f"{self.prefix}user-version:{email}"
+
+    def _record_key(self, email, version):
+        return f"{self.prefix}user:{email}:{version}"
+
+    # Subscribe to invalidations from other instances. Call once per process, after fork
+    def start(self):
+        if self.shared is None or self._subscription is not None:
+            return
+        pubsub = self.shared.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: self._on_invalidation})
+        self._subscription = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop(self):
+        if self._subscription is not None:
+            self._subscription.stop()
+            self._subscription = None
+
+    def _on_invalidation(self, message):
+        email = message['data']
+        if isinstance(email, bytes):
+            email = email.decode('utf-8')
+        self._local_remove(email)
+
+    # The user with this email as an object of the current session, from the cache if
+    # possible. `loader` reads it from the database on a miss and may return None
+    def get_user(self, email, loader):
+        if self.max_size <= 0:
+            return loader(email)
+        record = self._local_get(email)
+        if record is not None:
+            metrics.incr('user_cache.hits', tags={'level': 'l1'})
+            return materialize(record)
+
+        version = None
+        cacheable = True
+        generation = self._generation
+        if self.shared is not None:
+            try:
+                version = self._shared_version(email)
+                data = self.shared.get(self._record_key(email, version or 0))
+                if data is not None:
+                    record = load_snapshot(data)
+                    self._local_add(email, record)
+                    metrics.incr('user_cache.hits', tags={'level': 'l2'})
+                    return materialize(record)
+            except Exception as e:
+                # The shared cache is an optimization, the database is the source of truth
+                logger.error("Shared user cache read failed: %s", e)
+                cacheable = False
+
+        metrics.incr('user_cache.misses')
+        user = loader(email)
+        # Not cached if the user was invalidated while it was being loaded
+        if user is None or not cacheable or generation != self._generation or self._recently_written(version):
+            return user
+        record = snapshot(user)
+        if self.shared is not None:
+            try:
+                self.shared.set(self._record_key(email, version or 0), dump_snapshot(record), ex=self.shared_ttl)
+            except Exception as e:
+                logger.error("Shared user cache write failed: %s", e)
+        self._local_add(email, record)
+        return user
+
+    def _shared_version(self, email):
+        version = self.shared.get(self._version_key(email))
+        if isinstance(version, bytes):
+            version = version.decode('utf-8')
+        return version
+
+    def _recently_written(self, version):
+        return version is not None and time.time() - float(version) < self.fill_delay
+
+    # Call after committing a change to the user or their profile picture
+    def invalidate(self, email):
+        self._local_remove(email)
+        if self.shared is None:
+            return
+        try:
+            # Outlives every record stored under the previous version, so an expired
+            # stamp can never make an old record reachable again
+            self.shared.set(self._version_key(email), f"{time.time():.6f}", ex=int(self.shared_ttl * 2 + self.fill_delay))
+            self.shared.publish(self.channel, email)
+        except Exception as e:
+            logger.error("Shared user cache invalidation failed for %s: %s", email, e)
+
+    def _local_get(self, email):
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            record, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[email]
+                return None
+            # Mark as most recently used
+            self._entries.move_to_end(email)
+            return record
+
+    def _local_add(self, email, record):
+        with self._lock:
+            self._entries[email] = (record, time.monotonic() + self.ttl)
+            self._entries.move_to_end(email)
+            # Evict least recently used entries once we go over capacity
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _local_remove(self, email):
+        with self._lock:
+            self._entries.pop(email, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# On by default only with a shared cache: without one, invalidations never reach the other
+# gunicorn workers, which would keep accepting an old password or refusing a newly
+# verified user for up to USER_CACHE_TTL seconds
+def create_user_cache():
+    redis_url = os.getenv('USER_CACHE_REDIS_URL')
+    enabled = os.getenv('USER_CACHE_ENABLED', 'true' if redis_url else 'false').lower() == 'true'
+    max_size = int(os.getenv('USER_CACHE_MAX_SIZE', '10000')) if enabled else 0
+    ttl = float(os.getenv('USER_CACHE_TTL', '5'))
+    shared_ttl = int(os.getenv('USER_CACHE_SHARED_TTL', '300'))
+    fill_delay = float(os.getenv('USER_CACHE_FILL_DELAY', os.getenv('DB_REPLICA_STICKY_SECONDS', '5')))
+    shared = None
+    if enabled and redis_url:
+        # Only needed when a shared cache is configured
+        import redis
+        shared = redis.Redis.from_url(redis_url, socket_timeout=float(os.getenv('USER_CACHE_REDIS_TIMEOUT', '0.2')))
+    if enabled and shared is None:
+        logger.warning("User cache enabled without USER_CACHE_REDIS_URL: other workers keep stale users for up to %ss", ttl)
+    logger.info("User cache configured with ttl=%ss, max_size=%s, shared=%s", ttl, max_size, shared is not None)
+    return UserCache(ttl=ttl, shared_ttl=shared_ttl, max_size=max_size, shared=shared,
+                     prefix=os.getenv('USER_CACHE_PREFIX', 'webapp:'), fill_delay=fill_delay)
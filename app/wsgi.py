@@ -0,0 +1,7 @@
+# WSGI entry point for production. Served by gunicorn, see gunicorn.conf.py:
+#   gunicorn --config gunicorn.conf.py wsgi:app
+# The database is initialized once before workers start (on_starting hook runs utils.db_init),
+# so each worker only builds the app and starts its own background threads.
+from app import create_app
+
+app = create_app()
@@ -0,0 +1,57 @@
+# Benchmark for the verified-credential cache in front of bcrypt.
+#
+# Drives authenticated GET /v1/user/self requests through the Flask test client on a
+# single thread (so the numbers are requests/sec per core) with the auth cache
+# disabled and enabled, against the in-memory SQLite database used by the unit tests.
+#
+# Usage: python benchmarks/auth_cache_bench.py [--requests 50] [--rounds 12]
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../app/')))
+# Keep app logging off the production log path
+os.environ.setdefault('LOG_FILE', os.devnull)
+import argparse
+import base64
+import time
+import uuid
+import bcrypt
+import app as webapp
+from app import create_app, db, User
+
+
+def run(requests_count, rounds, cache_enabled):
+    app = create_app(testing='unit')
+    webapp.auth_cache.clear()
+    webapp.auth_cache.max_size = 10000 if cache_enabled else 0
+    email, password = 'bench@example.com', 'benchmark-password'
+    with app.app_context():
+        db.create_all()
+        hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+        db.session.add(User(first_name='Bench', last_name='Mark', email=email, password=hashed,
+                            is_verified=True, verification_token=str(uuid.uuid4())))
+        db.session.commit()
+        auth_string = base64.b64encode(f"{email}:{password}".encode()).decode()
+        headers = {'Authorization': f"Basic {auth_string}"}
+        with app.test_client() as client:
+            start = time.perf_counter()
+            for _ in range(requests_count):
+                response = client.get('/v1/user/self', headers=headers)
+                assert response.status_code == 200, response.status_code
+            elapsed = time.perf_counter() - start
+        db.session.remove()
+        db.drop_all()
+    return requests_count / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Auth cache throughput benchmark')
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt work factor of the stored hash')
+    args = parser.parse_args()
+
+    without_cache = run(args.requests, args.rounds, cache_enabled=False)
+    with_cache = run(args.requests, args.rounds, cache_enabled=True)
+    print(f"bcrypt rounds: {args.rounds}, requests: {args.requests}")
+    print(f"without auth cache: {without_cache:10.1f} req/s per core")
+    print(f"with auth cache:    {with_cache:10.1f} req/s per core")
+    print(f"speedup:            {with_cache / without_cache:10.1f}x")
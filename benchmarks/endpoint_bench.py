@@ -0,0 +1,311 @@
+# Benchmark suite for the /v1 endpoints.
+#
+# Drives every /v1 route through the Flask test client on a single thread (so the numbers
+# are per core), against create_app(testing=...) with local stubs for S3 and SNS. Records
+# throughput, latency percentiles and database queries per request for each route, and
+# writes them as JSON together with the commit they were measured on:
+#
+#   python benchmarks/endpoint_bench.py --output before.json
+#   python benchmarks/endpoint_bench.py --output after.json --compare before.json
+#
+# --compare prints the change per route and exits with status 1 if throughput dropped or
+# p95 latency grew by more than --threshold percent. --testing integration runs against
+# the PostgreSQL test database configured with DB_* variables instead of in-memory SQLite.
+# App logs go to stderr.
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../app/')))
+import argparse
+import base64
+import json
+import platform
+import subprocess
+import time
+import uuid
+from datetime import datetime, timezone
+from io import BytesIO
+from load_test import percentile
+
+BENCH_ENV = {
+    # Keep app logging off the production log path
+    'LOG_FILE': os.devnull,
+    # No DNS lookups for signups, the domain checks are cached in production anyway
+    'EMAIL_DELIVERABILITY_MODE': 'off',
+    'AWS_S3_BUCKET': 'bench-bucket',
+    'AWS_SNS_TOPIC_ARN': 'arn:aws:sns:us-east-1:000000000000:bench',
+    'VERIFICATION_URL': 'http://localhost/v1/verify-email',
+}
+
+
+# Local stand-in for the S3 client calls the app makes
+class StubS3:
+    def __init__(self):
+        self.objects = {}
+        self.parts = {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self.objects[Key] = Fileobj.read()
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': f"upload-{Key}"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts[(Key, PartNumber)] = Body
+        return {'ETag': f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.objects[Key] = b''.join(self.parts.pop((Key, part['PartNumber'])) for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        pass
+
+    def generate_presigned_post(self, Bucket, Key, Conditions, ExpiresIn):
+        return {'url': f"https://{Bucket}.s3.local/", 'fields': {'key': Key}}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}.s3.local/{Params['Key']}?signature=bench"
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects.get(Key, b''))}
+
+
+# Local stand-in for SNS PublishBatch, always succeeds
+class StubSNS:
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        return {'Successful': [{'Id': entry['Id'], 'MessageId': str(uuid.uuid4())} for entry in PublishBatchRequestEntries],
+                'Failed': []}
+
+
+# Latencies, query counts and unexpected statuses of one route
+class RouteStats:
+    def __init__(self, route):
+        self.route = route
+        self.latencies = []
+        self.queries = 0
+        self.errors = 0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        total = sum(latencies)
+        count = len(latencies)
+        return {
+            'route': self.route,
+            'requests': count,
+            'errors': self.errors,
+            'throughput_rps': count / total if total else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+            'queries_per_request': self.queries / count if count else 0.0,
+        }
+
+
+class Bench:
+    def __init__(self, app, client, query_counter):
+        self.app = app
+        self.client = client
+        self.query_counter = query_counter
+        self.stats = {}
+
+    # Send one request and record it under `route`
+    def request(self, route, method, path, expected, **kwargs):
+        stats = self.stats.setdefault(route, RouteStats(route))
+        queries_before = self.query_counter[0]
+        start = time.perf_counter()
+        response = self.client.open(path, method=method, **kwargs)
+        response.get_data()
+        stats.latencies.append(time.perf_counter() - start)
+        stats.queries += self.query_counter[0] - queries_before
+        if response.status_code != expected:
+            stats.errors += 1
+        return response
+
+    # Time a call that is not a request, e.g. one outbox batch
+    def call(self, route, func):
+        stats = self.stats.setdefault(route, RouteStats(route))
+        queries_before = self.query_counter[0]
+        start = time.perf_counter()
+        result = func()
+        stats.latencies.append(time.perf_counter() - start)
+        stats.queries += self.query_counter[0] - queries_before
+        return result
+
+
+def auth_headers(email, password):
+    return {'Authorization': f"Basic {base64.b64encode(f'{email}:{password}'.encode()).decode()}"}
+
+
+def create_verified_user(db, User, hasher, email, password):
+    db.session.add(User(first_name='Bench', last_name='User', email=email, password=hasher.hash(password),
+                        is_verified=True, verification_token=str(uuid.uuid4())))
+    db.session.commit()
+
+
+def run_suite(args):
+    os.environ.update({key: os.environ.get(key, value) for key, value in BENCH_ENV.items()})
+    os.environ['BCRYPT_ROUNDS'] = str(args.rounds)
+    from sqlalchemy import event
+    import utils.s3
+    import app as webapp
+    from app import create_app, db, User
+    from utils.sns_outbox import OutboxDispatcher
+
+    utils.s3.s3_client = StubS3()
+    app = create_app(testing=args.testing)
+    app.config['TESTING'] = True
+    run_id = uuid.uuid4().hex[:8]
+    password = 'bench-password'
+    reader, writer, uploader = (f"bench_{role}_{run_id}@example.com" for role in ('reader', 'writer', 'uploader'))
+    query_counter = [0]
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        query_counter[0] += 1
+
+    with app.app_context():
+        db.create_all(bind_key=None)
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', count_query)
+        for email in (reader, writer, uploader):
+            create_verified_user(db, User, webapp.password_hasher, email, password)
+
+    n = args.requests
+    # Requests are made outside of an app context, so each gets its own session like in production
+    with app.test_client() as client:
+        bench = Bench(app, client, query_counter)
+
+        # Signups, then the verification links they were sent
+        for i in range(n):
+            bench.request('POST /v1/user', 'POST', '/v1/user', 201, json={
+                'first_name': 'Bench', 'last_name': 'Signup', 'email': f"bench_signup{i}_{run_id}@example.com",
+                'password': password})
+        with app.app_context():
+            tokens = [token for (token,) in db.session.query(User.verification_token)
+                      .filter(User.email.like(f"bench_signup%_{run_id}@example.com"), User.is_verified.is_(False))]
+        for token in tokens:
+            bench.request('GET /v1/verify-email', 'GET', f"/v1/verify-email?token={token}", 200)
+
+        # Verification emails, published by the outbox dispatcher in batches
+        dispatcher = OutboxDispatcher(app, client_factory=StubSNS)
+        while bench.call('SNS outbox batch', dispatcher.drain_batch):
+            pass
+
+        headers = auth_headers(reader, password)
+        for _ in range(n):
+            bench.request('GET /v1/user/self', 'GET', '/v1/user/self', 200, headers=headers)
+        etag = client.get('/v1/user/self', headers=headers).headers['ETag']
+        for _ in range(n):
+            bench.request('GET /v1/user/self (If-None-Match)', 'GET', '/v1/user/self', 304,
+                          headers={**headers, 'If-None-Match': etag})
+
+        writer_headers = auth_headers(writer, password)
+        for i in range(n):
+            bench.request('PUT /v1/user/self', 'PUT', '/v1/user/self', 204, headers=writer_headers,
+                          json={'first_name': f"Bench{i}"})
+
+        # Profile pictures, in every upload mode, each upload followed by a delete
+        uploader_headers = auth_headers(uploader, password)
+        image = os.urandom(args.image_size)
+        for mode in ('buffered', 'stream', 'presigned'):
+            os.environ['IMAGE_UPLOAD_MODE'] = mode
+            for _ in range(n):
+                if mode == 'presigned':
+                    response = bench.request('POST /v1/user/self/pic [presigned]', 'POST', '/v1/user/self/pic', 200,
+                                             headers=uploader_headers, json={'file_name': 'pic.png'})
+                    file_name = response.get_json()['file_name']
+                    utils.s3.s3_client.objects[file_name] = image
+                    bench.request('POST /v1/user/self/pic/complete', 'POST', '/v1/user/self/pic/complete', 201,
+                                  headers=uploader_headers, json={'file_name': file_name})
+                else:
+                    bench.request(f"POST /v1/user/self/pic [{mode}]", 'POST', '/v1/user/self/pic', 201,
+                                  headers=uploader_headers, data={'file': (BytesIO(image), 'pic.png')},
+                                  content_type='multipart/form-data')
+                bench.request('GET /v1/user/self/pic', 'GET', '/v1/user/self/pic', 200, headers=uploader_headers)
+                bench.request('DELETE /v1/user/self/pic', 'DELETE', '/v1/user/self/pic', 204, headers=uploader_headers)
+        os.environ.pop('IMAGE_UPLOAD_MODE')
+
+        # Bulk imports of import_rows users per request
+        for i in range(max(1, n // 10)):
+            body = ''.join(json.dumps({'first_name': 'Bench', 'last_name': 'Import', 'password': password,
+                                       'email': f"bench_import{i}_{row}_{run_id}@example.com"}) + '\n'
+                           for row in range(args.import_rows))
+            bench.request(f"POST /v1/admin/users/import ({args.import_rows} rows)", 'POST', '/v1/admin/users/import',
+                          200, data=body, content_type='application/x-ndjson')
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.remove(engine, 'before_cursor_execute', count_query)
+        if args.testing == 'unit':
+            db.session.remove()
+            db.drop_all(bind_key=None)
+    return [stats.summary() for stats in bench.stats.values()]
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Print the change of each route against a previous run. Returns the routes that regressed
+def compare(results, baseline, threshold):
+    previous = {result['route']: result for result in baseline['results']}
+    regressions = []
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'}:")
+    for result in results:
+        before = previous.get(result['route'])
+        if before is None or not before['throughput_rps'] or not before['p95_ms']:
+            continue
+        throughput_change = (result['throughput_rps'] / before['throughput_rps'] - 1) * 100
+        p95_change = (result['p95_ms'] / before['p95_ms'] - 1) * 100
+        regressed = throughput_change < -threshold or p95_change > threshold
+        if regressed:
+            regressions.append(result['route'])
+        print(f"{result['route']:<48} throughput {throughput_change:+7.1f}%  p95 {p95_change:+7.1f}%"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput, latency and queries per request of the /v1 endpoints')
+    parser.add_argument('--testing', choices=['unit', 'integration'], default='unit')
+    parser.add_argument('--requests', type=int, default=100, help='requests per route')
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt work factor')
+    parser.add_argument('--image-size', type=int, default=64 * 1024, help='profile picture size in bytes')
+    parser.add_argument('--import-rows', type=int, default=100, help='users per bulk import request')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0, help='regression threshold in percent')
+    args = parser.parse_args()
+
+    results = run_suite(args)
+    report = {
+        'commit': current_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'testing': args.testing, 'requests': args.requests, 'bcrypt_rounds': args.rounds,
+                   'image_size': args.image_size, 'import_rows': args.import_rows},
+        'results': results,
+    }
+    print(f"{'route':<48} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'errors':>7}")
+    for result in results:
+        print(f"{result['route']:<48} {result['throughput_rps']:9.1f} {result['p50_ms']:8.2f} {result['p95_ms']:8.2f} "
+              f"{result['p99_ms']:8.2f} {result['queries_per_request']:8.1f} {result['errors']:7d}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+# HTTP load-test harness to compare serving modes.
+#
+# Start the app once per mode and point the harness at each of them, e.g.
+#   PORT=8081 python app/app.py                                           # Werkzeug dev server
+#   cd app && PORT=8082 gunicorn --config gunicorn.conf.py wsgi:app       # pre-fork gunicorn
+#   python benchmarks/load_test.py --target dev=http://127.0.0.1:8081 \
+#       --target gunicorn=http://127.0.0.1:8082 --path /healthz --concurrency 32 --duration 30
+#
+# Every client thread keeps one persistent connection open (like the ALB does) and
+# issues requests back to back. Reports throughput and latency percentiles per target.
+import argparse
+import base64
+import http.client
+import json
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def client_loop(base_url, path, headers, deadline, latencies, errors, lock):
+    parts = urlsplit(base_url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(parts.hostname, parts.port, timeout=30)
+    local_latencies = []
+    local_errors = 0
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 400:
+                local_errors += 1
+            if response.getheader('Connection', '').lower() == 'close':
+                connection.close()
+        except (OSError, http.client.HTTPException):
+            local_errors += 1
+            connection.close()
+        local_latencies.append(time.perf_counter() - start)
+    connection.close()
+    with lock:
+        latencies.extend(local_latencies)
+        errors.append(local_errors)
+
+
+def run_target(name, base_url, path, headers, concurrency, duration):
+    latencies, errors, lock = [], [], threading.Lock()
+    start = time.perf_counter()
+    deadline = start + duration
+    threads = [
+        threading.Thread(target=client_loop, args=(base_url, path, headers, deadline, latencies, errors, lock))
+        for _ in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'target': name,
+        'url': base_url + path,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': sum(errors),
+        'throughput_rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare throughput of webapp serving modes')
+    parser.add_argument('--target', action='append', required=True, help='name=base_url, may be repeated')
+    parser.add_argument('--path', default='/healthz')
+    parser.add_argument('--auth', help='email:password for Basic auth')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per target')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    headers = {}
+    if args.auth:
+        headers['Authorization'] = f"Basic {base64.b64encode(args.auth.encode()).decode()}"
+
+    results = []
+    for target in args.target:
+        name, base_url = target.split('=', 1)
+        result = run_target(name, base_url.rstrip('/'), args.path, headers, args.concurrency, args.duration)
+        results.append(result)
+        print(f"{name:>12}: {result['throughput_rps']:9.1f} req/s  p50 {result['p50_ms']:7.1f} ms  "
+              f"p95 {result['p95_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms  errors {result['errors']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,313 @@
+# Traffic replay from recorded request captures.
+#
+# Captures are JSON lines written by the app when REQUEST_CAPTURE_FILE is set (see
+# app/utils/request_capture.py), or derived from the Werkzeug access lines of an app log
+# with --from-log. They hold request metadata only, so the replay fills in credentials,
+# bodies and verification tokens, and reproduces the recorded outcome where it can: a
+# recorded 401 is replayed with a wrong password, a failed verification with an unknown
+# token, and so on. Each recorded user is mapped to a seeded user, so per-user sequences
+# such as upload, fetch and delete of a picture stay together.
+#
+# The captures are replayed over HTTP against a local create_app() instance, with S3 and
+# SNS stubbed, at the recorded pacing or --speed times faster (0 sends as fast as
+# possible) from --concurrency connections. Reports latency percentiles per route, how
+# late requests were sent compared to the recorded pacing, and error rates compared to
+# the recording.
+#
+#   python benchmarks/replay.py capture.jsonl --speed 10 --concurrency 16 --output replay.json
+#   python benchmarks/replay.py webapp.log --from-log --convert capture.jsonl
+#
+# With --testing unit the in-memory SQLite database has a single connection, so the
+# server handles one request at a time. Use --testing integration (PostgreSQL, DB_*
+# variables) to replay with real server-side concurrency. App logs go to stderr.
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../app/')))
+import argparse
+import base64
+import http.client
+import itertools
+import json
+import queue
+import threading
+import time
+import uuid
+from datetime import timedelta
+from load_test import percentile
+from endpoint_bench import BENCH_ENV, StubS3
+
+REPLAY_PASSWORD = 'replay-password'
+
+
+# Captures from a capture file, or from an app log, in recorded order
+def load_captures(path, from_log=False):
+    from utils.request_capture import captures_from_log
+    with open(path, encoding='utf-8') as f:
+        if from_log:
+            captures = list(captures_from_log(f))
+        else:
+            captures = [json.loads(line) for line in f if line.strip()]
+    captures.sort(key=lambda capture: capture['ts'])
+    return captures
+
+
+def route_of(capture):
+    return f"{capture['method']} {capture['path']}"
+
+
+def is_error(status):
+    return status is None or status >= 400
+
+
+def basic_auth(email, password):
+    return {'Authorization': f"Basic {base64.b64encode(f'{email}:{password}'.encode()).decode()}"}
+
+
+def multipart_body(field, file_name, content):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{file_name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+# Turns captures into requests: seeded users, verification tokens and request bodies
+class RequestBuilder:
+    def __init__(self, users, tokens, image_size):
+        self.users = users
+        self.tokens = iter(tokens)
+        self.image = os.urandom(image_size)
+        self.by_key = {}
+        self.round_robin = itertools.cycle(users)
+        self.counter = itertools.count()
+        self._lock = threading.Lock()
+
+    # The seeded user standing in for a recorded one. Captures derived from a log have no
+    # user, those are spread over all seeded users
+    def user_for(self, key):
+        with self._lock:
+            if key is None:
+                return next(self.round_robin)
+            if key not in self.by_key:
+                self.by_key[key] = self.users[len(self.by_key) % len(self.users)]
+            return self.by_key[key]
+
+    def build(self, capture):
+        method, path, status = capture['method'], capture['path'], capture.get('status')
+        query = capture.get('query') or ''
+        headers, body = {}, None
+        email = self.user_for(capture.get('user'))
+        with self._lock:
+            unique = next(self.counter)
+        # Failed authentication: a wrong password, or a user that does not exist
+        password = 'wrong-password' if status == 401 else REPLAY_PASSWORD
+        if status == 404 and capture.get('user') is None:
+            email = f"unknown_{unique}@example.com"
+
+        if (method, path) == ('POST', '/v1/user'):
+            # A failed signup is replayed as a duplicate
+            new_email = email if is_error(status) else f"replay_signup{unique}_{uuid.uuid4().hex[:8]}@example.com"
+            body = json.dumps({'first_name': 'Replay', 'last_name': 'Signup', 'email': new_email,
+                               'password': REPLAY_PASSWORD})
+            headers['Content-Type'] = 'application/json'
+        elif (method, path) == ('GET', '/v1/verify-email'):
+            token = next(self.tokens, None) if not is_error(status) else None
+            query = f"token={token or 'unknown'}"
+        elif (method, path) == ('POST', '/v1/admin/users/import'):
+            body = ''.join(json.dumps({'first_name': 'Replay', 'last_name': 'Import', 'password': REPLAY_PASSWORD,
+                                       'email': f"replay_import{unique}_{row}_{uuid.uuid4().hex[:8]}@example.com"}) + '\n'
+                           for row in range(10))
+            headers['Content-Type'] = 'application/x-ndjson'
+        elif path.startswith('/v1/user/self'):
+            headers.update(basic_auth(email, password))
+            if (method, path) == ('PUT', '/v1/user/self'):
+                body = json.dumps({'first_name': f"Replay{unique}"})
+                headers['Content-Type'] = 'application/json'
+            elif (method, path) == ('POST', '/v1/user/self/pic'):
+                body, headers['Content-Type'] = multipart_body('file', 'pic.png', self.image)
+            elif method == 'POST':
+                body = '{}'
+                headers['Content-Type'] = 'application/json'
+        target = f"{path}?{query}" if query else path
+        return method, target, headers, body.encode() if isinstance(body, str) else body
+
+
+# Serializes requests for the in-memory SQLite database, which has a single connection
+class SerializedApp:
+    def __init__(self, app):
+        self.app = app
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            return list(self.app(environ, start_response))
+
+
+# Seed the replay's users and start the app on a local port. Returns (server, users, tokens)
+def start_local_app(args, captures):
+    os.environ.update({key: os.environ.get(key, value) for key, value in BENCH_ENV.items()})
+    os.environ['BCRYPT_ROUNDS'] = str(args.rounds)
+    import bcrypt
+    import utils.s3
+    from werkzeug.serving import make_server
+    from app import create_app, db, User
+    from utils.models import utc_now
+
+    utils.s3.s3_client = StubS3()
+    app = create_app(testing=args.testing)
+    run_id = uuid.uuid4().hex[:8]
+    recorded_users = {capture['user'] for capture in captures if capture.get('user')}
+    user_count = max(len(recorded_users), args.users)
+    verifications = sum(1 for capture in captures
+                        if route_of(capture) == 'GET /v1/verify-email' and not is_error(capture.get('status')))
+    span = captures[-1]['ts'] - captures[0]['ts'] if captures else 0
+    hashed = bcrypt.hashpw(REPLAY_PASSWORD.encode('utf-8'), bcrypt.gensalt(args.rounds)).decode('utf-8')
+    users = [f"replay_user{i}_{run_id}@example.com" for i in range(user_count)]
+    tokens = [str(uuid.uuid4()) for _ in range(verifications)]
+    with app.app_context():
+        db.create_all(bind_key=None)
+        db.session.add_all(User(first_name='Replay', last_name='User', email=email, password=hashed,
+                                is_verified=True, verification_token=str(uuid.uuid4())) for email in users)
+        # Tokens are dated so they are still valid when the replay reaches them
+        valid_from = utc_now() + timedelta(seconds=span / args.speed if args.speed else 0)
+        db.session.add_all(User(first_name='Replay', last_name='Verify', email=f"replay_verify{i}_{run_id}@example.com",
+                                password=hashed, is_verified=False, verification_token=token,
+                                verification_token_created=valid_from) for i, token in enumerate(tokens))
+        db.session.commit()
+        db.session.remove()
+    wsgi_app = SerializedApp(app) if args.testing == 'unit' else app
+    server = make_server('127.0.0.1', 0, wsgi_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='replay-server', daemon=True).start()
+    return server, users, tokens
+
+
+def replay(captures, port, builder, speed, concurrency):
+    work = queue.Queue(maxsize=concurrency * 4)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        local = []
+        while True:
+            item = work.get()
+            if item is None:
+                break
+            capture, due = item
+            method, target, headers, body = builder.build(capture)
+            start = time.perf_counter()
+            try:
+                connection.request(method, target, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = None
+                connection.close()
+            local.append({'route': route_of(capture), 'recorded_status': capture.get('status'),
+                          'recorded_ms': capture.get('duration_ms'), 'status': status,
+                          'latency': time.perf_counter() - start, 'lag': max(0.0, start - due)})
+        connection.close()
+        with lock:
+            results.extend(local)
+
+    threads = [threading.Thread(target=worker, name=f"replay-{i}") for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    first_ts = captures[0]['ts'] if captures else 0
+    start = time.perf_counter()
+    for capture in captures:
+        due = start + (capture['ts'] - first_ts) / speed if speed else time.perf_counter()
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        work.put((capture, due))
+    for _ in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def summarize(results, elapsed):
+    by_route = {}
+    for result in results:
+        by_route.setdefault(result['route'], []).append(result)
+    routes = []
+    for route, items in sorted(by_route.items()):
+        latencies = sorted(item['latency'] for item in items)
+        recorded = sorted(item['recorded_ms'] for item in items if item['recorded_ms'] is not None)
+        recorded_errors = sum(1 for item in items if is_error(item['recorded_status'])) / len(items)
+        replay_errors = sum(1 for item in items if is_error(item['status'])) / len(items)
+        routes.append({
+            'route': route,
+            'requests': len(items),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+            'recorded_p50_ms': percentile(recorded, 50) if recorded else None,
+            'recorded_p95_ms': percentile(recorded, 95) if recorded else None,
+            'recorded_error_rate': recorded_errors,
+            'replay_error_rate': replay_errors,
+            'error_rate_difference': replay_errors - recorded_errors,
+            'status_mismatches': sum(1 for item in items if item['status'] != item['recorded_status']),
+        })
+    lags = sorted(result['lag'] for result in results)
+    return {
+        'requests': len(results),
+        'duration_s': elapsed,
+        'throughput_rps': len(results) / elapsed if elapsed else 0.0,
+        'lag_p50_ms': percentile(lags, 50) * 1000,
+        'lag_p95_ms': percentile(lags, 95) * 1000,
+        'routes': routes,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded requests against a local app instance')
+    parser.add_argument('capture', help='capture file, or app log with --from-log')
+    parser.add_argument('--from-log', action='store_true', help='derive captures from the access lines of an app log')
+    parser.add_argument('--convert', help='only write the captures to this file, do not replay')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay N times faster than recorded, 0 for no pacing')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--users', type=int, default=20, help='users to spread captures without a user over')
+    parser.add_argument('--testing', choices=['unit', 'integration'], default='unit')
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt work factor')
+    parser.add_argument('--image-size', type=int, default=64 * 1024, help='profile picture size in bytes')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    captures = load_captures(args.capture, from_log=args.from_log)
+    if args.convert:
+        with open(args.convert, 'w', encoding='utf-8') as f:
+            for capture in captures:
+                f.write(json.dumps(capture) + '\n')
+        print(f"{len(captures)} captures written to {args.convert}")
+        return
+    if not captures:
+        sys.exit('No captures to replay')
+
+    server, users, tokens = start_local_app(args, captures)
+    try:
+        results, elapsed = replay(captures, server.server_port, RequestBuilder(users, tokens, args.image_size),
+                                  args.speed, args.concurrency)
+    finally:
+        server.shutdown()
+    report = summarize(results, elapsed)
+    report['config'] = {'capture': args.capture, 'speed': args.speed, 'concurrency': args.concurrency,
+                        'testing': args.testing, 'bcrypt_rounds': args.rounds}
+
+    print(f"{report['requests']} requests in {report['duration_s']:.1f}s ({report['throughput_rps']:.1f} req/s), "
+          f"sent late by p50 {report['lag_p50_ms']:.1f} ms / p95 {report['lag_p95_ms']:.1f} ms")
+    print(f"{'route':<36} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rec err':>8} {'err':>6} {'mismatch':>9}")
+    for route in report['routes']:
+        print(f"{route['route']:<36} {route['requests']:6d} {route['p50_ms']:8.2f} {route['p95_ms']:8.2f} "
+              f"{route['p99_ms']:8.2f} {route['recorded_error_rate']:8.1%} {route['replay_error_rate']:6.1%} "
+              f"{route['status_mismatches']:9d}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,13 +5,80 @@ import bcrypt
 from faker import Faker
 import base64
 import random
+import uuid
 import pytest
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from app import create_app, db, User
+from app import create_app, db, User, Image
+from sqlalchemy import event
+from io import BytesIO, StringIO
+import utils.s3
+from utils.s3 import PresignedUrlCache, create_presigned_upload
+from botocore.exceptions import ClientError
+from email_validator import EmailNotValidError
+from utils.email_validation import SignupEmailValidator
+from types import SimpleNamespace
+import dns.resolver
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import text
+from utils.migrations import run_migrations, MIGRATIONS
+from utils.auth_cache import AuthCache
+from utils.passwords import PasswordHasher, PasswordHasherSaturated
+from utils.models import OutboxMessage
+from utils.sns_outbox import OutboxDispatcher, enqueue_verification
+from utils.db_routing import REPLICA_BIND_KEY, sticky_writes, replica_status
+from sqlalchemy.orm import Session
+from utils.log_pipeline import SamplingFilter, JsonFormatter, NonBlockingQueueHandler, BatchingQueueListener
+from utils.log_pipeline import configure_logging, UNSAMPLED
+import logging
+import queue
+import socket
+from utils.metrics import Metrics
+from utils.latency import LatencyHistogram, latency
+from utils.health import HealthMonitor
+import utils.health
+from utils.db_pool import get_engine_options, register_failover_handler, register_pool_metrics, READ_ONLY_SQL_TRANSACTION
+from utils.db_pool import TimedQueuePool
+import utils.db_pool
+from sqlalchemy.exc import TimeoutError as SQLAlchemyTimeoutError
+from sqlalchemy.exc import DBAPIError
+import sqlite3
+from app import response_cache, user_cache
+from utils.user_cache import UserCache, MemorySharedCache, snapshot, dump_snapshot, load_snapshot, create_user_cache
+from utils.request_capture import RequestCapture, captures_from_log, create_request_capture
+from utils.profiling import StackSampler
+from utils.tracing import tracer, BatchSpanExporter, TraceContextFilter, parse_trace_header, to_otlp
+import boto3
+from utils.query_stats import fingerprint
+from utils.models import utc_now, VERIFICATION_TOKEN_TTL, db_now_minus, to_est_isoformat, to_est_date
+import utils.models
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update, create_engine
+from sqlalchemy.dialects import postgresql
+import pstats
+import threading
+import time
 
 fake = Faker()
 
 
+# Local stand-in for the SNS client, records every PublishBatch call
+class StubSNS:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def publish_batch(self, TopicArn, PublishBatchRequestEntries):
+        self.batches.append(PublishBatchRequestEntries)
+        if self.fail:
+            return {'Successful': [], 'Failed': [
+                {'Id': entry['Id'], 'Code': 'InternalError', 'Message': 'stub failure', 'SenderFault': False}
+                for entry in PublishBatchRequestEntries
+            ]}
+        return {'Successful': [
+            {'Id': entry['Id'], 'MessageId': str(uuid.uuid4())} for entry in PublishBatchRequestEntries
+        ], 'Failed': []}
+
+
 @pytest.fixture(scope="module")
 def client():
     app = create_app(testing="unit")
@@ -23,7 +90,7 @@ def client():
             yield client
 
         db.session.remove()
-        db.drop_all()
+        db.drop_all(bind_key=None)
 
 
 print("\n--- Starting All Endpoint Tests ---")
@@ -46,6 +113,30 @@ update_data = {
 }
 
 
+# Basic auth headers for an email and password
+def basic_auth(email, password):
+    auth_string = base64.b64encode(f"{email}:{password}".encode()).decode()
+    return {'Authorization': f"Basic {auth_string}"}
+
+
+# Add a verified user with a random password. Returns the user, the password and the
+# headers to authenticate as them
+def create_verified_user(prefix, **fields):
+    password = fake.password()
+    user = User(
+        first_name=fake.first_name(),
+        last_name=fake.last_name(),
+        email=f"{prefix}_{local_part}@{domain}",
+        password=bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(4)).decode('utf-8'),
+        verification_token=str(uuid.uuid4()),
+        is_verified=True,
+        **fields
+    )
+    db.session.add(user)
+    db.session.commit()
+    return user, password, basic_auth(user.email, password)
+
+
 def test_health_endpoint(client):
     try:
         print("\n1. Testing Health Check")
@@ -233,4 +324,1300 @@ def test_get_request_with_body(client):
         print(f"Failed to verify requests with body: {e}")
 
 
+def test_auth_cache():
+    print("\n15. Testing Auth Cache TTL, LRU Eviction and Invalidation")
+    cache = AuthCache(ttl=60, max_size=2)
+    cache.add('a@gmail.com', 'password-a', 'hash-a')
+    cache.add('b@gmail.com', 'password-b', 'hash-b')
+    assert cache.get('a@gmail.com', 'password-a', 'hash-a')
+    assert not cache.get('a@gmail.com', 'wrong-password', 'hash-a')
+    # A changed stored hash misses the cache, wherever the password was changed
+    assert not cache.get('a@gmail.com', 'password-a', 'new-hash-a')
+    # 'b' is now least recently used and gets evicted
+    cache.add('c@gmail.com', 'password-c', 'hash-c')
+    assert not cache.get('b@gmail.com', 'password-b', 'hash-b')
+    assert cache.get('c@gmail.com', 'password-c', 'hash-c')
+    cache.invalidate('a@gmail.com')
+    assert not cache.get('a@gmail.com', 'password-a', 'hash-a')
+    expired_cache = AuthCache(ttl=-1)
+    expired_cache.add('a@gmail.com', 'password-a', 'hash-a')
+    assert not expired_cache.get('a@gmail.com', 'password-a', 'hash-a')
+    print("Auth cache behaves as expected")
+
+
+def test_single_user_lookup_per_request(client):
+    print("\n16. Testing Single DB Round Trip per Authenticated Request")
+    user, password, headers = create_verified_user('lookup')
+    db.session.add(Image(file_name='pic.png', url='bucket/pic.png', user_id=user.id))
+    db.session.commit()
+    db.session.expire_all()
+
+    statements = []
+
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count_query)
+    try:
+        for path in ('/v1/user/self', '/v1/user/self/pic'):
+            # Counts the lookup itself, not a user cache hit
+            user_cache.clear()
+            statements.clear()
+            response = client.get(path, headers=headers)
+            assert response.status_code == 200
+            assert len(statements) == 1, f"{path} ran {len(statements)} queries"
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_query)
+    print("Authenticated requests use a single query")
+
+
+def test_password_hasher_pool():
+    print("\n17. Testing Bounded Password Hashing Pool")
+    hasher = PasswordHasher(mode='thread', workers=1, max_queue=1, rounds=4)
+    hashed = hasher.hash('password-a')
+    assert hashed.startswith('$2b$04$')
+    assert hasher.check('password-a', hashed)
+    assert not hasher.check('password-b', hashed)
+    # Occupy the only slot, the next caller must be shed instead of queued
+    hasher._slots.acquire()
+    with pytest.raises(PasswordHasherSaturated):
+        hasher.hash('password-a')
+    hasher._slots.release()
+    hasher.shutdown()
+    print("Password hashing pool behaves as expected")
+
+
+def test_sns_outbox_dispatch(client):
+    print("\n18. Testing SNS Outbox Dispatch")
+    user = User(
+        first_name=fake.first_name(),
+        last_name=fake.last_name(),
+        email=f"outbox_{local_part}@{domain}",
+        password='not-a-real-hash',
+        verification_token=str(uuid.uuid4()),
+        verification_email_count=0
+    )
+    db.session.add(user)
+    db.session.flush()
+    message = enqueue_verification(user, 'http://localhost/v1/verify-email?token=abc')
+    db.session.commit()
+
+    failing_sns = StubSNS(fail=True)
+    OutboxDispatcher(client.application, client_factory=lambda: failing_sns).drain()
+    db.session.expire_all()
+    assert len(failing_sns.batches) == 1
+    assert message.sent_at is None
+    assert message.attempts == 1
+    assert user.verification_email_count == 0
+
+    # Make the failed message due again and publish it for real
+    message.next_attempt_at = message.created_at
+    db.session.commit()
+    sns = StubSNS()
+    OutboxDispatcher(client.application, client_factory=lambda: sns).drain()
+    db.session.expire_all()
+    assert json.loads(sns.batches[0][0]['Message'])['email'] == user.email
+    assert message.sent_at is not None
+    assert user.verification_email_count == 1
+    assert OutboxMessage.query.filter_by(sent_at=None).count() == 0
+    print("Outbox messages published in batches with retries")
+
+
+# Local stand-in for the S3 client's multipart upload calls
+class StubS3:
+    def __init__(self):
+        self.parts = {}
+        self.completed = {}
+        self.aborted = []
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': f"upload-{Key}"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts[(Key, PartNumber)] = Body
+        return {'ETag': f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed[Key] = b''.join(self.parts[(Key, part['PartNumber'])] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+
+    def generate_presigned_post(self, Bucket, Key, Fields, Conditions, ExpiresIn):
+        self.post_conditions = Conditions
+        return {'url': f"https://{Bucket}.s3.local/", 'fields': dict(Fields, key=Key, policy='stub-policy')}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        self.signed_urls = getattr(self, 'signed_urls', 0) + 1
+        return f"https://{Params['Bucket']}.s3.local/{Params['Key']}?signature={self.signed_urls}"
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.completed:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+        return {'ContentLength': len(self.completed[Key])}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self.completed[Key] = Fileobj.read()
+
+    def delete_object(self, Bucket, Key):
+        self.completed.pop(Key, None)
+
+
+def test_streamed_profile_picture_upload(client, monkeypatch):
+    print("\n19. Testing Streamed Profile Picture Upload")
+    stub_s3 = StubS3()
+    monkeypatch.setattr(utils.s3, 's3_client', stub_s3)
+    monkeypatch.setenv('IMAGE_UPLOAD_MODE', 'stream')
+    monkeypatch.setenv('S3_UPLOAD_MAX_SIZE', str(8 * 1024 * 1024))
+    user, password, headers = create_verified_user('stream')
+
+    # Bigger than one part, so it is uploaded in two
+    image = os.urandom(6 * 1024 * 1024)
+    response = client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                           data={'file': (BytesIO(image), 'pic.png')})
+    assert response.status_code == 201
+    file_name = json.loads(response.data)['file_name']
+    assert stub_s3.completed[file_name] == image
+    assert len([key for key in stub_s3.parts if key[0] == file_name]) == 2
+
+    db.session.delete(Image.query.filter_by(user_id=user.id).first())
+    db.session.commit()
+    response = client.post('/v1/user/self/pic', headers=headers, content_type='multipart/form-data',
+                           data={'file': (BytesIO(os.urandom(9 * 1024 * 1024)), 'big.png')})
+    assert response.status_code == 413
+    print("Profile picture streamed to S3 in parts")
+
+
+def test_presigned_profile_picture_flow(client, monkeypatch):
+    print("\n20. Testing Presigned Profile Picture Upload and Download")
+    stub_s3 = StubS3()
+    monkeypatch.setattr(utils.s3, 's3_client', stub_s3)
+    monkeypatch.setenv('IMAGE_UPLOAD_MODE', 'presigned')
+    monkeypatch.setenv('AWS_S3_BUCKET', 'webapp-bucket')
+    user, password, headers = create_verified_user('presigned')
+
+    response = client.post('/v1/user/self/pic', headers=headers, json={'file_name': 'pic.png'})
+    assert response.status_code == 200
+    file_name = json.loads(response.data)['file_name']
+    assert json.loads(response.data)['upload_fields']['key'] == file_name
+
+    # Completing before the client uploaded anything must fail
+    response = client.post('/v1/user/self/pic/complete', headers=headers, json={'file_name': file_name})
+    assert response.status_code == 400
+    # Simulate the client's direct upload to S3
+    stub_s3.completed[file_name] = b'image-bytes'
+    response = client.post('/v1/user/self/pic/complete', headers=headers, json={'file_name': file_name})
+    assert response.status_code == 201
+
+    first = json.loads(client.get('/v1/user/self/pic', headers=headers).data)['download_url']
+    second = json.loads(client.get('/v1/user/self/pic', headers=headers).data)['download_url']
+    assert file_name in first
+    assert first == second
+    print("Presigned upload recorded and download URL cached")
+
+
+# Local stand-in for a DNS resolver, counts lookups per domain
+class StubResolver:
+    def __init__(self):
+        self.lookups = []
+
+    def resolve(self, domain, record_type):
+        self.lookups.append(domain)
+        if domain == 'no-such-domain.com':
+            raise dns.resolver.NXDOMAIN()
+        return [SimpleNamespace(preference=10, exchange=f"mx.{domain}.")]
+
+
+def test_email_deliverability_cache():
+    print("\n21. Testing Cached Email Deliverability Checks")
+    resolver = StubResolver()
+    validator = SignupEmailValidator(mode='sync', dns_resolver=resolver)
+    validator.validate('first@gmail.com')
+    validator.validate('second@gmail.com')
+    assert resolver.lookups == ['gmail.com']
+    # Undeliverable domains are remembered as well
+    for _ in range(2):
+        with pytest.raises(EmailNotValidError):
+            validator.validate('someone@no-such-domain.com')
+    assert resolver.lookups == ['gmail.com', 'no-such-domain.com']
+    # Syntax errors never reach the resolver
+    with pytest.raises(EmailNotValidError):
+        SignupEmailValidator(mode='off', dns_resolver=resolver).validate('not-an-email')
+    assert len(resolver.lookups) == 2
+    print("Deliverability results cached per domain")
+
+
+def test_schema_constraints_and_migrations(client):
+    print("\n22. Testing Image Uniqueness Constraint and Migrations")
+    user = User(
+        first_name=fake.first_name(),
+        last_name=fake.last_name(),
+        email=f"constraint_{local_part}@{domain}",
+        password='not-a-real-hash',
+        verification_token=str(uuid.uuid4())
+    )
+    db.session.add(user)
+    db.session.commit()
+    db.session.add(Image(file_name='first.png', url='bucket/first.png', user_id=user.id))
+    db.session.commit()
+    db.session.add(Image(file_name='second.png', url='bucket/second.png', user_id=user.id))
+    with pytest.raises(IntegrityError):
+        db.session.commit()
+    db.session.rollback()
+
+    # Migrations are recorded once and are safe to run again
+    assert run_migrations(db.engine)
+    assert run_migrations(db.engine)
+    with db.engine.connect() as conn:
+        versions = [row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))]
+    assert sorted(versions) == [version for version, _ in MIGRATIONS]
+    print("Image uniqueness enforced and migrations applied")
+
+
+def test_read_replica_routing(monkeypatch, tmp_path):
+    print("\n23. Testing Read Replica Routing and Read-Your-Writes")
+    # Two SQLite databases stand in for the primary and the replica. Nothing replicates
+    # between them, so the first name shows which one a read went to
+    monkeypatch.setenv('DB_REPLICA_URI', f"sqlite:///{tmp_path / 'replica.db'}")
+    app = create_app(testing="unit")
+    app.config['TESTING'] = True
+    password = fake.password()
+    user_id = uuid.uuid4()
+    row = {
+        'id': user_id,
+        'last_name': fake.last_name(),
+        'email': f"replica_{local_part}@{domain}",
+        'password': bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(4)).decode('utf-8'),
+        'verification_token': str(uuid.uuid4()),
+        'is_verified': True
+    }
+    headers = basic_auth(row['email'], password)
+    with app.app_context():
+        db.create_all()
+        db.metadata.create_all(db.engines[REPLICA_BIND_KEY])
+        db.session.add(User(first_name='Primary', **row))
+        db.session.commit()
+        with Session(db.engines[REPLICA_BIND_KEY]) as session:
+            session.add(User(first_name='Replica', **row))
+            session.commit()
+    sticky_writes.clear()
+
+    # Each request gets its own app context and session, like in production
+    with app.test_client() as replica_client:
+        # Reads and the auth lookup go to the replica
+        response = replica_client.get('/v1/user/self', headers=headers)
+        assert response.status_code == 200
+        assert json.loads(response.data)['first_name'] == 'Replica'
+
+        # Writes go to the primary, and the writer reads from the primary for a while
+        response = replica_client.put('/v1/user/self', json={'first_name': 'Updated'}, headers=headers)
+        assert response.status_code == 204
+        response = replica_client.get('/v1/user/self', headers=headers)
+        assert json.loads(response.data)['first_name'] == 'Updated'
+
+        # Once the window has passed, reads are back on the replica.
+        # The user cache keeps copies for about as long, so it is cleared as well
+        sticky_writes.clear()
+        user_cache.clear()
+        response = replica_client.get('/v1/user/self', headers=headers)
+        assert json.loads(response.data)['first_name'] == 'Replica'
+
+    with app.app_context():
+        assert db.session.get(User, user_id).first_name == 'Updated'
+        db.session.remove()
+        db.drop_all(bind_key=None)
+        db.engines[REPLICA_BIND_KEY].dispose()
+    print("Reads routed to the replica, writes and recent writers to the primary")
+
+
+def test_async_logging_pipeline():
+    print("\n24. Testing Asynchronous Logging Pipeline")
+    output = StringIO()
+    stream_handler = logging.StreamHandler(output)
+    stream_handler.setFormatter(JsonFormatter())
+    queue_handler = NonBlockingQueueHandler(queue.Queue(100))
+    sampler = SamplingFilter(burst=3, window=60)
+    queue_handler.addFilter(sampler)
+    listener = BatchingQueueListener(queue_handler.queue, [stream_handler], batch_size=10, flush_interval=0.05)
+    logger = logging.getLogger('tests.async_logging')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(queue_handler)
+    try:
+        listener.start()
+        for attempt in range(10):
+            logger.error("Error in creating user: %s", attempt)
+        logger.info("Request served")
+        # A new window lets the template through again, with the count of what was dropped
+        sampler.window = 0
+        logger.error("Error in creating user: %s", 'again')
+        listener.stop()
+    finally:
+        logger.removeHandler(queue_handler)
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line['message'] for line in lines] == [
+        'Error in creating user: 0', 'Error in creating user: 1', 'Error in creating user: 2',
+        'Request served', 'Error in creating user: again'
+    ]
+    assert lines[-1]['suppressed'] == 7
+    assert lines[0]['level'] == 'ERROR'
+
+    # A full queue drops records instead of blocking the request thread
+    full_handler = NonBlockingQueueHandler(queue.Queue(1))
+    full_handler.handle(logging.makeLogRecord({'msg': 'first'}))
+    full_handler.handle(logging.makeLogRecord({'msg': 'second'}))
+    assert full_handler.dropped == 1
+    print("Logs written in batches as sampled JSON lines")
+
+
+def test_metrics_aggregation():
+    print("\n25. Testing Buffered StatsD Metrics with Tags")
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(1)
+    try:
+        client_metrics = Metrics(host='127.0.0.1', port=receiver.getsockname()[1], max_timer_samples=5)
+        tags = {'endpoint': 'get_user_info', 'method': 'GET', 'status': 200}
+        for _ in range(500):
+            client_metrics.incr('api.requests', tags=tags)
+        for duration in range(20):
+            client_metrics.timing('api.duration', duration, tags=tags)
+        client_metrics.gauge('database.pool.checked_out', 3)
+        # Everything fits in a single datagram
+        assert client_metrics.flush() == 1
+        lines = receiver.recv(65535).decode().splitlines()
+    finally:
+        receiver.close()
+    assert 'api.requests:500|c|#endpoint:get_user_info,method:GET,status:200' in lines
+    assert 'database.pool.checked_out:3|g' in lines
+    # Timers beyond the sample cap are sampled and sent with the matching rate
+    timer_lines = [line for line in lines if line.startswith('api.duration:')]
+    assert len(timer_lines) == 5
+    assert all('|ms|@0.250000|#endpoint:get_user_info' in line for line in timer_lines)
+    assert client_metrics.flush() == 0
+
+    graphite_metrics = Metrics(tag_format='name')
+    graphite_metrics.incr('api.requests', tags={'endpoint': 'health_check', 'method': 'GET'})
+    assert graphite_metrics.collect() == ['api.requests.health_check.GET:1|c']
+    print("Metrics aggregated, tagged and sent in batches")
+
+
+def test_latency_histograms_and_metrics_endpoint(client, monkeypatch):
+    print("\n26. Testing Latency Histograms and /metrics Endpoint")
+    histogram = LatencyHistogram()
+    for millis in range(1, 1001):
+        histogram.record(millis / 1000)
+    assert abs(histogram.quantile(0.5) - 0.5) / 0.5 < 0.035
+    assert abs(histogram.quantile(0.99) - 0.99) / 0.99 < 0.035
+    assert histogram.quantile(1) == histogram.max == 1.0
+
+    latency.clear()
+    assert client.get('/healthz').status_code == 200
+    assert client.get('/v1/verify-email?token=unknown').status_code == 404
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain')
+    body = response.data.decode()
+    assert '# TYPE webapp_request_duration_seconds summary' in body
+    assert 'webapp_request_duration_seconds_count{endpoint="health_check",method="GET"} 1' in body
+    assert 'webapp_request_duration_seconds{endpoint="health_check",method="GET",quantile="0.99"}' in body
+    assert 'webapp_request_phase_duration_seconds_count{endpoint="verify_email",phase="db"} 1' in body
+
+    # Requests through the load balancer need the token
+    assert client.get('/metrics', headers={'X-Forwarded-For': '203.0.113.7'}).status_code == 404
+    monkeypatch.setenv('METRICS_TOKEN', 'scrape-secret')
+    headers = {'X-Forwarded-For': '203.0.113.7', 'Authorization': 'Bearer scrape-secret'}
+    assert client.get('/metrics', headers=headers).status_code == 200
+    headers['Authorization'] = 'Bearer wrong'
+    assert client.get('/metrics', headers=headers).status_code == 404
+    print("Latency histograms exported in the Prometheus format")
+
+
+def test_tiered_health_checks(client):
+    print("\n27. Testing Cached Readiness and Deep Health Checks")
+    calls = []
+
+    def database():
+        calls.append('database')
+
+    def slow_sns():
+        time.sleep(1)
+
+    def failing_s3():
+        raise RuntimeError('bucket unreachable')
+
+    monitor = HealthMonitor({'database': database}, {'s3': failing_s3, 'sns': slow_sns},
+                            interval=5, deep_timeout=0.2)
+    # The readiness probe result is reused while it is fresh
+    assert monitor.is_ready() and monitor.is_ready()
+    assert calls == ['database']
+    assert monitor.deep_status() == {'database': 'ok', 's3': 'failing', 'sns': 'timeout'}
+
+    assert client.get('/livez').status_code == 200
+    assert client.get('/healthz').status_code == 200
+    response = client.get('/healthz/deep')
+    assert response.status_code == 200
+    assert json.loads(response.data)['database'] == 'ok'
+    # Header and body validation still applies
+    assert client.get('/healthz', headers={'Extra-Header': 'value'}).status_code == 400
+    assert client.get('/livez', data='body').status_code == 400
+    print("Health checks answered from cached probe results")
+
+
+def test_request_validation_middleware(client):
+    print("\n28. Testing Request Validation Middleware")
+    # Header names are compared case-insensitively, as HTTP/2 sends them in lowercase
+    headers = {'x-amzn-requestid': 'abc', 'x-forwarded-for': '203.0.113.7', 'accept': '*/*'}
+    assert client.get('/livez', headers=headers).status_code == 200
+    response = client.get('/livez', headers={'X-Unknown-Header': 'value'})
+    assert response.status_code == 400
+    assert b'Bad Request' in response.data
+    assert client.get('/livez?verbose=1').status_code == 400
+    response = client.get('/livez', data='body')
+    assert response.status_code == 400
+    assert b'GET requests should not contain a body' in response.data
+    # Validation runs before authentication
+    assert client.get('/v1/user/self', headers={'X-Unknown-Header': 'value'}).status_code == 400
+    # Routes can relax the rules: the verification link takes a token and any browser headers
+    response = client.get('/v1/verify-email?token=unknown', headers={'Upgrade-Insecure-Requests': '1'})
+    assert response.status_code == 404
+    # Unknown paths are still answered by the 404 handler
+    assert client.get('/livez/v1', headers={'X-Unknown-Header': 'value'}).status_code == 404
+    print("Requests validated before dispatch")
+
+
+def test_conditional_get_and_response_cache(client, monkeypatch):
+    print("\n29. Testing ETags, Conditional GET and the Response Cache")
+    stub_s3 = StubS3()
+    monkeypatch.setattr(utils.s3, 's3_client', stub_s3)
+    monkeypatch.setenv('IMAGE_UPLOAD_MODE', 'buffered')
+    monkeypatch.setenv('AWS_S3_BUCKET', 'webapp-bucket')
+    user, password, headers = create_verified_user('etag')
+
+    response = client.get('/v1/user/self', headers=headers)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['Cache-Control'] == 'no-cache'
+    # A client that has the current version gets an empty 304
+    response = client.get('/v1/user/self', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+    # Repeat requests are served from the cached body
+    body = client.get('/v1/user/self', headers=headers).data
+    assert response_cache.get(user.id, 'user', etag.strip('"')) == body
+
+    # An update invalidates the cached response and changes the ETag
+    assert client.put('/v1/user/self', headers=headers, json={'first_name': 'Updated'}).status_code == 204
+    assert response_cache.get(user.id, 'user', etag.strip('"')) is None
+    response = client.get('/v1/user/self', headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert json.loads(response.data)['first_name'] == 'Updated'
+
+    # Image metadata: versioned by the image id, invalidated by the upload and the delete
+    assert client.get('/v1/user/self/pic', headers=headers).status_code == 404
+    data = {'file': (BytesIO(b'image-bytes'), 'pic.png')}
+    assert client.post('/v1/user/self/pic', headers=headers, data=data).status_code == 201
+    response = client.get('/v1/user/self/pic', headers=headers)
+    assert response.status_code == 200
+    image_etag = response.headers['ETag']
+    response = client.get('/v1/user/self/pic', headers={**headers, 'If-None-Match': image_etag})
+    assert response.status_code == 304
+    assert client.delete('/v1/user/self/pic', headers=headers).status_code == 204
+    assert response_cache.get(user.id, 'image', image_etag.strip('"')) is None
+    response = client.get('/v1/user/self/pic', headers={**headers, 'If-None-Match': image_etag})
+    assert response.status_code == 404
+    print("Unchanged metadata answered with 304 and cached bodies invalidated on writes")
+
+
+def test_two_level_user_cache(client):
+    print("\n30. Testing Two-Level User Cache Across Instances")
+    user, password, headers = create_verified_user('shared')
+    db.session.add(Image(file_name='pic.png', url='bucket/pic.png', user_id=user.id))
+    db.session.commit()
+    record = snapshot(user)
+    assert load_snapshot(dump_snapshot(record)) == record
+
+    loads = []
+
+    def loader(email):
+        loads.append(email)
+        return User.query.filter_by(email=email).first()
+
+    # Two instances sharing one cache
+    shared = MemorySharedCache()
+    instance_a = UserCache(ttl=60, shared=shared, fill_delay=0)
+    instance_b = UserCache(ttl=60, shared=shared, fill_delay=0)
+    instance_a.start()
+    instance_b.start()
+    try:
+        assert instance_a.get_user(user.email, loader).id == user.id
+        # The other instance finds the record in the shared cache, then in its own
+        statements = []
+
+        def count_query(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count_query)
+        try:
+            for _ in range(2):
+                cached = instance_b.get_user(user.email, loader)
+                assert cached.images[0].file_name == 'pic.png'
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_query)
+        assert statements == []
+        assert len(loads) == 1
+
+        # A write on one instance drops the copies everywhere and bumps the version
+        instance_a.invalidate(user.email)
+        assert len(instance_b) == 0
+        instance_b.get_user(user.email, loader)
+        assert len(loads) == 2
+        instance_a.get_user(user.email, loader)
+        assert len(loads) == 2
+
+        # Right after a write, records are not cached while replicas may lag
+        lagging = UserCache(ttl=60, shared=shared, fill_delay=60)
+        instance_a.invalidate(user.email)
+        lagging.get_user(user.email, loader)
+        lagging.get_user(user.email, loader)
+        assert len(loads) == 4
+    finally:
+        instance_a.stop()
+        instance_b.stop()
+    print("User records shared between instances and invalidated on writes")
+
+
+def test_bulk_user_import(client, monkeypatch):
+    print("\n31. Testing Bulk User Import Endpoint and CLI")
+    importer = client.application.extensions['bulk_import']
+    monkeypatch.setattr(importer, 'email_validator', SignupEmailValidator(mode='off'))
+    monkeypatch.setattr(importer, 'password_hasher', PasswordHasher(mode='thread', workers=2, rounds=4))
+    monkeypatch.setattr(importer, 'chunk_size', 2)
+    existing = User.query.filter_by(is_verified=True).first()
+    rows = [
+        {'first_name': 'Bulk', 'last_name': 'One', 'email': f"bulk1_{local_part}@{domain}", 'password': 'secret1'},
+        {'first_name': 'Bulk', 'last_name': 'Two', 'email': f"bulk2_{local_part}@{domain}", 'password': 'abc'},
+        {'first_name': 'Bulk', 'last_name': 'Three', 'email': existing.email, 'password': 'secret3'},
+        {'first_name': 'Bulk', 'last_name': 'Four', 'email': f"bulk1_{local_part}@{domain}", 'password': 'secret4'},
+    ]
+    body = '\n'.join(json.dumps(row) for row in rows) + '\nnot json\n'
+    outbox_before = OutboxMessage.query.count()
+    response = client.post('/v1/admin/users/import', data=body, content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    results = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [result['status'] for result in results] == [201, 400, 400, 400, 400]
+    assert [result['line'] for result in results] == [1, 2, 3, 4, 5]
+    assert results[2]['message'] == 'User already exists!'
+    assert results[3]['message'] == 'Duplicate email in import'
+    created = db.session.get(User, uuid.UUID(results[0]['id']))
+    assert created.email == rows[0]['email'] and not created.is_verified
+    assert bcrypt.checkpw(b'secret1', created.password.encode('utf-8'))
+    # The verification email is queued in the outbox like for a single signup
+    assert OutboxMessage.query.count() == outbox_before + 1
+
+    # Only served locally or with the admin token
+    response = client.post('/v1/admin/users/import', data=body, headers={'X-Forwarded-For': '203.0.113.7'})
+    assert response.status_code == 404
+
+    # The same import from a CSV file on the command line
+    csv_file = StringIO("first_name,last_name,email,password\n"
+                        f"Bulk,Five,bulk5_{local_part}@{domain},secret5\n"
+                        f"Bulk,Six,bulk6_{local_part}@{domain},secret6\n"
+                        f"Bulk,Seven,bulk7_{local_part}@{domain},secret7\n")
+    result = client.application.test_cli_runner().invoke(args=['import-users', '--format', 'csv', '-'], input=csv_file.getvalue())
+    assert result.exit_code == 0, result.output
+    assert '3 users created, 0 rows failed' in result.output
+    assert User.query.filter_by(email=f"bulk7_{local_part}@{domain}").count() == 1
+    print("Users imported in chunks with a result per row")
+
+
+def test_request_capture(monkeypatch, tmp_path):
+    print("\n32. Testing Request Capture for Replays")
+    capture_file = tmp_path / 'capture.jsonl'
+    monkeypatch.setenv('REQUEST_CAPTURE_FILE', str(capture_file))
+    monkeypatch.setenv('REQUEST_CAPTURE_SECRET', 'shared-secret')
+    app = create_app(testing="unit")
+    with app.test_client() as capture_client:
+        assert capture_client.get('/livez').status_code == 200
+        assert capture_client.get('/livez?token=secret-value').status_code == 400
+    captures = [json.loads(line) for line in capture_file.read_text().splitlines()]
+    assert [(capture['method'], capture['path'], capture['status']) for capture in captures] == [
+        ('GET', '/livez', 200), ('GET', '/livez', 400)]
+    # Parameter values such as verification tokens are never written out
+    assert captures[1]['query'] == 'token='
+    assert 'secret-value' not in capture_file.read_text()
+    assert captures[0]['duration_ms'] >= 0 and captures[0]['user'] is None
+    # Users are pseudonymous but stable
+    capture = RequestCapture(str(capture_file), secret=b'shared-secret')
+    assert capture.user_key('a@example.com') == capture.user_key('a@example.com') != capture.user_key('b@example.com')
+    assert 'a@example.com' not in capture.user_key('a@example.com')
+
+    # Captures derived from the access lines of text and JSON app logs
+    log_lines = [
+        '2026-10-18 04:37:08,824 - root - INFO - User info fetched successfully!',
+        '2026-10-18 04:37:08,825 - werkzeug - INFO - 127.0.0.1 - - [18/Oct/2026 04:37:08] "GET /v1/user/self HTTP/1.1" 200 -',
+        json.dumps({'timestamp': '2026-10-18 04:37:09,125', 'level': 'INFO', 'logger': 'werkzeug',
+                    'message': '127.0.0.1 - - [18/Oct/2026 04:37:09] "GET /v1/verify-email?token=abc HTTP/1.1" 404 -'}),
+    ]
+    derived = list(captures_from_log(log_lines))
+    assert [(capture['method'], capture['path'], capture['query'], capture['status']) for capture in derived] == [
+        ('GET', '/v1/user/self', '', 200), ('GET', '/v1/verify-email', 'token=', 404)]
+    assert round(derived[1]['ts'] - derived[0]['ts'], 3) == 0.3
+    print("Request metadata captured without credentials or tokens")
+
+
+# Test the stack sampler and per-request cProfile dumps
+def test_profiling(monkeypatch, tmp_path):
+    print("\n33. Testing Sampling Profiler and Request Profiles")
+    # Only threads serving a request are sampled, with the endpoint as root of the stack
+    sampler = StackSampler(output=str(tmp_path / 'stacks.folded'))
+    sampler.sample_once()
+    assert sampler.folded() == ''
+    sampler.enter_request('get_user_info')
+    sampler.sample_once()
+    sampler.exit_request()
+    sampler.sample_once()
+    stack, count = sampler.folded().strip().rsplit(' ', 1)
+    assert stack.startswith('get_user_info;') and 'test_profiling (test_unit.py:' in stack and count == '1'
+    sampler.flush()
+    assert (tmp_path / f"stacks.folded.{os.getpid()}").read_text() == sampler.folded()
+
+    profile_dir = tmp_path / 'profiles'
+    monkeypatch.setenv('PROFILE_DIR', str(profile_dir))
+    monkeypatch.setenv('PROFILE_TOKEN', 'profile-secret')
+    monkeypatch.setenv('PROFILE_MAX_PER_MINUTE', '2')
+    app = create_app(testing="unit")
+    with app.test_client() as profile_client:
+        # Without the token nothing is profiled
+        response = profile_client.get('/livez', headers={'X-Profile-Token': 'wrong'})
+        assert response.status_code == 200 and 'X-Profile-Id' not in response.headers
+        # With it, the dump is written once the response is closed
+        response = profile_client.get('/livez', headers={'X-Profile-Token': 'profile-secret'})
+        profile_id = response.headers['X-Profile-Id']
+        assert profile_id.startswith('liveness_check-')
+        response.close()
+        pstats.Stats(str(profile_dir / profile_id))
+        # At most PROFILE_MAX_PER_MINUTE requests a minute are profiled
+        profile_client.get('/livez', headers={'X-Profile-Token': 'profile-secret'}).close()
+        response = profile_client.get('/livez', headers={'X-Profile-Token': 'profile-secret'})
+        assert 'X-Profile-Id' not in response.headers
+        assert len(list(profile_dir.glob('*.prof'))) == 2
+
+        # Settings can be changed at runtime from the admin endpoint
+        assert profile_client.post('/v1/admin/profiling', json={'request_rate': 2}).status_code == 400
+        response = profile_client.post('/v1/admin/profiling', json={'sampler': True, 'request_rate': 0.5})
+        assert response.status_code == 200
+        assert response.json['sampler']['running'] is True and response.json['request_profiles']['rate'] == 0.5
+        response = profile_client.post('/v1/admin/profiling', json={'sampler': False})
+        assert response.json['sampler']['running'] is False
+        assert profile_client.get('/v1/admin/profiling/stacks').mimetype == 'text/plain'
+        # Not served to other hosts without the admin token
+        assert profile_client.get('/v1/admin/profiling', headers={'X-Forwarded-For': '203.0.113.9'}).status_code == 404
+    print("Stacks sampled and request profiles written within budget")
+
+
+# Test request tracing across the database, S3 and SNS, and the batched span export
+def test_request_tracing(client, monkeypatch):
+    print("\n34. Testing Distributed Request Tracing")
+    spans = []
+    exporter = BatchSpanExporter(SimpleNamespace(write=spans.extend))
+    monkeypatch.setattr(tracer, 'exporter', exporter)
+    # Only traces the ALB marks as sampled are exported
+    monkeypatch.setattr(tracer, 'sample_rate', 0.0)
+    monkeypatch.setattr(utils.s3, 's3_client', StubS3())
+    monkeypatch.setenv('IMAGE_UPLOAD_MODE', 'buffered')
+    monkeypatch.setenv('AWS_S3_BUCKET', 'webapp-bucket')
+    user, password, headers = create_verified_user('trace')
+
+    trace_id = '1-67891233-abcdef012345678912345678'
+    headers = {**headers, 'X-Amzn-Trace-Id': f"Root={trace_id};Parent=53995c3f42cd8ad8;Sampled=1"}
+    data = {'file': (BytesIO(b'image-bytes'), 'pic.png')}
+    response = client.post('/v1/user/self/pic', headers=headers, data=data)
+    assert response.status_code == 201
+    assert response.headers['X-Amzn-Trace-Id'].startswith(f"Root={trace_id};")
+    exporter.flush()
+    root = next(span for span in spans if span['kind'] == 'server')
+    assert root['trace_id'] == trace_id and root['parent_id'] == '53995c3f42cd8ad8'
+    assert root['attributes']['http.route'] == '/v1/user/self/pic'
+    assert root['attributes']['http.status_code'] == 201
+    children = [span for span in spans if span['parent_id'] == root['span_id']]
+    queries = [span for span in children if span['name'] == 'db.query']
+    assert queries and all(span['trace_id'] == trace_id for span in queries)
+    assert any(span['attributes']['db.statement'].startswith('INSERT INTO images') for span in queries)
+    upload = next(span for span in children if span['name'] == 's3.upload_to_s3')
+    assert upload['attributes']['s3.bucket'] == 'webapp-bucket' and 'error' not in upload
+
+    # Unsampled requests still get a trace id, but nothing is exported
+    spans.clear()
+    response = client.get('/livez')
+    assert response.headers['X-Amzn-Trace-Id'].endswith(';Sampled=0')
+    exporter.flush()
+    assert spans == []
+
+    # The outbox dispatcher traces each drain that publishes something
+    message = enqueue_verification(user, 'http://localhost/v1/verify-email?token=abc')
+    db.session.commit()
+    monkeypatch.setattr(tracer, 'sample_rate', 1.0)
+    OutboxDispatcher(client.application, client_factory=StubSNS).drain()
+    exporter.flush()
+    drain = next(span for span in spans if span['name'] == 'sns.outbox.drain')
+    publish = next(span for span in spans if span['name'] == 'sns.publish_batch')
+    assert drain['parent_id'] is None and publish['parent_id'] == drain['span_id']
+    assert publish['attributes']['sns.messages'] >= 1
+    db.session.expire_all()
+    assert message.sent_at is not None
+
+    # Calls to AWS carry the trace, and log lines its id
+    boto_request = SimpleNamespace(headers={})
+    record = logging.LogRecord('tracing', logging.INFO, __file__, 1, 'message', None, None)
+    with tracer.span('work', root=True) as span:
+        boto3_client = tracer.instrument_boto_client(boto3.client('s3', region_name='us-east-1'))
+        boto3_client.meta.events.emit('before-send.s3.HeadObject', request=boto_request)
+        TraceContextFilter(tracer).filter(record)
+    assert boto_request.headers['X-Amzn-Trace-Id'].startswith(f"Root={span.trace_id};Parent={span.span_id};")
+    assert json.loads(JsonFormatter().format(record))['trace_id'] == span.trace_id
+    # The ALB only sets the root
+    assert parse_trace_header(f"Root={trace_id}") == (trace_id, None, None)
+    # Export to an OTLP collector drops the X-Ray version and dashes from the trace id
+    otlp = to_otlp([root], 'webapp')['resourceSpans'][0]['scopeSpans'][0]['spans'][0]
+    assert otlp['traceId'] == '67891233abcdef012345678912345678' and otlp['kind'] == 2
+    print("Spans exported for the request, its queries, S3 upload and SNS publish")
+
+
+# Test statement fingerprints, per-statement statistics and the slow query log
+def test_query_statistics(client, monkeypatch):
+    print("\n35. Testing Query Statistics and the Slow Query Log")
+    # Statements that only differ in parameters, literals and list lengths share a fingerprint
+    assert fingerprint("SELECT * FROM users WHERE email = %(email_1)s AND id IN (%(id_1_1)s, %(id_1_2)s) LIMIT 5") == \
+        fingerprint("SELECT *  FROM users\nWHERE email = 'a@b.com' AND id IN (?) LIMIT 1 -- comment") == \
+        "SELECT * FROM users WHERE email = ? AND id IN (...) LIMIT ?"
+    assert fingerprint("INSERT INTO t (a, b) VALUES (?, ?), (?, ?), (?, ?)") == "INSERT INTO t (a, b) VALUES (?, ?)"
+
+    query_stats = client.application.extensions['query_stats']
+    query_stats.clear()
+    User.query.filter_by(email=f"first_{local_part}@{domain}").first()
+    User.query.filter_by(email=f"second_{local_part}@{domain}").first()
+    lookup = next(query for query in query_stats.top(10, sort='count') if query['fingerprint'].startswith('SELECT users.id'))
+    assert lookup['count'] == 2 and lookup['slow'] == 0 and lookup['plan'] is None
+    assert lookup['total_ms'] >= lookup['max_ms'] >= lookup['p50_ms'] > 0
+
+    # Slow statements get their plan, without the parameter values
+    monkeypatch.setattr(query_stats, 'slow_threshold', 0)
+    email = f"slow_{local_part}@{domain}"
+    User.query.filter_by(email=email).first()
+    monkeypatch.setattr(query_stats, 'slow_threshold', 60)
+    lookup = next(query for query in query_stats.top(10) if query['id'] == lookup['id'])
+    assert lookup['count'] == 3 and lookup['slow'] == 1
+    assert 'users' in lookup['plan'] and email not in lookup['plan']
+
+    # Failed statements are counted as errors
+    try:
+        db.session.execute(text('SELECT * FROM missing_table'))
+    except Exception:
+        db.session.rollback()
+    failed = next(query for query in query_stats.top(10) if 'missing_table' in query['fingerprint'])
+    assert failed['errors'] == 1 and failed['count'] == 0
+
+    # Top-N export
+    response = client.get('/v1/admin/queries?sort=max&limit=1')
+    assert response.status_code == 200
+    assert len(response.json['queries']) == 1 and response.json['fingerprints'] == len(query_stats)
+    assert client.get('/v1/admin/queries?sort=name').status_code == 400
+    assert client.get('/v1/admin/queries', headers={'X-Forwarded-For': '203.0.113.9'}).status_code == 404
+    assert client.delete('/v1/admin/queries').status_code == 204
+    assert len(query_stats) == 0
+    print("Statements fingerprinted, timed and explained when slow")
+
+
+# Test that the verification expiry check uses the TTL and clock of each execution
+def test_verification_expiry_query(client, monkeypatch):
+    print("\n36. Testing the Verification Token Expiry Query")
+    user = User(
+        first_name=fake.first_name(),
+        last_name=fake.last_name(),
+        email=f"expiry_{local_part}@{domain}",
+        password='not-a-real-hash',
+        verification_token=str(uuid.uuid4()),
+        verification_token_created=utc_now() - timedelta(seconds=90)
+    )
+    db.session.add(user)
+    db.session.commit()
+
+    def is_valid(ttl):
+        statement = select(User.id).where(User.id == user.id, User.verification_token_created > db_now_minus(ttl))
+        return db.session.execute(statement).first() is not None
+
+    # Same statement shape with different TTLs: each execution uses its own
+    assert is_valid(timedelta(minutes=2))
+    assert not is_valid(timedelta(minutes=1))
+    assert is_valid(timedelta(minutes=5))
+    # Later on, the same TTL no longer accepts the token
+    later = utc_now() + timedelta(minutes=10)
+    monkeypatch.setattr(utils.models, 'utc_now', lambda: later)
+    assert not is_valid(timedelta(minutes=2))
+    assert is_valid(timedelta(minutes=15))
+    monkeypatch.undo()
+
+    # On PostgreSQL the interval is a bound parameter of a cached statement
+    statements = [select(User.id).where(User.verification_token_created > db_now_minus(ttl))
+                  for ttl in (timedelta(minutes=2), timedelta(minutes=5))]
+    assert statements[0]._generate_cache_key().key == statements[1]._generate_cache_key().key
+    compiled = [statement.compile(dialect=postgresql.dialect()) for statement in statements]
+    assert 'now() - %(ttl_1)s' in str(compiled[0])
+    assert [params['ttl_1'] for params in (compiled[0].params, compiled[1].params)] == [timedelta(minutes=2), timedelta(minutes=5)]
+
+    # And through the endpoint
+    assert client.get(f"/v1/verify-email?token={user.verification_token}").status_code == 200
+    print("Expiry checked against the TTL and time of each request")
+
+
+# Test that timestamps are returned in EST and that migration 0003 converts the old columns
+def test_timestamp_serialization_and_migration(client):
+    print("\n37. Testing Timestamp Serialization and the timestamptz Migration")
+    winter = datetime(2024, 1, 15, 17, 30, tzinfo=timezone.utc)
+    assert to_est_isoformat(winter) == '2024-01-15T12:30:00-05:00'
+    assert to_est_isoformat(datetime(2024, 7, 15, 17, 30, tzinfo=timezone.utc)) == '2024-07-15T13:30:00-04:00'
+    # SQLite hands back naive values, which are stored in UTC
+    assert to_est_isoformat(winter.replace(tzinfo=None)) == '2024-01-15T12:30:00-05:00'
+    assert to_est_date(datetime(2024, 1, 16, 3, 0, tzinfo=timezone.utc)) == '2024-01-15'
+    assert to_est_isoformat(None) is None and to_est_date(None) is None
+
+    # Stored values come back as the same instant
+    user, password, headers = create_verified_user('timestamps', account_created=winter, account_updated=winter)
+    response = client.get('/v1/user/self', headers=headers)
+    assert response.status_code == 200
+    assert response.json['account_created'] == '2024-01-15T12:30:00-05:00'
+
+    # Migration 0003 on a database that still has the string columns
+    class MigrationConnection:
+        def __init__(self, column_type):
+            self.column_type = column_type
+            self.statements = []
+
+        def execute(self, statement, params=None):
+            self.statements.append(str(statement))
+            return SimpleNamespace(scalar=lambda: self.column_type)
+
+    migration = dict(MIGRATIONS)['0003_native_timestamps']
+    conn = MigrationConnection('character varying')
+    migration(conn, 'postgresql')
+    alters = [statement for statement in conn.statements if statement.startswith('ALTER TABLE')]
+    assert len(alters) == 2
+    for column in ('account_created', 'account_updated', 'verification_token_created'):
+        assert f"ALTER COLUMN {column} TYPE timestamptz USING NULLIF({column}, '')::timestamptz" in alters[0]
+    assert "upload_date TYPE timestamptz USING (NULLIF(upload_date, '')::date)::timestamp AT TIME ZONE 'US/Eastern'" in alters[1]
+    # Already converted: nothing to do
+    conn = MigrationConnection('timestamp with time zone')
+    migration(conn, 'postgresql')
+    assert not any(statement.startswith('ALTER TABLE') for statement in conn.statements)
+    # SQLite databases are created with the final schema
+    conn = MigrationConnection('character varying')
+    migration(conn, 'sqlite')
+    assert conn.statements == []
+    print("Timestamps serialized in EST and old columns converted")
+
+
+# Test that a password changed on another instance stops working here too
+def test_password_change_on_another_instance(client):
+    print("\n38. Testing Cached Credentials After a Password Change Elsewhere")
+    user, old_password, _ = create_verified_user('rotate')
+    new_password = fake.password()
+
+    def authenticate(password):
+        return client.get('/v1/user/self', headers=basic_auth(user.email, password)).status_code
+
+    # Cached in this instance's auth cache
+    assert authenticate(old_password) == 200
+    assert authenticate(old_password) == 200
+    # Another instance changes the password. All that reaches this one is the user cache
+    # invalidation on the shared channel, its auth cache is left as it was
+    new_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt(4)).decode('utf-8')
+    db.session.execute(update(User).where(User.id == user.id).values(password=new_hash))
+    db.session.commit()
+    user_cache.invalidate(user.email)
+    assert authenticate(old_password) == 401
+    assert authenticate(new_password) == 200
+    print("Old password rejected once the stored hash changed")
+
+
+# Test that verification emails are not sent or retried once their link has expired
+def test_outbox_gives_up_on_expired_messages(client):
+    print("\n39. Testing SNS Outbox Expiry")
+    user = User(
+        first_name=fake.first_name(),
+        last_name=fake.last_name(),
+        email=f"expired_outbox_{local_part}@{domain}",
+        password='not-a-real-hash',
+        verification_token=str(uuid.uuid4())
+    )
+    db.session.add(user)
+    db.session.flush()
+    # Queued while SNS was unreachable for longer than the token lives
+    stale = enqueue_verification(user, 'http://localhost/v1/verify-email?token=stale')
+    stale.created_at = stale.next_attempt_at = utc_now() - VERIFICATION_TOKEN_TTL - timedelta(seconds=1)
+    db.session.commit()
+    sns = StubSNS()
+    dispatcher = OutboxDispatcher(client.application, client_factory=lambda: sns, max_attempts=8)
+    dispatcher.drain()
+    db.session.expire_all()
+    assert sns.batches == []
+    assert stale.sent_at is None and stale.attempts == 8
+    assert stale.last_error.startswith('Expired')
+
+    # A failure whose retry would come after the token expires is not retried
+    fresh = enqueue_verification(user, 'http://localhost/v1/verify-email?token=fresh')
+    db.session.commit()
+    failing_sns = StubSNS(fail=True)
+    OutboxDispatcher(client.application, client_factory=lambda: failing_sns,
+                     base_backoff=VERIFICATION_TOKEN_TTL.total_seconds()).drain()
+    db.session.expire_all()
+    assert len(failing_sns.batches) == 1
+    assert fresh.attempts == 8 and fresh.last_error.startswith('Expired')
+    # Nothing is claimed again
+    dispatcher.drain()
+    assert sns.batches == []
+    print("Expired verification messages given up on")
+
+
+# Test that the replica only affects the deep check and AWS clients are built once
+def test_health_monitor_setup(monkeypatch, tmp_path):
+    print("\n40. Testing Health Monitor Setup")
+    built = []
+
+    class StubClient:
+        def head_bucket(self, Bucket):
+            pass
+
+        def get_topic_attributes(self, TopicArn):
+            pass
+
+    def aws_client(service, timeout):
+        built.append(service)
+        return StubClient()
+
+    monkeypatch.setattr(utils.health, '_aws_client', aws_client)
+    monkeypatch.setenv('AWS_S3_BUCKET', 'bucket')
+    monkeypatch.setenv('AWS_SNS_TOPIC_ARN', 'arn:aws:sns:us-east-1:123456789012:topic')
+    # The replica's database file is in a directory that does not exist
+    engines = {
+        None: create_engine(f"sqlite:///{tmp_path / 'primary.db'}"),
+        REPLICA_BIND_KEY: create_engine(f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    }
+    monitor = utils.health.create_health_monitor(engines)
+    assert sorted(built) == ['s3', 'sns']
+    assert monitor.is_ready()
+    status = monitor.deep_status()
+    assert status == {'database': 'ok', f"database_{REPLICA_BIND_KEY}": 'failing', 's3': 'ok', 'sns': 'ok'}
+    assert sorted(built) == ['s3', 'sns']
+    print("Replica reported by the deep check only, AWS clients reused")
+
+
+# Test that only async logging samples, and never failed login attempts
+def test_log_sampling_scope(monkeypatch, tmp_path):
+    print("\n41. Testing Log Sampling Scope")
+    configured = {}
+    monkeypatch.setattr(logging, 'basicConfig', lambda **kwargs: configured.update(kwargs))
+    monkeypatch.setenv('LOG_FILE', str(tmp_path / 'webapp.log'))
+    monkeypatch.setenv('LOG_MODE', 'sync')
+    assert configure_logging() is None
+    assert all(not handler.filters for handler in configured['handlers'])
+
+    sampler = SamplingFilter(burst=1, window=60)
+    logger = logging.getLogger('tests.log_sampling')
+    records = [
+        logger.makeRecord(logger.name, logging.ERROR, __file__, 0, "Unauthorized access attempt for email: %s",
+                          (email,), None, extra=UNSAMPLED)
+        for email in ('a@example.com', 'b@example.com', 'c@example.com')
+    ]
+    assert all(sampler.filter(record) for record in records)
+    errors = [logger.makeRecord(logger.name, logging.ERROR, __file__, 0, "Error: %s", (n,), None) for n in range(3)]
+    assert [sampler.filter(record) for record in errors] == [True, False, False]
+    print("Sync mode unsampled, failed logins always logged")
+
+
+# Test the pool options read from the environment and the failover handling
+def test_database_pool_configuration(monkeypatch, tmp_path):
+    print("\n42. Testing Database Pool Configuration")
+    monkeypatch.setenv('DB_POOL_SIZE', '20')
+    monkeypatch.setenv('DB_POOL_PRE_PING', 'false')
+    monkeypatch.setenv('DB_STATEMENT_TIMEOUT_MS', '1500')
+    options = get_engine_options()
+    assert options['pool_size'] == 20 and options['max_overflow'] == 10
+    assert options['pool_pre_ping'] is False
+    assert options['connect_args']['options'] == '-c statement_timeout=1500'
+    monkeypatch.setenv('DB_STATEMENT_TIMEOUT_MS', '0')
+    assert 'options' not in get_engine_options()['connect_args']
+
+    # A write on an instance that came back as a reader after a failover
+    class ReadOnlyError(sqlite3.OperationalError):
+        pgcode = READ_ONLY_SQL_TRANSACTION
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'failover.db'}")
+    register_failover_handler(engine)
+    register_pool_metrics(engine, 'replica')
+
+    def read_only(cursor, statement, parameters, context):
+        raise ReadOnlyError('cannot execute UPDATE in a read-only transaction')
+
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+        event.listen(engine, 'do_execute', read_only)
+        with pytest.raises(DBAPIError) as error:
+            conn.execute(text('SELECT 1'))
+        event.remove(engine, 'do_execute', read_only)
+    assert error.value.connection_invalidated
+    engine.dispose()
+
+    # Checkout waits are timed, and checkouts that give up are counted
+    pool_metrics = Metrics(tag_format='name')
+    monkeypatch.setattr(utils.db_pool, 'metrics', pool_metrics)
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=TimedQueuePool,
+                           pool_size=1, max_overflow=0, pool_timeout=0.05)
+    register_pool_metrics(engine, 'replica')
+    engine.dispose()
+    with engine.connect():
+        with pytest.raises(SQLAlchemyTimeoutError):
+            engine.connect()
+    lines = pool_metrics.collect()
+    assert len([line for line in lines if line.startswith('database.pool.wait.replica:')]) == 1
+    assert 'database.pool.timeout.replica:1|c' in lines
+    assert 'database.pool.idle.replica:1|g' in lines
+    assert 'database.pool.checked_out.replica:0|g' in lines
+    engine.dispose()
+
+    # Migrations run without the statement timeout, and restore it afterwards
+    class MigrationEngine:
+        dialect = SimpleNamespace(name='postgresql')
+
+        def __init__(self):
+            self.statements = []
+
+        def connect(self):
+            return self
+
+        def execution_options(self, **options):
+            return self
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def execute(self, statement, params=None):
+            self.statements.append(str(statement))
+            if str(statement).startswith('SELECT version'):
+                return [(version,) for version, _ in MIGRATIONS]
+            return None
+
+    migration_engine = MigrationEngine()
+    assert run_migrations(migration_engine)
+    statements = migration_engine.statements
+    assert statements.index('SET statement_timeout = 0') < statements.index('SELECT pg_advisory_lock(:key)')
+    assert statements[-1] == 'RESET statement_timeout'
+    print("Pool configured from the environment, read-only errors invalidate the pool")
+
+
+# Test the presigned URL cache bounds and the upload policy's content type
+def test_presigned_url_cache_bounds(client, monkeypatch):
+    print("\n43. Testing Presigned URL Cache Bounds and Upload Policy")
+    cache = PresignedUrlCache(refresh_margin=30, max_size=2)
+    now = time.time()
+    cache.set('a', 'a.png', 'url-a', now + 300)
+    cache.set('b', 'b.png', 'url-b', now + 300)
+    assert cache.get('a', 'a.png') == 'url-a'
+    # 'b' is the least recently used
+    cache.set('c', 'c.png', 'url-c', now + 300)
+    assert len(cache) == 2
+    assert cache.get('b', 'b.png') is None
+    assert cache.get('a', 'a.png') == 'url-a'
+    # Expired entries are dropped when read
+    cache.set('d', 'd.png', 'url-d', now + 10)
+    assert cache.get('d', 'd.png') is None
+    assert len(cache) == 1
+
+    stub_s3 = StubS3()
+    monkeypatch.setattr(utils.s3, 's3_client', stub_s3)
+    upload = create_presigned_upload('webapp-bucket', 'pic.jpg', 1024, 'image/jpeg')
+    assert upload['fields']['Content-Type'] == 'image/jpeg'
+    assert {'Content-Type': 'image/jpeg'} in stub_s3.post_conditions
+    assert ['content-length-range', 1, 1024] in stub_s3.post_conditions
+    print("Presigned URL cache bounded, upload policy pinned to the image type")
+
+
+# Test that a hash that runs past the timeout keeps its slot and answers 503
+def test_password_hasher_timeout(client, monkeypatch):
+    print("\n44. Testing Password Hashing Timeout")
+    hasher = PasswordHasher(mode='thread', workers=1, max_queue=1, rounds=4, timeout=0.05)
+    finish = threading.Event()
+    with pytest.raises(PasswordHasherSaturated):
+        hasher._run('hash', finish.wait)
+    # The job is still running on the pool, so its slot is not free yet
+    with pytest.raises(PasswordHasherSaturated):
+        hasher.hash('password-a')
+    finish.set()
+    deadline = time.monotonic() + 5
+    while hasher._depth and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert hasher.check('password-a', hasher.hash('password-a'))
+    hasher.shutdown()
+
+    # Signup answers 503, not 400 "Missing fields"
+    slow_hasher = PasswordHasher(mode='thread', workers=1, rounds=14, timeout=0.01)
+    monkeypatch.setattr(sys.modules['app'], 'password_hasher', slow_hasher)
+    monkeypatch.setattr(sys.modules['app'], 'signup_email_validator', SimpleNamespace(validate=lambda email: None))
+    response = client.post('/v1/user', json={
+        'first_name': fake.first_name(),
+        'last_name': fake.last_name(),
+        'email': f"timeout_{local_part}@{domain}",
+        'password': 'Password@123'
+    })
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    slow_hasher.shutdown()
+    print("Timed out hashes hold their slot and return 503")
+
+
+# Test that capture only runs with a secret every worker shares
+def test_request_capture_secret(monkeypatch, tmp_path):
+    print("\n45. Testing Request Capture Secret")
+    monkeypatch.setenv('REQUEST_CAPTURE_FILE', str(tmp_path / 'capture.jsonl'))
+    monkeypatch.delenv('REQUEST_CAPTURE_SECRET', raising=False)
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    assert create_request_capture() is None
+
+    monkeypatch.setenv('SECRET_KEY', 'app-secret')
+    first, second = create_request_capture(), create_request_capture()
+    assert first.user_key('user@example.com') == second.user_key('user@example.com')
+    monkeypatch.setenv('REQUEST_CAPTURE_SECRET', 'capture-secret')
+    assert create_request_capture().user_key('user@example.com') != first.user_key('user@example.com')
+    assert create_request_capture().user_key('user@example.com') == RequestCapture(
+        'unused', secret=b'capture-secret').user_key('user@example.com')
+    print("Capture user keys shared across workers")
+
+
+# Test that reads fall back to the primary when the replica cannot be reached
+def test_replica_fallback(monkeypatch, tmp_path):
+    print("\n46. Testing Read Replica Fallback")
+    # The replica's database file is in a directory that does not exist
+    monkeypatch.setenv('DB_REPLICA_URI', f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    app = create_app(testing="unit")
+    app.config['TESTING'] = True
+    with app.app_context():
+        db.create_all(bind_key=None)
+        user, password, headers = create_verified_user('fallback')
+    sticky_writes.clear()
+    replica_status.reset()
+    try:
+        with app.test_client() as fallback_client:
+            response = fallback_client.get('/v1/user/self', headers=headers)
+            assert response.status_code == 200
+            assert replica_status.is_down()
+            response = fallback_client.put('/v1/user/self', json={'first_name': 'Updated'}, headers=headers)
+            assert response.status_code == 204
+            assert fallback_client.get('/v1/user/self/pic', headers=headers).status_code == 404
+            # Still ready, only the deep check reports the replica
+            assert fallback_client.get('/healthz').status_code == 200
+            response = fallback_client.get('/healthz/deep')
+            assert response.status_code == 503
+            assert json.loads(response.data)[f"database_{REPLICA_BIND_KEY}"] == 'failing'
+            # Once the replica is due to be retried, the failing attempt falls back again
+            replica_status.reset()
+            user_cache.clear()
+            sticky_writes.clear()
+            response = fallback_client.get('/v1/user/self', headers=headers)
+            assert response.status_code == 200
+            assert json.loads(response.data)['first_name'] == 'Updated'
+    finally:
+        replica_status.reset()
+        with app.app_context():
+            db.session.remove()
+            db.drop_all(bind_key=None)
+    print("Reads served by the primary while the replica is unreachable")
+
+
+# Test that the user cache needs a shared tier by default and never holds the token
+def test_user_cache_defaults(client, monkeypatch):
+    print("\n47. Testing User Cache Defaults")
+    monkeypatch.delenv('USER_CACHE_REDIS_URL', raising=False)
+    monkeypatch.delenv('USER_CACHE_ENABLED', raising=False)
+    assert create_user_cache().max_size == 0
+    monkeypatch.setenv('USER_CACHE_ENABLED', 'true')
+    assert create_user_cache().max_size == 10000
+
+    user, password, headers = create_verified_user('uncached')
+    record = snapshot(user)
+    assert 'verification_token' not in record['user']
+    assert 'verification_token' not in json.loads(dump_snapshot(record))['user']
+    # A cached user can still be updated without clearing the token
+    cache = UserCache(ttl=60, fill_delay=0)
+    cache.get_user(user.email, lambda email: User.query.filter_by(email=email).first())
+    db.session.remove()
+    cached = cache.get_user(user.email, lambda email: None)
+    cached.first_name = 'Cached'
+    db.session.commit()
+    assert cached.verification_token == user.verification_token
+    db.session.expire_all()
+    assert db.session.get(User, user.id).verification_token == user.verification_token
+    print("User cache off without a shared tier, tokens left out")
+
+
+# Test that malformed and truncated multipart bodies get a 400 in streaming mode
+def test_streamed_upload_malformed_body(client, monkeypatch):
+    print("\n48. Testing Streamed Upload of Malformed Bodies")
+    stub_s3 = StubS3()
+    monkeypatch.setattr(utils.s3, 's3_client', stub_s3)
+    monkeypatch.setenv('IMAGE_UPLOAD_MODE', 'stream')
+    user, password, headers = create_verified_user('malformed')
+    content_type = 'multipart/form-data; boundary=----b'
+    body = (b'------b\r\nContent-Disposition: form-data; name="file"; filename="pic.png"\r\n'
+            b'Content-Type: image/png\r\n\r\n' + b'x' * 100 + b'\r\n------b--\r\n')
+    bodies = {
+        'garbage': b'------b\r\nnonsense\r\n\r\nxx',
+        # Ends in the middle of the file, before the closing boundary
+        'truncated': body[:150],
+    }
+    for name, data in bodies.items():
+        response = client.post('/v1/user/self/pic', headers=headers, content_type=content_type, data=data)
+        assert response.status_code == 400, name
+        assert json.loads(response.data)['message'] == 'Malformed multipart body'
+    # The upload started for the truncated body was aborted
+    assert len(stub_s3.aborted) == 1
+    assert Image.query.filter_by(user_id=user.id).first() is None
+    # Buffered mode answers the same
+    monkeypatch.setenv('IMAGE_UPLOAD_MODE', 'buffered')
+    for data in bodies.values():
+        assert client.post('/v1/user/self/pic', headers=headers, content_type=content_type,
+                           data=data).status_code == 400
+    print("Malformed and truncated bodies rejected with a 400")
+
+
+# Test that queued records carry the message as it was when logged
+def test_queued_log_message_formatting():
+    print("\n49. Testing Queued Log Message Formatting")
+    output = StringIO()
+    stream_handler = logging.StreamHandler(output)
+    stream_handler.setFormatter(JsonFormatter())
+    queue_handler = NonBlockingQueueHandler(queue.Queue(10))
+    listener = BatchingQueueListener(queue_handler.queue, [stream_handler], batch_size=10, flush_interval=0.05)
+    logger = logging.getLogger('tests.queued_formatting')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(queue_handler)
+    try:
+        state = ['pending']
+        # The writer thread is not running yet, so the record waits in the queue
+        logger.info("Upload state: %s", state)
+        state[0] = 'done'
+        record = queue_handler.queue.queue[0]
+        assert record.args is None
+        listener.start()
+        listener.stop()
+    finally:
+        logger.removeHandler(queue_handler)
+    assert json.loads(output.getvalue())['message'] == "Upload state: ['pending']"
+    print("Queued records formatted on the logging thread")
+
+
 print("\n--- All Endpoint Tests Completed ---")